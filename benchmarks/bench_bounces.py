@@ -0,0 +1,55 @@
+'''
+bench_bounces.py: 最大反射次数与轮盘赌存活概率对光学过程的影响
+
+运行: python -m benchmarks.bench_bounces [-n 事件数] [-g geo.h5] [-s 种子] [--optics numba]
+
+对每组(max_bounces, survival)给出每秒追踪的光子数、每个光子的PE数及其相对
+默认设置的偏差。截断丢弃了反射多次后才到达PMT的光子，PE数随max_bounces增加而收敛;
+轮盘赌的期望不变，只增大涨落
+'''
+
+import argparse
+import time
+import h5py as h5
+from scripts.event import generate_events
+from scripts.genPETruth import get_PE_Truth, BACKENDS, MAX_BOUNCES, SURVIVAL
+from scripts.rng import CounterRNG
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", dest="n", type=int, default=10, help="Number of events")
+    parser.add_argument("-g", "--geo", dest="geo", type=str, default="geo.h5", help="Geometry file")
+    parser.add_argument("-p", "--pmt", dest="pmt_count", type=int, default=17612, help="Number of PMTs")
+    parser.add_argument("-s", "--seed", dest="seed", type=int, default=0, help="Random seed")
+    parser.add_argument("--optics", dest="optics", type=str, choices=BACKENDS[:2],
+                        default="numba", help="Optics backend")
+    args = parser.parse_args()
+
+    with h5.File(args.geo, "r") as geo:
+        PMT_list = geo['Geometry'][:args.pmt_count]
+    rng = CounterRNG(args.seed)
+    ParticleTruth, PhotonTruth = generate_events(args.n, rng=rng)
+
+    # 预热: numba编译不计入
+    get_PE_Truth(ParticleTruth[:1], PhotonTruth[:1000], PMT_list, rng,
+                 backend=args.optics, survival=0.5)
+
+    settings = [(0, 1.0), (1, 1.0), (2, 1.0), (MAX_BOUNCES, SURVIVAL), (8, 1.0), (16, 1.0),
+                (16, 0.5), (16, 0.2), (64, 0.2)]
+    results = {}
+    for max_bounces, survival in settings:
+        start = time.perf_counter()
+        PETruth = get_PE_Truth(
+            ParticleTruth, PhotonTruth, PMT_list, rng, backend=args.optics,
+            max_bounces=max_bounces, survival=survival
+        )
+        results[max_bounces, survival] = (len(PETruth), time.perf_counter() - start)
+
+    reference = results[MAX_BOUNCES, SURVIVAL][0]
+    # 表头用ASCII，中文在终端中占两列，会使各列错位
+    print(f'{"max_bounces":>11} {"survival":>8} {"photons/s":>10} {"PE/photon":>10} '
+          f'{"PE bias":>9}')
+    for (max_bounces, survival), (count, elapsed) in results.items():
+        print(f'{max_bounces:>11} {survival:>8.2f} {len(PhotonTruth)/elapsed:>10.3g} '
+              f'{count/len(PhotonTruth):>10.4f} {count/reference - 1:>+9.2%}')
@@ -0,0 +1,48 @@
+'''
+bench_event.py: 比较GenTime的两种采样方法
+
+运行: python -m benchmarks.bench_event [-n 事件数]
+
+对thinning与inverse两种方法分别给出:
+每个事件的候选光子数, 峰值内存, 光子生成速率
+'''
+
+import argparse
+import time
+import tracemalloc
+from scripts.event import generate_events, get_cdf_list, get_expect_list, T_MAX
+
+
+def run(number_of_events, method):
+    '''
+    生成number_of_events个事件，返回(光子数, 用时/s, 峰值内存/B)
+    '''
+    tracemalloc.start()
+    start = time.perf_counter()
+    PhotonTruth = generate_events(number_of_events, method)[1]
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return PhotonTruth.shape[0], elapsed, peak
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", dest="n", type=int, default=1000, help="Number of events")
+    args = parser.parse_args()
+
+    # 预热: 表的缓存与numba编译不计入
+    generate_events(10, 'thinning')
+    generate_events(10, 'inverse')
+
+    candidates = {
+        'thinning': get_expect_list().max() * T_MAX,
+        'inverse': get_cdf_list()[-1],
+    }
+    results = {method: run(args.n, method) for method in candidates}
+
+    print(f'{"method":>10} {"candidates/event":>17} {"photons/event":>14} '
+          f'{"peak MB":>9} {"photons/s":>11}')
+    for method, (photons, elapsed, peak) in results.items():
+        print(f'{method:>10} {candidates[method]:>17.0f} {photons/args.n:>14.0f} '
+              f'{peak/2**20:>9.1f} {photons/elapsed:>11.3g}')
@@ -0,0 +1,145 @@
+'''
+bench_hdf5.py: 比较Waveform表的各种存储方式
+
+运行: python -m benchmarks.bench_hdf5 [-n 事件数] [-g geo.h5] [-s 种子] [-d 临时目录]
+
+先模拟n个事件的PETruth并在内存中合成各事件的Waveform表，再以各种方式写入临时文件:
+'append'为原来的逐个事件resize追加（默认分块，不压缩），其余为WaveformWriter
+预先分配、整块写入，按genWaveform.COMPRESSIONS压缩，压缩前做或不做shuffle。
+给出写入的吞吐量（按未压缩的大小计）、每1000个事件的文件大小、压缩率，
+以及随机读取一个事件的用时。
+'sparse'为零压缩（genWaveform.SparseWaveformWriter，默认阈值，gzip），由
+readWaveform.SparseWaveform读取并重建，另给出保留的采样点比例与被丢弃的采样点的最大值
+'''
+
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+import h5py as h5
+from scripts.event import generate_events
+from scripts.genPETruth import get_PE_Truth
+from scripts.genWaveform import event_waveforms, common_noise, count_waveforms, \
+    WaveformWriter, SparseWaveformWriter, WAVEFORM_DTYPE, COMPRESSIONS
+from scripts.readWaveform import SparseWaveform
+from scripts.rng import CounterRNG
+
+
+def write_append(filename, WFs):
+    '''
+    原来的写法: 每个事件resize一次再写入
+    '''
+    with h5.File(filename, "w") as f:
+        for WF in WFs:
+            if 'Waveform' not in f:
+                wfds = f.create_dataset('Waveform', (len(WF),), maxshape=(None,), dtype=WAVEFORM_DTYPE)
+            else:
+                wfds = f['Waveform']
+                wfds.resize(wfds.shape[0] + len(WF), axis=0)
+            wfds[-len(WF):] = WF
+
+
+def write_blocks(filename, WFs, rows, events, compression, shuffle):
+    '''
+    由WaveformWriter写入
+    '''
+    with h5.File(filename, "w") as f:
+        writer = WaveformWriter(f, rows, events, compression, shuffle)
+        for WF in WFs:
+            writer.write(WF)
+        writer.close()
+
+
+def write_sparse(filename, WFs):
+    '''
+    零压缩后写入
+    '''
+    with h5.File(filename, "w") as f:
+        writer = SparseWaveformWriter(f)
+        for WF in WFs:
+            writer.write(WF)
+        writer.close()
+
+
+def read_all(filename):
+    '''
+    读出完整的Waveform表，零压缩时重建
+    '''
+    with h5.File(filename, "r") as f:
+        if 'Waveform' in f:
+            return f['Waveform'][...]
+        return np.concatenate(list(SparseWaveform(f)))
+
+
+def read_events(filename, bounds, events, repeat=20):
+    '''
+    随机读取repeat个事件，返回每个事件的平均用时/s，零压缩时包括重建
+    '''
+    rng = np.random.default_rng(0)
+    with h5.File(filename, "r") as f:
+        if 'Waveform' in f:
+            wfds = f['Waveform']
+            read = lambda i: wfds[bounds[i]:bounds[i+1]]
+        else:
+            sparse = SparseWaveform(f)
+            read = lambda i: sparse.event(events[i])
+        begin = time.perf_counter()
+        for i in rng.integers(0, len(bounds) - 1, repeat):
+            read(i)
+        return (time.perf_counter() - begin) / repeat
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", dest="n", type=int, default=20, help="Number of events")
+    parser.add_argument("-g", "--geo", dest="geo", type=str, default="geo.h5", help="Geometry file")
+    parser.add_argument("-p", "--pmt", dest="pmt_count", type=int, default=17612, help="Number of PMTs")
+    parser.add_argument("-s", "--seed", dest="seed", type=int, default=0, help="Random seed")
+    parser.add_argument("-d", "--dir", dest="dir", type=str, default=None,
+                        help="Directory of the temporary files")
+    args = parser.parse_args()
+
+    with h5.File(args.geo, "r") as geo:
+        PMT_list = geo['Geometry'][:args.pmt_count]
+    rng = CounterRNG(args.seed)
+    ParticleTruth, PhotonTruth = generate_events(args.n, rng=rng)
+    PETruth = get_PE_Truth(ParticleTruth, PhotonTruth, PMT_list, rng, backend='numba')
+    noise_0 = common_noise(PETruth, ratio=1e-2, rng=rng)
+    WFs = list(event_waveforms(PETruth, noise_0, rng, method='template'))
+    rows, events = count_waveforms(PETruth)
+    bounds = np.cumsum([0] + [len(WF) for WF in WFs])
+    EventIDs = [WF['EventID'][0] for WF in WFs]
+    raw = rows * WAVEFORM_DTYPE.itemsize
+
+    layouts = {'append': lambda filename: write_append(filename, WFs)}
+    for compression in COMPRESSIONS:
+        for shuffle in ((False, True) if compression != 'none' else (False,)):
+            name = compression + ('+shuffle' if shuffle else '')
+            layouts[name] = lambda filename, c=compression, s=shuffle: \
+                write_blocks(filename, WFs, rows, events, c, s)
+    layouts['sparse'] = lambda filename: write_sparse(filename, WFs)
+
+    print(f'{events}个事件，平均每个事件 {rows/events:.0f} 个通道，'
+          f'未压缩 {raw/2**20:.1f} MB')
+    print(f'{"layout":>12} {"写入MB/s":>9} {"MB/1000事件":>12} {"压缩率":>6} {"读取ms/事件":>11}')
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        reference = None
+        for name, write in layouts.items():
+            filename = os.path.join(directory, f'{name}.h5')
+            begin = time.perf_counter()
+            write(filename)
+            elapsed = time.perf_counter() - begin
+            size = os.path.getsize(filename)
+            stored = read_all(filename)
+            if reference is None:
+                reference = stored
+            print(f'{name:>12} {raw/2**20/elapsed:>11.1f} {size/2**20/events*1000:>14.1f} '
+                  f'{raw/size:>9.2f} {read_events(filename, bounds, EventIDs)*1000:>14.2f}')
+            if name != 'sparse':
+                assert np.array_equal(stored, reference), f'{name} differs from append'
+                continue
+            # 零压缩是有损的: 保留的采样点不变，被丢弃的置为0
+            kept = stored['Waveform'] == reference['Waveform']
+            print(f'{"":>12} 重建后非零的采样点 {np.count_nonzero(stored["Waveform"])/stored["Waveform"].size:.2%}，'
+                  f'被丢弃的采样点最大为 {reference["Waveform"][~kept].max(initial=0)}')
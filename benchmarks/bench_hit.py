@@ -0,0 +1,135 @@
+'''
+bench_hit.py: 比较求光子击中PMT的两种方法
+
+运行: python -m benchmarks.bench_hit [-g geo.h5] [-p PMT数] [-n 光子数] [-b 暴力求交的光子数]
+
+光子从液闪表面向外出射（对应hit_PMT），或从PMT表面反射（对应fromPMT=True）,
+对PMTIndex与KDTreeIndex分别给出:
+建索引用时, 光子处理速率, 峰值内存, 击中率, 与PMTIndex结果一致的比例,
+以及在前-b个光子上与所有PMT暴力求交的结果一致的比例
+PMTIndex另给出每格候选PMT数的最大值与平均值
+'''
+
+import argparse
+import time
+import tracemalloc
+import numpy as np
+import h5py as h5
+from scripts.geometry import PMTIndex, KDTreeIndex, EPS
+from scripts.utils import xyz_from_spher, Ri, Ro, r_PMT
+
+
+def outgoing_photons(number_of_photons, rng):
+    '''
+    在液闪表面均匀取点，方向在向外的半球内均匀分布
+    '''
+    coordinates = rng.normal(size=(3, number_of_photons))
+    coordinates *= Ri / np.linalg.norm(coordinates, axis=0)
+    velocities = rng.normal(size=(3, number_of_photons))
+    velocities /= np.linalg.norm(velocities, axis=0)
+    inward = np.einsum('kn, kn->n', coordinates, velocities) < 0
+    velocities[:, inward] *= -1
+    return coordinates, velocities
+
+
+def reflected_photons(index, number_of_photons, rng):
+    '''
+    在被击中的PMT表面镜面反射，只保留不射回液闪的光子
+    '''
+    coordinates, velocities = outgoing_photons(4 * number_of_photons, rng)
+    PMT_index, photon_index = index.first_hit(coordinates, velocities)
+    coordinates = coordinates[:, photon_index]
+    velocities = velocities[:, photon_index]
+    w = coordinates - index.PMTs[:, PMT_index]
+    bw = np.einsum('kn, kn->n', w, velocities)
+    ts = -bw - np.sqrt(bw**2 - np.einsum('kn, kn->n', w, w) + r_PMT**2)
+    edge_points = coordinates + ts * velocities
+    normal_vectors = (edge_points - index.PMTs[:, PMT_index]) / r_PMT
+    velocities = velocities - 2 * np.einsum('kn, kn->n', velocities, normal_vectors) * normal_vectors
+    rt = -np.einsum('kn, kn->n', edge_points, velocities)
+    stay = np.linalg.norm(edge_points + rt*velocities, axis=0) >= Ri
+    return edge_points[:, stay][:, :number_of_photons], velocities[:, stay][:, :number_of_photons]
+
+
+def brute_force(PMTs, coordinates, velocities, chunk=100):
+    '''
+    与所有PMT求交，给出每个光子最先击中的PMT序号，-1为未击中
+    交点距离的判据与PMTIndex相同
+    '''
+    hits = np.full(coordinates.shape[1], -1)
+    for start in range(0, coordinates.shape[1], chunk):
+        o = coordinates[:, start:start + chunk, np.newaxis]
+        v = velocities[:, start:start + chunk, np.newaxis]
+        w = o - PMTs[:, np.newaxis, :]
+        bw = np.einsum('kmp, kmp->mp', w, np.broadcast_to(v, w.shape))
+        d = bw**2 - np.einsum('kmp, kmp->mp', w, w) + r_PMT**2
+        t = np.where(d >= 0, -bw - np.sqrt(np.maximum(d, 0)), np.inf)
+        t[t <= EPS] = np.inf
+        nearest = np.argmin(t, axis=1)
+        hit = np.isfinite(t[np.arange(t.shape[0]), nearest])
+        hits[start:start + chunk] = np.where(hit, nearest, -1)
+    return hits
+
+
+def run(index, coordinates, velocities, fromPMT):
+    '''
+    返回(击中的PMT序号, 每个光子一个，-1为未击中), 用时/s, 峰值内存/B
+    '''
+    tracemalloc.start()
+    start = time.perf_counter()
+    PMT_index, photon_index = index.first_hit(coordinates, velocities, fromPMT)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    hits = np.full(coordinates.shape[1], -1)
+    hits[photon_index] = PMT_index
+    return hits, elapsed, peak
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-g", "--geo", dest="geo", type=str, default="geo.h5", help="Geometry file")
+    parser.add_argument("-p", "--pmt", dest="pmt_count", type=int, default=17612, help="Number of PMTs")
+    parser.add_argument("-n", dest="n", type=int, default=200000, help="Number of photons")
+    parser.add_argument("-b", dest="brute", type=int, default=2000,
+                        help="Number of photons checked against all PMTs")
+    args = parser.parse_args()
+
+    with h5.File(args.geo, "r") as geo:
+        PMT_list = geo['Geometry'][:args.pmt_count]
+    PMTs = np.stack(xyz_from_spher(
+        Ro, PMT_list['theta']/180*np.pi, PMT_list['phi']/180*np.pi
+    ))
+
+    indexes = {}
+    for name, cls in (('PMTIndex', PMTIndex), ('KDTree', KDTreeIndex)):
+        start = time.perf_counter()
+        indexes[name] = cls(PMTs)
+        print(f'{name}: 建索引用时 {time.perf_counter() - start:.2f}s')
+    table = indexes['PMTIndex'].table
+    counts = np.sum(table >= 0, axis=1)
+    print(f'PMTIndex: {table.shape[0]}个格子, '
+          f'每格至多{counts.max()}个候选PMT, 平均{counts.mean():.1f}个')
+
+    rng = np.random.default_rng(0)
+    # 预热numba编译
+    indexes['PMTIndex'].first_hit(*outgoing_photons(10, rng))
+    # fromPMT时KDTree在每条光线上取1000个点，光子数相应减少
+    cases = {
+        'LS->PMT': (outgoing_photons(args.n, rng), False),
+        'PMT->PMT': (reflected_photons(indexes['PMTIndex'], args.n // 100, rng), True),
+    }
+
+    print(f'{"case":>9} {"method":>9} {"photons":>8} {"photons/s":>10} '
+          f'{"peak MB":>8} {"hit rate":>9} {"agree":>7} {"brute":>7}')
+    for case, ((coordinates, velocities), fromPMT) in cases.items():
+        results = {
+            name: run(index, coordinates, velocities, fromPMT)
+            for name, index in indexes.items()
+        }
+        exact = results['PMTIndex'][0]
+        brute = brute_force(PMTs, coordinates[:, :args.brute], velocities[:, :args.brute])
+        for name, (hits, elapsed, peak) in results.items():
+            print(f'{case:>9} {name:>9} {hits.shape[0]:>8} {hits.shape[0]/elapsed:>10.3g} '
+                  f'{peak/2**20:>8.1f} {np.mean(hits >= 0):>9.4f} {np.mean(hits == exact):>7.4f} '
+                  f'{np.mean(hits[:brute.shape[0]] == brute):>7.4f}')
@@ -0,0 +1,85 @@
+'''
+bench_noise.py: 比较逐点抽取的正态噪声与噪声库
+
+运行: python -m benchmarks.bench_noise [-n 事件数] [-g geo.h5] [-s 种子]
+
+先模拟n个事件的PETruth，对'normal'与'bank'两种噪声、各event相同与否两种情况，
+逐个事件调用genWaveform.event_waveforms（'template'方法），给出每个事件制备噪声与
+合成波形的用时、峰值内存(tracemalloc)。再检查噪声库的统计性质:
+噪声库的均值、标准差与对标准正态分布的KS统计量，一个事件中偏移相同的行数，
+以及同一通道的各行噪声相加后的方差与行数之比（各行独立时为1）
+'''
+
+import argparse
+import time
+import tracemalloc
+import numpy as np
+import h5py as h5
+from scipy import stats
+from scripts.event import generate_events
+from scripts.genPETruth import get_PE_Truth
+from scripts.genWaveform import event_waveforms, common_noise, noise_bank, bank_noise, \
+    WINDOW, BANK_SIZE
+from scripts.rng import CounterRNG
+
+
+def run(PETruth, rng, noisetype, controlnoise):
+    '''
+    生成所有事件的波形，返回(每个事件的用时/s, 峰值内存/B)，共用的噪声计入
+    '''
+    tracemalloc.start()
+    begin = time.perf_counter()
+    noise_0 = common_noise(PETruth, noisetype=noisetype, controlnoise=controlnoise, rng=rng)
+    for WF in event_waveforms(PETruth, noise_0, rng, noisetype=noisetype, method='template'):
+        pass
+    elapsed = time.perf_counter() - begin
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed / len(np.unique(PETruth['EventID'])), peak
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", dest="n", type=int, default=10, help="Number of events")
+    parser.add_argument("-g", "--geo", dest="geo", type=str, default="geo.h5", help="Geometry file")
+    parser.add_argument("-p", "--pmt", dest="pmt_count", type=int, default=17612, help="Number of PMTs")
+    parser.add_argument("-s", "--seed", dest="seed", type=int, default=0, help="Random seed")
+    args = parser.parse_args()
+
+    with h5.File(args.geo, "r") as geo:
+        PMT_list = geo['Geometry'][:args.pmt_count]
+    rng = CounterRNG(args.seed)
+    ParticleTruth, PhotonTruth = generate_events(args.n, rng=rng)
+    PETruth = get_PE_Truth(ParticleTruth, PhotonTruth, PMT_list, rng, backend='numba')
+
+    # 预热: numba编译与噪声库的生成（或读取缓存）不计入
+    begin = time.perf_counter()
+    bank = noise_bank()
+    print(f'噪声库 {BANK_SIZE} 点，读取或生成用时 {time.perf_counter() - begin:.2f}s')
+    run(PETruth[:10], rng, 'bank', False)
+    run(PETruth[:10], rng, 'normal', False)
+
+    print(f'{args.n}个事件，平均每个事件 {PETruth.shape[0]/args.n:.0f} 个PE')
+    print(f'{"noise":>8} {"controlnoise":>12} {"ms/event":>9} {"peak MB":>8}')
+    for noisetype in ('normal', 'bank'):
+        for controlnoise in (True, False):
+            elapsed, peak = run(PETruth, rng, noisetype, controlnoise)
+            print(f'{noisetype:>8} {str(controlnoise):>12} {elapsed*1000:>9.1f} {peak/2**20:>8.1f}')
+
+    samples = bank[:BANK_SIZE].astype(np.float64)
+    print(f'噪声库: 均值 {samples.mean():+.2e}, 标准差 {samples.std():.5f}, '
+          f'KS统计量 {stats.kstest(samples[::16], "norm").statistic:.2e}')
+
+    # 一个事件中各行的偏移，同一通道的各行相加
+    events, counts = np.unique(PETruth['EventID'], return_counts=True)
+    event = events[np.argmax(counts)]
+    PEs = PETruth[PETruth['EventID'] == event]
+    noise = bank_noise(len(PEs), 1.0, rng, event)
+    same = len(PEs) - len(np.unique(noise.offsets))
+    print(f'PE最多的事件有 {len(PEs)} 行噪声，偏移相同的行 {same} 个'
+          f'（期望 {len(PEs)**2/2/BANK_SIZE:.1f}）')
+    channels, idx, multiplicity = np.unique(PEs['ChannelID'], return_inverse=True, return_counts=True)
+    summed = np.zeros((len(channels), WINDOW))
+    np.add.at(summed, idx, np.asarray(noise))
+    ratio = summed.var(axis=1).sum() / multiplicity.sum()
+    print(f'同一通道各行相加后的方差/行数: {ratio:.4f}（各行独立时为1）')
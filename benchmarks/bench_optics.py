@@ -0,0 +1,112 @@
+'''
+bench_optics.py: 折射/反射各个kernel的微基准
+
+运行: python -m benchmarks.bench_optics [-n 光线数] [-r 重复次数]
+
+对optics中的每个kernel给出每条光线的用时，并与原来经过反三角函数、
+由角度计算反射率的写法比较速度与结果的偏差
+'''
+
+import argparse
+import time
+import numpy as np
+import numexpr as ne
+from numba import njit
+from scripts import optics
+from scripts.utils import n_water, n_LS
+
+eta = n_LS / n_water
+
+
+def angle_fresnel(velocities, normals, eta):
+    '''
+    原来的写法：先求入射角与出射角，再由sin/tan求反射率
+    '''
+    vertical_of_incidence = np.maximum(np.einsum('kn, kn->n', velocities, normals), -1)
+    incidence_angles = np.arccos(-vertical_of_incidence)
+    delta = ne.evaluate('1 - eta**2 * (1 - vertical_of_incidence**2)')
+    new_velocities = ne.evaluate(
+        '(eta*velocities - (eta*vertical_of_incidence + sqrt(abs(delta))) * normals) * (delta > 0)'
+    )
+    emergence_angles = np.arccos(np.minimum(np.einsum('kn, kn->n', new_velocities, -normals), 1))
+    Rs = ne.evaluate('(sin(emergence_angles - incidence_angles)/sin(emergence_angles + incidence_angles))**2')
+    Rp = ne.evaluate('(tan(emergence_angles - incidence_angles)/tan(emergence_angles + incidence_angles))**2')
+    return (Rs+Rp)/2, new_velocities
+
+
+@njit(cache=True)
+def numba_interface(velocities, normals, eta, R, refracted):
+    '''
+    逐条光线调用interface_one与refract_one
+    '''
+    for i in range(R.shape[0]):
+        cos_i, cos_t, R[i] = optics.interface_one(
+            velocities[0, i], velocities[1, i], velocities[2, i],
+            normals[0, i], normals[1, i], normals[2, i], eta
+        )
+        refracted[0, i], refracted[1, i], refracted[2, i] = optics.refract_one(
+            velocities[0, i], velocities[1, i], velocities[2, i],
+            normals[0, i], normals[1, i], normals[2, i], cos_i, cos_t, eta
+        )
+
+
+def timeit(f, repeat):
+    '''
+    返回f()的结果与repeat次中最短的用时/s
+    '''
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = f()
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", dest="n", type=int, default=1000000, help="Number of rays")
+    parser.add_argument("-r", dest="repeat", type=int, default=5, help="Repeats")
+    args = parser.parse_args()
+
+    # 入射方向在法向量的反方向一侧均匀分布
+    rng = np.random.default_rng(0)
+    normals = rng.normal(size=(3, args.n))
+    normals /= np.linalg.norm(normals, axis=0)
+    velocities = rng.normal(size=(3, args.n))
+    velocities /= np.linalg.norm(velocities, axis=0)
+    velocities *= -np.sign(np.einsum('kn, kn->n', velocities, normals))
+
+    cos_i = optics.incidence_cosines(velocities, normals)
+    cos_t = optics.snell(cos_i, eta)
+    R = np.empty(args.n)
+    refracted = np.empty((3, args.n))
+    numba_interface(velocities[:, :10], normals[:, :10], eta, R[:10], refracted[:, :10])
+
+    kernels = {
+        'incidence_cosines': lambda: optics.incidence_cosines(velocities, normals),
+        'snell': lambda: optics.snell(cos_i, eta),
+        'fresnel': lambda: optics.fresnel(cos_i, cos_t, eta),
+        'refract': lambda: optics.refract(velocities, normals, cos_i, cos_t, eta),
+        'reflect': lambda: optics.reflect(velocities, normals, cos_i),
+        'interface+refract': lambda: (
+            optics.interface(velocities, normals, eta)[2],
+            optics.refract(velocities, normals, cos_i, cos_t, eta)
+        ),
+        'numba interface_one+refract_one': lambda: (
+            numba_interface(velocities, normals, eta, R, refracted), (R, refracted)
+        )[1],
+        'angles (original)': lambda: angle_fresnel(velocities, normals, eta),
+    }
+    results = {name: timeit(f, args.repeat) for name, f in kernels.items()}
+
+    print(f'{"kernel":>32} {"ns/ray":>8}')
+    for name, (result, elapsed) in results.items():
+        print(f'{name:>32} {elapsed/args.n*1e9:>8.1f}')
+
+    # 与原来写法的偏差，只比较能折射的光线
+    R_angle, refracted_angle = results['angles (original)'][0]
+    transmit = cos_t > 0
+    for name in ('interface+refract', 'numba interface_one+refract_one'):
+        R_cos, refracted_cos = results[name][0]
+        print(f'{name}: 反射率最大偏差 {np.nanmax(np.abs(R_cos - R_angle)[transmit]):.2g}, '
+              f'折射方向最大偏差 {np.max(np.abs(refracted_cos - refracted_angle)[:, transmit]):.2g}')
@@ -0,0 +1,110 @@
+'''
+bench_waveform.py: 比较波形的各种合成方法
+
+运行: python -m benchmarks.bench_waveform [-n 事件数] [-g geo.h5] [-s 种子]
+
+先模拟n个事件的PETruth，再对每种方法逐个事件调用genWaveform.synthesize并转为int16
+（'int'方法由saturate饱和），给出: 每个事件的用时, 合成一个事件的峰值内存(tracemalloc),
+与'dense'方法的int16波形的最大偏差与不同采样点的比例;
+再在每个通道PE数（占有率）不同的人造事件上比较'template'与'fft'，用于选取FFT_OCCUPANCY
+'''
+
+import argparse
+import time
+import tracemalloc
+import numpy as np
+import h5py as h5
+from scripts.event import generate_events
+from scripts.genPETruth import get_PE_Truth
+from scripts.genWaveform import synthesize, saturate, normal_noise, METHODS, WINDOW, FFT_OCCUPANCY
+from scripts.rng import CounterRNG
+
+
+def run(PETruth, noise, method):
+    '''
+    合成所有事件的波形，返回(int16波形, 每个事件的用时/s, 单个事件的峰值内存/B)
+    '''
+    starts = np.flatnonzero(np.diff(PETruth['EventID'], prepend=-1))
+    stops = np.append(starts[1:], PETruth.shape[0])
+    waveforms = []
+    elapsed = 0
+    peak = 0
+    tracemalloc.start()
+    for start, stop in zip(starts, stops):
+        # 只计合成一个事件时新分配的内存，不计已经保存的结果
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        begin = time.perf_counter()
+        result = synthesize(
+            PETruth['PETime'][start:stop], PETruth['ChannelID'][start:stop],
+            noise[:stop - start], method=method
+        )[1]
+        if method == 'int':
+            waveform = np.empty(result.shape, dtype='<i2')
+            saturate(result, waveform)
+        else:
+            waveform = result.astype('<i2')
+        elapsed += time.perf_counter() - begin
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - base)
+        waveforms.append(waveform)
+    tracemalloc.stop()
+    return np.concatenate(waveforms), elapsed / starts.shape[0], peak
+
+
+def sweep(occupancy, channels=64, repeat=3):
+    '''
+    channels个通道各有occupancy个PE的人造事件，返回'template'与'fft'每个PE的用时/s
+    '''
+    rng = np.random.default_rng(occupancy)
+    n = occupancy * channels
+    PETime = rng.uniform(0, 300, n)
+    ChannelID = np.repeat(np.arange(channels), occupancy)
+    noise = np.zeros((n, WINDOW))
+    best = {}
+    for method in ('template', 'fft'):
+        best[method] = np.inf
+        for _ in range(repeat):
+            begin = time.perf_counter()
+            synthesize(PETime, ChannelID, noise, method=method)
+            best[method] = min(best[method], (time.perf_counter() - begin) / n)
+    return best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", dest="n", type=int, default=20, help="Number of events")
+    parser.add_argument("-g", "--geo", dest="geo", type=str, default="geo.h5", help="Geometry file")
+    parser.add_argument("-p", "--pmt", dest="pmt_count", type=int, default=17612, help="Number of PMTs")
+    parser.add_argument("-s", "--seed", dest="seed", type=int, default=0, help="Random seed")
+    args = parser.parse_args()
+
+    with h5.File(args.geo, "r") as geo:
+        PMT_list = geo['Geometry'][:args.pmt_count]
+    rng = CounterRNG(args.seed)
+    ParticleTruth, PhotonTruth = generate_events(args.n, rng=rng)
+    PETruth = get_PE_Truth(ParticleTruth, PhotonTruth, PMT_list, rng, backend='numba')
+
+    # 与get_waveform相同，各事件共用一份噪声
+    longest = np.max(np.bincount(PETruth['EventID'] - PETruth['EventID'][0]))
+    noise = normal_noise(np.tile(np.arange(WINDOW), (longest, 1)), 10, rng)
+
+    # 预热: numba编译不计入
+    for method in METHODS:
+        synthesize(PETruth['PETime'][:10], PETruth['ChannelID'][:10], noise[:10], method=method)
+
+    results = {method: run(PETruth, noise, method) for method in METHODS}
+    dense = results['dense'][0].astype(np.int64)
+
+    print(f'{args.n}个事件，平均每个事件 {PETruth.shape[0]/args.n:.0f} 个PE')
+    print(f'{"method":>10} {"ms/event":>9} {"peak MB":>8} {"最大偏差":>6} {"不同的比例":>8}')
+    for method, (waveforms, elapsed, peak) in results.items():
+        difference = np.abs(waveforms - dense)
+        print(f'{method:>10} {elapsed*1000:>9.2f} {peak/2**20:>8.1f} {difference.max():>10} '
+              f'{np.count_nonzero(difference)/difference.size:>13.2e}')
+
+    # 按占有率扫描: 噪声的累加两者相同，'fft'每个通道的代价固定，占有率高时更快
+    print(f'每个通道的PE数扫描（FFT_OCCUPANCY = {FFT_OCCUPANCY}）')
+    print(f'{"PE/通道":>8} {"template us/PE":>15} {"fft us/PE":>10}')
+    for occupancy in (1, 16, 64, 256, 512, 1024, 2048):
+        best = sweep(occupancy)
+        print(f'{occupancy:>10} {best["template"]*1e6:>15.3f} {best["fft"]*1e6:>10.3f}')
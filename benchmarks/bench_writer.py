@@ -0,0 +1,74 @@
+'''
+bench_writer.py: 后台写入线程的合成与写入重叠
+
+运行: python -m benchmarks.bench_writer [-n 事件数] [-g geo.h5] [-s 种子] [-d 临时目录]
+                                       [--waveform template]
+
+先模拟n个事件的PETruth，对各种压缩方法与BackgroundWriter的队列长度depth，
+与get_waveform相同地逐个事件合成并写入临时文件，给出总用时、后台写入的用时、
+主线程等待写入的用时与BackgroundWriter报告的重叠比例，
+以及实际节省的时间占同步写入(depth=0)时写入用时的比例。
+单核上合成与压缩争用同一个CPU，只有等待磁盘的时间能够重叠
+'''
+
+import argparse
+import os
+import tempfile
+import time
+import h5py as h5
+from scripts.event import generate_events
+from scripts.genPETruth import get_PE_Truth
+from scripts.genWaveform import event_waveforms, common_noise, count_waveforms, open_writer, \
+    BackgroundWriter, METHODS, COMPRESSIONS
+from scripts.rng import CounterRNG
+
+
+def run(filename, PETruth, rng, method, compression, depth):
+    '''
+    合成并写入PETruth的波形，返回(总用时/s, BackgroundWriter)
+    '''
+    rows, events = count_waveforms(PETruth)
+    begin = time.perf_counter()
+    noise_0 = common_noise(PETruth, rng=rng)
+    with h5.File(filename, "w") as f:
+        writer = BackgroundWriter(open_writer(f, rows, events, compression), depth)
+        with writer:
+            for WF in event_waveforms(PETruth, noise_0, rng, method=method):
+                writer.write(WF)
+    return time.perf_counter() - begin, writer
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", dest="n", type=int, default=20, help="Number of events")
+    parser.add_argument("-g", "--geo", dest="geo", type=str, default="geo.h5", help="Geometry file")
+    parser.add_argument("-p", "--pmt", dest="pmt_count", type=int, default=17612, help="Number of PMTs")
+    parser.add_argument("-s", "--seed", dest="seed", type=int, default=0, help="Random seed")
+    parser.add_argument("-d", "--dir", dest="dir", type=str, default=None,
+                        help="Directory of the temporary files")
+    parser.add_argument("--waveform", dest="waveform", type=str, choices=METHODS,
+                        default="template", help="Waveform synthesis method")
+    args = parser.parse_args()
+
+    with h5.File(args.geo, "r") as geo:
+        PMT_list = geo['Geometry'][:args.pmt_count]
+    rng = CounterRNG(args.seed)
+    ParticleTruth, PhotonTruth = generate_events(args.n, rng=rng)
+    PETruth = get_PE_Truth(ParticleTruth, PhotonTruth, PMT_list, rng, backend='numba')
+
+    print(f'{args.n}个事件，{os.cpu_count()}个CPU，合成方法 {args.waveform}')
+    print(f'{"压缩":>6} {"depth":>5} {"总用时/s":>8} {"写入/s":>7} {"等待/s":>7} '
+          f'{"重叠":>5} {"节省/同步写入":>10}')
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        filename = os.path.join(directory, 'waveform.h5')
+        # 预热: numba编译不计入
+        run(filename, PETruth[:100], rng, args.waveform, 'none', 0)
+        for compression in COMPRESSIONS:
+            baseline = None
+            for depth in (0, 1, 2, 4):
+                elapsed, writer = run(filename, PETruth, rng, args.waveform, compression, depth)
+                if baseline is None:
+                    baseline = (elapsed, writer.stats['write'])
+                saved = (baseline[0] - elapsed) / baseline[1]
+                print(f'{compression:>8} {depth:>5} {elapsed:>10.2f} {writer.stats["write"]:>9.2f} '
+                      f'{writer.stats["stall"]:>9.2f} {writer.overlap:>7.0%} {saved:>+16.0%}')
@@ -0,0 +1,111 @@
+'''
+validate_float32.py: float32模式相对float64的精度报告
+
+运行: python -m benchmarks.validate_float32 [-n 事件数] [-g geo.h5] [-s 种子]
+                                           [--max-flip 比例] [--max-residual ps]
+
+对numpy与numba后端，用同一批光子分别以float64与float32追踪，按(EventID, PhotonID)
+逐个光子比较: 每个光子的PE数（击中率）与击中的PMT是否相同，同一PMT上PE时间的残差分布，
+以及PETime分布的KS统计量与各自的用时。
+结果改变的光子比例超过--max-flip，或残差的99%分位数超过--max-residual时判为不通过，
+返回值为1。残差的尾部来自几乎擦过PMT的光线，交点对方向极其敏感，
+float32对方向的舍入在这里会被放大到几十甚至几百ps，所以不以最大值判断
+'''
+
+import argparse
+import sys
+import time
+import numpy as np
+import h5py as h5
+from scipy import stats
+from scripts.event import generate_events
+from scripts.genPETruth import make_tracer, make_buffer, emit_photons, split_photons, \
+    MAX_BOUNCES, SURVIVAL, BATCH_SIZE
+from scripts.geometry import PMTIndex
+from scripts.rng import CounterRNG
+from scripts.utils import xyz_from_spher, Ro
+
+
+def trace(backend, dtype, index, ParticleTruth, PhotonTruth, rng):
+    '''
+    追踪PhotonTruth中的光子，返回各PE的(EventID, PhotonID, ChannelID, PETime)与用时/s
+    '''
+    transport = (MAX_BOUNCES, SURVIVAL, None, dtype)
+    pe_buffer = make_buffer(rng, transport)
+    tracer = make_tracer(backend, index, rng, pe_buffer, BATCH_SIZE, transport)
+    start = time.perf_counter()
+    tracer.run(emit_photons(ParticleTruth, split_photons(PhotonTruth, BATCH_SIZE), rng,
+                            dtype=dtype))
+    elapsed = time.perf_counter() - start
+    events, channels, times, photons = (column[:pe_buffer.size] for column in pe_buffer.columns)
+    return (events, photons, channels, times), elapsed
+
+
+def keyed(result):
+    '''
+    按(EventID, PhotonID)排序，给出每个PE的键、PMT与时间
+    '''
+    events, photons, channels, times = result
+    keys = (events.astype(np.int64) << 32) | photons
+    order = np.argsort(keys, kind='stable')
+    return keys[order], channels[order], times[order].astype(np.float64)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", dest="n", type=int, default=20, help="Number of events")
+    parser.add_argument("-g", "--geo", dest="geo", type=str, default="geo.h5", help="Geometry file")
+    parser.add_argument("-p", "--pmt", dest="pmt_count", type=int, default=17612, help="Number of PMTs")
+    parser.add_argument("-s", "--seed", dest="seed", type=int, default=0, help="Random seed")
+    parser.add_argument("--max-flip", dest="max_flip", type=float, default=1e-3,
+                        help="Maximum fraction of photons with a different outcome")
+    parser.add_argument("--max-residual", dest="max_residual", type=float, default=1.0,
+                        help="Maximum 99%% quantile of |PETime residual| in ps")
+    args = parser.parse_args()
+
+    with h5.File(args.geo, "r") as geo:
+        PMT_list = geo['Geometry'][:args.pmt_count]
+    index = PMTIndex(np.stack(xyz_from_spher(
+        Ro, PMT_list['theta']/180*np.pi, PMT_list['phi']/180*np.pi
+    )))
+    rng = CounterRNG(args.seed)
+    ParticleTruth, PhotonTruth = generate_events(args.n, rng=rng)
+    photon_count = PhotonTruth.shape[0]
+
+    passed = True
+    for backend in ('numpy', 'numba'):
+        # 预热: numba编译不计入
+        for dtype in ('<f8', '<f4'):
+            trace(backend, dtype, index, ParticleTruth[:1], PhotonTruth[:1000], rng)
+        (double, double_time), (single, single_time) = (
+            trace(backend, dtype, index, ParticleTruth, PhotonTruth, rng)
+            for dtype in ('<f8', '<f4')
+        )
+        keys_a, channels_a, times_a = keyed(double)
+        keys_b, channels_b, times_b = keyed(single)
+
+        # 逐个PE比较，轮盘赌关闭时每个光子至多一个PE
+        common, ia, ib = np.intersect1d(keys_a, keys_b, assume_unique=True, return_indices=True)
+        same = channels_a[ia] == channels_b[ib]
+        flipped = keys_a.shape[0] + keys_b.shape[0] - 2*common.shape[0] + np.count_nonzero(~same)
+        residuals = np.abs(times_b[ib] - times_a[ia])[same] * 1000
+
+        print(f'[{backend}] 光子数 {photon_count}')
+        print(f'  {"":>8} {"PE数":>8} {"击中率":>8} {"用时/s":>8}')
+        print(f'  {"float64":>8} {keys_a.shape[0]:>10} {keys_a.shape[0]/photon_count:>10.5f} '
+              f'{double_time:>10.3f}')
+        print(f'  {"float32":>8} {keys_b.shape[0]:>10} {keys_b.shape[0]/photon_count:>10.5f} '
+              f'{single_time:>10.3f}')
+        print(f'  结果改变的光子: {flipped} ({flipped/photon_count:.2e})，'
+              f'其中只在一侧击中 {flipped - np.count_nonzero(~same)}，'
+              f'击中不同的PMT {np.count_nonzero(~same)}')
+        quantiles = np.quantile(residuals, [0.5, 0.99, 0.999]) if residuals.size else np.zeros(3)
+        print(f'  PETime残差/ps: 均值 {residuals.mean():.4f}, 中位数 {quantiles[0]:.4f}, '
+              f'99% {quantiles[1]:.4f}, 99.9% {quantiles[2]:.4f}, 最大 {residuals.max():.4f}')
+        print(f'  PETime分布KS统计量: {stats.ks_2samp(times_a, times_b).statistic:.2e}')
+
+        ok = flipped / photon_count <= args.max_flip and quantiles[1] <= args.max_residual
+        print(f'  {"通过" if ok else "不通过"}')
+        passed &= ok
+
+    sys.exit(0 if passed else 1)
@@ -0,0 +1,65 @@
+'''
+validate_optics.py: 对比光学过程的numba后端与numpy后端
+
+运行: python -m benchmarks.validate_optics [-n 事件数] [-g geo.h5] [-s 种子]
+
+两个后端使用相同的随机数，逐个PE应当相同（PETime只有舍入误差）;
+另外给出统计检验: 每个事件的PE数, PETime分布的KS检验, 各PMT的PE数的卡方检验,
+以及两者的光子处理速率
+'''
+
+import argparse
+import time
+import numpy as np
+import h5py as h5
+from scipy import stats
+from scripts.event import generate_events
+from scripts.genPETruth import get_PE_Truth
+from scripts.rng import CounterRNG
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", dest="n", type=int, default=20, help="Number of events")
+    parser.add_argument("-g", "--geo", dest="geo", type=str, default="geo.h5", help="Geometry file")
+    parser.add_argument("-p", "--pmt", dest="pmt_count", type=int, default=17612, help="Number of PMTs")
+    parser.add_argument("-s", "--seed", dest="seed", type=int, default=0, help="Random seed")
+    args = parser.parse_args()
+
+    with h5.File(args.geo, "r") as geo:
+        PMT_list = geo['Geometry'][:args.pmt_count]
+    rng = CounterRNG(args.seed)
+    ParticleTruth, PhotonTruth = generate_events(args.n, rng=rng)
+
+    # 预热: numba编译不计入
+    get_PE_Truth(ParticleTruth[:1], PhotonTruth[:1000], PMT_list, rng, backend='numba')
+
+    results = {}
+    for backend in ('numpy', 'numba'):
+        start = time.perf_counter()
+        results[backend] = get_PE_Truth(ParticleTruth, PhotonTruth, PMT_list, rng, backend=backend)
+        results[backend + ' time'] = time.perf_counter() - start
+    a, b = results['numpy'], results['numba']
+
+    print(f'{"backend":>8} {"PE/event":>9} {"photons/s":>10}')
+    for backend in ('numpy', 'numba'):
+        print(f'{backend:>8} {len(results[backend])/args.n:>9.1f} '
+              f'{PhotonTruth.shape[0]/results[backend + " time"]:>10.3g}')
+
+    # 逐个PE比较
+    if len(a) == len(b):
+        same = np.mean((a['EventID'] == b['EventID']) & (a['ChannelID'] == b['ChannelID']))
+        print(f'相同的PE比例: {same:.6f}, PETime最大偏差: {np.max(np.abs(a["PETime"] - b["PETime"])):.3g} ns')
+    else:
+        print(f'PE数不同: {len(a)} vs {len(b)}')
+
+    # 统计检验
+    counts_a = np.bincount(a['EventID'], minlength=args.n)
+    counts_b = np.bincount(b['EventID'], minlength=args.n)
+    print(f'每个事件的PE数: {counts_a.mean():.1f}±{counts_a.std():.1f} vs '
+          f'{counts_b.mean():.1f}±{counts_b.std():.1f}')
+    print(f'PETime KS检验 p值: {stats.ks_2samp(a["PETime"], b["PETime"]).pvalue:.4f}')
+    channel_a = np.bincount(a['ChannelID'], minlength=args.pmt_count)
+    channel_b = np.bincount(b['ChannelID'], minlength=args.pmt_count)
+    table = np.stack((channel_a, channel_b))[:, (channel_a + channel_b) > 0]
+    print(f'各PMT的PE数卡方检验 p值: {stats.chi2_contingency(table)[1]:.4f}')
@@ -0,0 +1,49 @@
+'''
+validate_planner.py: 检查plan_memory给出的分块用满了内存预算
+
+运行: python -m benchmarks.validate_planner [-n 事件数] [--tolerance 比例]
+
+对若干预算、波形方法、噪声形式与波形进程数，检查估计的峰值不超过可用的预算
+（预算的USABLE），且没有用完事件数时，峰值与可用预算之差小于--tolerance，
+即块再加一个事件就会超出预算。最小的分块也超过预算的情形只给出警告。
+有不通过的组合时返回值为1
+'''
+
+import argparse
+import sys
+from scripts.planner import plan_memory, USABLE
+from scripts.genWaveform import METHODS
+
+BUDGETS = (512, 1024, 2048, 4096, 16384) # 预算/MB
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", dest="n", type=int, default=10**6, help="Number of events")
+    parser.add_argument("--tolerance", dest="tolerance", type=float, default=0.02,
+                        help="Largest unused fraction of the usable budget")
+    args = parser.parse_args()
+
+    print(f'{"budget MB":>9} {"method":>8} {"noise":>6} {"-w":>3} {"chunk":>8} '
+          f'{"peak MB":>8} {"used":>6} {"result":>7}')
+    failed = False
+    for budget in BUDGETS:
+        usable = budget * 2**20 * USABLE
+        for method in METHODS:
+            for noisetype in ('normal', 'bank'):
+                for workers in (1, 4):
+                    plan = plan_memory(
+                        args.n, budget * 2**20, waveform=method, waveform_workers=workers,
+                        noisetype=noisetype
+                    )
+                    used = plan.peak / usable
+                    if plan.chunk_size == 1 and used > 1:
+                        result = 'warn'
+                    elif used > 1 or (plan.chunk_size < args.n and used < 1 - args.tolerance):
+                        result = 'FAIL'
+                        failed = True
+                    else:
+                        result = 'ok'
+                    print(f'{budget:>9} {method:>8} {noisetype:>6} {workers:>3} '
+                          f'{plan.chunk_size:>8} {plan.peak/2**20:>8.0f} {used:>6.1%} {result:>7}')
+    sys.exit(1 if failed else 0)
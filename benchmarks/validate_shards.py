@@ -0,0 +1,71 @@
+'''
+validate_shards.py: 检查分批与多进程不改变光学过程的结果
+
+运行: python -m benchmarks.validate_shards [-n 事件数] [-g geo.h5] [-s 种子] [-j 进程数]
+                                          [--batch-size 光子数]
+
+随机数只由seed, EventID, PhotonID决定，但numpy的向量化函数按数组的长度与对齐
+选择不同的代码路径，分批或分段的边界改变时，同一个光子的PETime可以相差约1 ulp。
+对两个后端，以单进程、默认batch_size的结果为参照，与-j个进程、较小的batch_size
+以及先生成PhotonTruth与否（融合）的结果比较: EventID, ChannelID须完全相同，
+PETime用np.isclose比较，并给出逐位相同的比例与最大的绝对偏差
+'''
+
+import argparse
+import numpy as np
+import h5py as h5
+from scripts.event import generate_events
+from scripts.genPETruth import get_PE_Truth, BATCH_SIZE
+from scripts.rng import CounterRNG
+
+
+def compare(name, PETruth, reference):
+    '''
+    比较两个PETruth表，返回是否在误差范围内相同
+    '''
+    if len(PETruth) != len(reference):
+        print(f'{name:>24}: PE数 {len(PETruth)} != {len(reference)}')
+        return False
+    same = all(
+        np.array_equal(PETruth[field], reference[field]) for field in ('EventID', 'ChannelID')
+    )
+    close = np.isclose(PETruth['PETime'], reference['PETime'], rtol=1e-12, atol=0)
+    exact = PETruth['PETime'] == reference['PETime']
+    deviation = np.abs(PETruth['PETime'] - reference['PETime']).max(initial=0)
+    print(f'{name:>24}: EventID, ChannelID {"相同" if same else "不同"}，'
+          f'PETime isclose {close.mean():.2%}，逐位相同 {exact.mean():.4%}，'
+          f'最大偏差 {deviation:.2e} ns')
+    return same and close.all()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", dest="n", type=int, default=10, help="Number of events")
+    parser.add_argument("-g", "--geo", dest="geo", type=str, default="geo.h5", help="Geometry file")
+    parser.add_argument("-p", "--pmt", dest="pmt_count", type=int, default=17612, help="Number of PMTs")
+    parser.add_argument("-s", "--seed", dest="seed", type=int, default=7, help="Random seed")
+    parser.add_argument("-j", dest="workers", type=int, default=2, help="Number of processes")
+    parser.add_argument("--batch-size", dest="batch_size", type=int, default=5000,
+                        help="Smaller batch size to compare with")
+    args = parser.parse_args()
+
+    with h5.File(args.geo, "r") as geo:
+        PMT_list = geo['Geometry'][:args.pmt_count]
+    rng = CounterRNG(args.seed)
+    ParticleTruth, PhotonTruth = generate_events(args.n, rng=rng)
+
+    passed = True
+    for backend in ('numpy', 'numba'):
+        print(f'后端 {backend}，{args.n}个事件，参照为单进程、batch_size={BATCH_SIZE}')
+        reference = get_PE_Truth(ParticleTruth, PhotonTruth, PMT_list, rng, backend=backend)
+        # 名称: (PhotonTruth, get_PE_Truth的其他参数)，PhotonTruth为None时融合
+        variants = {
+            f'-j {args.workers}': (PhotonTruth, dict(workers=args.workers)),
+            f'batch_size={args.batch_size}': (PhotonTruth, dict(batch_size=args.batch_size)),
+            'fused': (None, {}),
+            f'fused -j {args.workers}': (None, dict(workers=args.workers)),
+        }
+        for name, (photons, kwargs) in variants.items():
+            PETruth = get_PE_Truth(ParticleTruth, photons, PMT_list, rng, backend=backend, **kwargs)
+            passed &= compare(name, PETruth, reference)
+    assert passed, 'sharded or batched optics differ from the single-process run'
@@ -0,0 +1,86 @@
+'''
+validate_table.py: 对比探针表后端与光线追踪后端
+
+运行: python -m benchmarks.validate_table [-n 事件数] [-g geo.h5] [-s 种子] [-P 探针表精度]
+
+探针表后端只在统计上正确，与追踪（numba后端）比较:
+每个事件的PE数（按顶点半径分段），PETime分布的KS检验与均值，
+各PMT的PE数的卡方检验与相关系数，以及各后端每个事件的用时
+'''
+
+import argparse
+import time
+import numpy as np
+import h5py as h5
+from scipy import stats
+from scripts.event import generate_events
+from scripts.genPETruth import get_PE_Truth, PEBuffer
+from scripts.probe import ProbeTable, sample_PE, TABLE_PRECISION
+from scripts.rng import CounterRNG
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", dest="n", type=int, default=20, help="Number of events")
+    parser.add_argument("-g", "--geo", dest="geo", type=str, default="geo.h5", help="Geometry file")
+    parser.add_argument("-p", "--pmt", dest="pmt_count", type=int, default=17612, help="Number of PMTs")
+    parser.add_argument("-s", "--seed", dest="seed", type=int, default=0, help="Random seed")
+    parser.add_argument("-P", "--precision", dest="precision", type=int,
+                        default=TABLE_PRECISION, help="Probe table precision")
+    args = parser.parse_args()
+
+    with h5.File(args.geo, "r") as geo:
+        PMT_list = geo['Geometry'][:args.pmt_count]
+    rng = CounterRNG(args.seed)
+    ParticleTruth, PhotonTruth = generate_events(args.n, rng=rng)
+    table = ProbeTable(args.precision)
+
+    # 预热: numba编译不计入
+    get_PE_Truth(ParticleTruth[:1], PhotonTruth[:1000], PMT_list, rng, backend='numba')
+    sample_PE(ParticleTruth[:1], PMT_list, rng, PEBuffer(), table)
+
+    results = {}
+    for backend in ('numpy', 'numba', 'table'):
+        start = time.perf_counter()
+        if backend == 'table':
+            pe_buffer = PEBuffer()
+            sample_PE(ParticleTruth, PMT_list, rng, pe_buffer, table)
+            results[backend] = pe_buffer.to_structured()
+        else:
+            results[backend] = get_PE_Truth(
+                ParticleTruth, PhotonTruth, PMT_list, rng, backend=backend
+            )
+        results[backend + ' time'] = time.perf_counter() - start
+    traced, sampled = results['numba'], results['table']
+
+    print(f'{"backend":>8} {"PE/event":>9} {"s/event":>9} {"加速比":>6}')
+    for backend in ('numpy', 'numba', 'table'):
+        elapsed = results[backend + ' time']
+        print(f'{backend:>8} {len(results[backend])/args.n:>9.1f} {elapsed/args.n:>9.3g} '
+              f'{elapsed/results["table time"]:>8.1f}')
+
+    # 每个事件的PE数，按顶点半径分段
+    event_ids = ParticleTruth['EventID']
+    counts_a = np.bincount(traced['EventID'] - event_ids[0], minlength=args.n)
+    counts_b = np.bincount(sampled['EventID'] - event_ids[0], minlength=args.n)
+    r = np.sqrt(ParticleTruth['x']**2 + ParticleTruth['y']**2 + ParticleTruth['z']**2) / 1000
+    print(f'{"r/m":>11} {"事件数":>5} {"追踪PE数":>9} {"探针表PE数":>9} {"比值":>6}')
+    edges = np.array([0, 8, 12, 14, 16, 17, 18])
+    for low, high in zip(edges[:-1], edges[1:]):
+        selected = (r >= low) & (r < high)
+        if selected.any():
+            a, b = counts_a[selected].mean(), counts_b[selected].mean()
+            print(f'{low:>4.0f}-{high:<6.0f} {selected.sum():>7} {a:>11.1f} {b:>11.1f} {b/a:>7.3f}')
+
+    # PETime分布
+    print(f'PETime 均值: {traced["PETime"].mean():.2f} vs {sampled["PETime"].mean():.2f} ns, '
+          f'中位数: {np.median(traced["PETime"]):.2f} vs {np.median(sampled["PETime"]):.2f} ns')
+    print(f'PETime KS统计量: {stats.ks_2samp(traced["PETime"], sampled["PETime"]).statistic:.4f}')
+
+    # 各PMT的PE数
+    channel_a = np.bincount(traced['ChannelID'], minlength=args.pmt_count)
+    channel_b = np.bincount(sampled['ChannelID'], minlength=args.pmt_count)
+    hit = (channel_a + channel_b) > 0
+    contingency = np.stack((channel_a, channel_b))[:, hit]
+    print(f'各PMT的PE数卡方检验 p值: {stats.chi2_contingency(contingency)[1]:.4f}, '
+          f'相关系数: {np.corrcoef(channel_a, channel_b)[0, 1]:.4f}')
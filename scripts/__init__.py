@@ -1 +1 @@
-__all__ = ['drawProbe', 'event', 'genPETruth', 'genWaveform', 'getProbTime', 'utils']
\ No newline at end of file
+__all__ = ['drawProbe', 'event', 'genPETruth', 'genWaveform', 'geometry', 'getProbTime', 'optics', 'planner', 'probe', 'readWaveform', 'rng', 'tracking', 'utils']
\ No newline at end of file
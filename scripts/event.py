@@ -1,16 +1,16 @@
 '''
 event.py: 顶点与光子模拟
 
-主要接口：generate_events
+主要接口：generate_events, generate_events_bychunk, generate_photons
 生成球内均匀分布的顶点位置坐标，使用非齐次泊松分布采样光子时间
 '''
 
-import multiprocessing
 import numpy as np
-from scipy.integrate import quad
+from scipy.special import erfcx
 from tqdm import tqdm
 from numba import njit
 from . import utils
+from .rng import CounterRNG, STREAM_VERTEX, STREAM_PHOTON_COUNT, STREAM_PHOTON_TIME
 
 LS_RADIUS = utils.Ri # 液闪的半径，单位m
 SIGMA = 5 # 正态分布的标准差
@@ -18,21 +18,159 @@ TAU = 20 # 指数衰减函数e^(-t/tau)中的tau
 NORM_FACTOR = 69.1504473757916# 期望的归一化系数
 T_MAX = 500 # 只考虑500ns以内产生的光子
 PRECISION = 1000 # expectation取样时的间隔为其倒数
+BATCH_CANDIDATES = 1 << 22 # 每批最多的候选光子数，控制内存
+
+PARTICLE_DTYPE = [
+    ('EventID', '<i4'),
+    ('x', '<f8'),
+    ('y', '<f8'),
+    ('z', '<f8'),
+    ('p', '<f8')
+]
+PHOTON_DTYPE = [
+    ('EventID', '<i4'),
+    ('PhotonID', '<i4'),
+    ('GenTime', '<f8')
+]
 
 def expectation(t):
     '''
     README中的lambda(t)，非齐次泊松过程的期望
-    输入：时间t
+    卷积积分有erfc形式的解析解，记u = t/TAU，
+    lambda(t) = NORM_FACTOR * SIGMA * sqrt(pi/2) * exp(-u^2/(2 SIGMA^2))
+                * erfcx((SIGMA^2 - u) / (sqrt(2) SIGMA))
+    用erfcx代替exp*erfc以避免溢出
+    输入：时间t，可以是数组
     输出：期望值
     '''
-    return (quad(lambda s: np.exp(-s-(t/TAU-s)**2/2/SIGMA/SIGMA),
-                 0, np.inf)[0]
-            * NORM_FACTOR)
+    u = np.asarray(t) / TAU
+    return (NORM_FACTOR * SIGMA * np.sqrt(np.pi/2)
+            * np.exp(-u**2/2/SIGMA/SIGMA)
+            * erfcx((SIGMA*SIGMA - u) / (np.sqrt(2)*SIGMA)))
+
+# 进程内的expectation表，避免同一进程重复读盘
+_expect_lists = {}
+
+def get_expect_list():
+    '''
+    给出0到T_MAX、间隔为1/PRECISION的expectation取样表
+    表按(SIGMA, TAU, T_MAX, PRECISION, NORM_FACTOR)缓存在磁盘上，
+    重复运行时直接读取
+    '''
+    key = (SIGMA, TAU, T_MAX, PRECISION, NORM_FACTOR)
+    if key in _expect_lists:
+        return _expect_lists[key]
+    path = utils.cache_path('expectation', *key)
+    expect_list = utils.load_cache(path)
+    if expect_list is None:
+        expect_list = expectation(np.arange(0, T_MAX*PRECISION + 1) / PRECISION)
+        utils.save_cache(path, expect_list)
+    _expect_lists[key] = expect_list
+    return expect_list
+
+@njit(cache=True)
+def linear_intp(t, expect_list, PRECISION):
+    '''
+    expectation表的线性插值
+    '''
+    floor = np.minimum(np.floor(t*PRECISION).astype(np.int64), expect_list.shape[0] - 2)
+    return (((t*PRECISION) - floor) * expect_list[floor+1] +
+            (-(t*PRECISION) + floor + 1) * expect_list[floor])
+
+def get_cdf_list():
+    '''
+    expectation表的累积积分（梯形公式），cdf_list[-1]即一个事件的期望光子数
+    '''
+    expect_list = get_expect_list()
+    return np.concatenate((
+        [0.], np.cumsum((expect_list[1:] + expect_list[:-1]) / 2 / PRECISION)
+    ))
+
+@njit(cache=True)
+def sorted_from_gaps(gaps, photon_counts):
+    '''
+    逐事件累加gap并归一化，得到每个事件内排好序的[0, 1)均匀分布
+    每个事件单独从0开始累加，结果与事件在批中的位置无关
+    '''
+    out = np.empty(gaps.shape[0] - photon_counts.shape[0])
+    start = 0
+    for i in range(photon_counts.shape[0]):
+        n = photon_counts[i]
+        gap_start = start + i
+        total = 0.
+        for j in range(n + 1):
+            total += gaps[gap_start + j]
+        partial = 0.
+        for j in range(n):
+            partial += gaps[gap_start + j]
+            out[start + j] = partial / total
+        start += n
+    return out
+
+def sorted_uniforms(photon_counts, event_ids, rng):
+    '''
+    对一批事件同时生成每个事件内排好序的[0, 1)均匀分布
+    输入：photon_counts，每个事件的个数；event_ids，这批事件的EventID；
+          rng，CounterRNG
+    输出：每个数所属事件在这批中的序号，每个数在事件内的序号，以及均匀分布的值
+    方法：n个排好序的均匀分布等价于n+1个指数分布累加后归一化，
+          一次给出所有事件的结果，无需排序
+    '''
+    event_count = photon_counts.shape[0]
+    gap_events = np.repeat(np.arange(event_count), photon_counts + 1)
+    gap_starts = np.cumsum(photon_counts + 1) - (photon_counts + 1)
+    gap_indexs = np.arange(gap_events.shape[0]) - gap_starts[gap_events]
+    gaps = rng.exponential(STREAM_PHOTON_TIME, event_ids[gap_events], gap_indexs)
 
-def generate_events(number_of_events):
+    events = np.repeat(np.arange(event_count), photon_counts)
+    indexs = np.arange(events.shape[0]) - (np.cumsum(photon_counts) - photon_counts)[events]
+    return events, indexs, sorted_from_gaps(gaps, photon_counts)
+
+def thin_photons(photon_counts, event_ids, expect_list, max_expect, rng):
+    '''
+    对一批事件同时做thinning
+    输入：photon_counts，每个事件lambda*齐次泊松过程的候选光子数；
+          event_ids，这批事件的EventID；rng，CounterRNG
+    输出：保留光子所属事件在这批中的序号，以及GenTime，
+          按事件、GenTime排好序
+    每个候选光子各自抽一个均匀数决定去留
+    '''
+    candidate_events, candidate_indexs, u = sorted_uniforms(photon_counts, event_ids, rng)
+    gen_times = u * T_MAX
+    keep = rng.random(
+        STREAM_PHOTON_TIME, event_ids[candidate_events], candidate_indexs, 1
+    ) * max_expect < linear_intp(
+        gen_times, expect_list, PRECISION
+    )
+    return candidate_events[keep], gen_times[keep]
+
+def inverse_photons(photon_counts, event_ids, cdf_list, rng, out=None):
+    '''
+    对一批事件同时用逆CDF法生成GenTime
+    输入：photon_counts，每个事件的光子数，服从Poisson(cdf_list[-1])；
+          event_ids，这批事件的EventID；rng，CounterRNG；
+          out，写入GenTime的数组（例如预分配的PhotonTruth表中这批的GenTime列），
+          为None时新建
+    输出：光子所属事件在这批中的序号，以及GenTime（out不为None时即out），
+          按事件、GenTime排好序
+    排好序的均匀分布经过单调的逆CDF后仍然有序
+    '''
+    events, _, u = sorted_uniforms(photon_counts, event_ids, rng)
+    u *= cdf_list[-1]
+    if out is None:
+        out = np.empty(u.shape[0])
+    out[...] = np.interp(u, cdf_list, np.arange(cdf_list.shape[0]) / PRECISION)
+    return events, out
+
+def generate_events(number_of_events, method='inverse', rng=None, first_event=0,
+                    photons=True):
     '''
     描述：生成事例
     输入：number_of_events: event数量
+          method: GenTime的采样方法，'inverse'逆CDF法，'thinning'齐次泊松+筛选
+          rng: CounterRNG，默认随机取种子
+          first_event: 第一个event的编号，用于只模拟某一段事件
+          photons: 为False时只生成顶点，PhotonTruth为None
     输出：ParticleTruth，PhotonTruth两个结构化数组
           ParticleTruth形状为(number_of_events, 5)，具有字段：
             EventID: 事件编号        '<i4'
@@ -44,49 +182,99 @@ def generate_events(number_of_events):
             EventID:  事件编号                       '<i4'
             PhotonID: 光子编号（每个事件单独编号）   '<i4'
             GenTime:  从顶点产生到光子产生的时间/ns  '<f8'
+    算法见generate_chunk
+    '''
+    print("正在生成event与光子...")
+    if rng is None:
+        rng = CounterRNG()
+    if not photons:
+        ParticleTruth = generate_vertices(first_event, number_of_events, rng)
+        print("ParticleTruth表生成完成！")
+        return ParticleTruth, None
+    ParticleTruth, PhotonTruth = generate_chunk(
+        first_event, number_of_events, method, rng, progress=True
+    )
+    print("ParticleTruth, PhotonTruth表生成完成！")
+    return ParticleTruth, PhotonTruth
+
+def generate_events_bychunk(number_of_events, chunk_size, method='inverse',
+                            rng=None, first_event=0, photons=True):
+    '''
+    描述：分块生成事例，内存只与chunk_size有关
+    输入：number_of_events: event总数
+          chunk_size: 每块的event数
+          method: GenTime的采样方法，同generate_events
+          rng: CounterRNG，默认随机取种子
+          first_event: 第一个event的编号，用于只模拟某一段事件
+          photons: 为False时只生成顶点，PhotonTruth为None，
+                   光子留给光学过程边生成边模拟
+    输出：生成器，依次给出每块的(ParticleTruth, PhotonTruth)，
+          格式同generate_events，EventID在各块之间连续编号
+    随机数只由seed与EventID决定，分块方式不影响结果
+    '''
+    if rng is None:
+        rng = CounterRNG()
+    last_event = first_event + number_of_events
+    for chunk_first in range(first_event, last_event, chunk_size):
+        if not photons:
+            yield generate_vertices(
+                chunk_first, min(chunk_size, last_event - chunk_first), rng
+            ), None
+            continue
+        yield generate_chunk(
+            chunk_first,
+            min(chunk_size, last_event - chunk_first),
+            method,
+            rng
+        )
+
+def generate_chunk(first_event, number_of_events, method, rng, progress=False):
+    '''
+    描述：生成EventID从first_event开始的number_of_events个事例
+    输入：first_event: 第一个event的编号
+          number_of_events: event数量
+          method: GenTime的采样方法，'inverse'逆CDF法，'thinning'齐次泊松+筛选
+          rng: CounterRNG，随机数只由seed与EventID决定
+          progress: 是否显示进度条
+    输出：ParticleTruth，PhotonTruth两个结构化数组，格式同generate_events
     算法描述：
-    1. 生成顶点坐标(x, y, z)
-       方法：生成球坐标，r用一个与r^2成正比的采样函数
-                         theta和phi均匀分布
-             转为xyz
-    2. 生成光子数目与GenTime
-       方法：先算出卷积后的lambda(t), 得到其最大值lambda*
-             定义截止时间，将截止时间内产生的光子作为总共的光子
-             用lambda*的齐次泊松分布模拟截止时间内的光子事件
-             筛选事件，有lambda(t)/lambda*的可能性事件留下
+    1. 生成顶点坐标(x, y, z)，见generate_vertices
+    2. 生成光子数目与GenTime，见generate_photons
     3. 转化为输出格式输出
     '''
-
-    # 初始化expectation
-    print("初始化expectation...")
-    step = 1/PRECISION
-    expect_list = np.zeros(int(T_MAX/step) + 1)
-    with multiprocessing.Pool(8) as p:
-        expect_list = np.array(
-            list(tqdm(
-                p.imap(
-                    expectation,
-                    np.arange(0, T_MAX+step, step)
-                ),
-                total=expect_list.shape[0]
-            ))
+    Particle_Truth = generate_vertices(first_event, number_of_events, rng)
+    photon_counts = get_photon_counts(Particle_Truth['EventID'], method, rng)
+    if method == 'inverse':
+        # 光子数事先已知，每批直接在预分配的表中生成，不经过临时的表
+        Photon_Truth = np.empty(photon_counts.sum(), dtype=PHOTON_DTYPE)
+        batches = generate_photons(
+            Particle_Truth, method, rng, progress=progress, photon_counts=photon_counts,
+            out=Photon_Truth
         )
-    max_expect = max(expect_list)
-    # 线性插值
-    @njit
-    def linear_intp(t, expect_list, PRECISION):
-        floor = np.floor(t*PRECISION).astype(np.int64)
-        return (((t*PRECISION) - floor) * expect_list[floor] +
-                (-(t*PRECISION) + floor + 1) * expect_list[floor+1])
-
-    # 初始化rng
-    rng = np.random.default_rng()
-
-    print("正在生成event位置...")
-    # 生成event的球坐标位置
-    event_r = rng.power(3, size=number_of_events) * LS_RADIUS
-    event_theta = np.pi/2 + rng.choice([-1, 1], size=number_of_events)*(np.pi/2 - np.arcsin(rng.random(size=number_of_events)))
-    event_phi = rng.random(size=number_of_events) * np.pi * 2
+        for _ in batches:
+            pass
+    else:
+        batches = generate_photons(
+            Particle_Truth, method, rng, progress=progress, photon_counts=photon_counts
+        )
+        Photon_Truth = np.concatenate([np.empty(0, dtype=PHOTON_DTYPE)] + list(batches))
+
+    return Particle_Truth, Photon_Truth
+
+def generate_vertices(first_event, number_of_events, rng):
+    '''
+    描述：生成EventID从first_event开始的number_of_events个事例的ParticleTruth
+    方法：生成球坐标，r用一个与r^2成正比的采样函数
+                      theta和phi均匀分布
+          转为xyz
+    '''
+    event_ids = np.arange(first_event, first_event + number_of_events)
+
+    # 生成event的球坐标位置，r服从power(3)分布
+    event_random = rng.random(STREAM_VERTEX, event_ids, 0, np.arange(4).reshape(-1, 1))
+    event_r = np.cbrt(event_random[0]) * LS_RADIUS
+    event_theta = np.pi/2 + np.where(event_random[1] < 0.5, -1, 1)*(np.pi/2 - np.arcsin(event_random[2]))
+    event_phi = event_random[3] * np.pi * 2
 
     # 转为直角坐标
     # event_coordinates形状为(number_of_events, 3)
@@ -96,53 +284,91 @@ def generate_events(number_of_events):
         ).transpose()
 
     # 生成ParticleTruth
-    par_tr_dtype = [
-        ('EventID', '<i4'),
-        ('x', '<f8'),
-        ('y', '<f8'),
-        ('z', '<f8'),
-        ('p', '<f8')
-    ]
-    Particle_Truth = np.zeros(number_of_events, dtype=par_tr_dtype)
-    Particle_Truth['EventID'] = np.arange(number_of_events)
+    Particle_Truth = np.zeros(number_of_events, dtype=PARTICLE_DTYPE)
+    Particle_Truth['EventID'] = event_ids
     Particle_Truth['x'] = event_coordinates[:, 0]*1000
     Particle_Truth['y'] = event_coordinates[:, 1]*1000
     Particle_Truth['z'] = event_coordinates[:, 2]*1000
     Particle_Truth['p'] = np.ones(number_of_events)
-    print("ParticleTruth表生成完成！")
+    return Particle_Truth
 
-    # 生成光子，先用齐次泊松分布，再用expectation来thin
-    print("生成光子中...")
-    photon_counts = np.round(
-        rng.poisson(max_expect*T_MAX, number_of_events)
-        ).astype(int)
+def get_photon_counts(event_ids, method, rng):
+    '''
+    每个事件的光子数，thinning时为筛选前的候选光子数
+    '''
+    if method == 'thinning':
+        # 先用齐次泊松分布，再用expectation来thin
+        return rng.poisson(get_expect_list().max()*T_MAX, STREAM_PHOTON_COUNT, event_ids)
+    elif method == 'inverse':
+        return rng.poisson(get_cdf_list()[-1], STREAM_PHOTON_COUNT, event_ids)
+    raise ValueError(f'Unknown sampling method {method}')
 
-    event_ids = np.zeros(sum(photon_counts)) #这是可能的最大shape
-    photon_ids = np.zeros(sum(photon_counts))
-    gen_times = np.zeros(sum(photon_counts))
-    start = 0
+def generate_photons(ParticleTruth, method='inverse', rng=None,
+                     batch_size=BATCH_CANDIDATES, progress=False, photon_counts=None,
+                     out=None):
+    '''
+    描述：生成器，按事件分批给出ParticleTruth中各事件的PhotonTruth
+    输入：ParticleTruth: 由generate_vertices给出
+          method: GenTime的采样方法，同generate_chunk
+          rng: CounterRNG
+          batch_size: 每批最多的候选光子数（单个事件超过时一个事件一批）
+          progress: 是否显示进度条
+          photon_counts: 各事件的（候选）光子数，须由get_photon_counts以相同的method与rng给出，
+                         为None时在此计算；调用者已算出时传入以免重复计算
+          out: 只用于inverse方法，长度为光子总数的PhotonTruth表，
+               每批直接写入其中的一段，给出的表即这一段的视图
+    输出：每批一个PhotonTruth表，格式同generate_events，每个事件的光子都在同一批中
+    方法：inverse方法：光子数服从Poisson(∫lambda)，
+                       GenTime由lambda的累积积分表插值求逆直接采样
+          thinning方法：先算出卷积后的lambda(t), 得到其最大值lambda*
+                定义截止时间，将截止时间内产生的光子作为总共的光子
+                用lambda*的齐次泊松分布模拟截止时间内的光子事件
+                筛选事件，每个光子有lambda(t)/lambda*的可能性留下
+          所有事件按候选光子数分批，每批整体向量化处理，
+          随机数只由seed与EventID决定，分批方式不影响结果
+    '''
+    if rng is None:
+        rng = CounterRNG()
+    event_ids = ParticleTruth['EventID']
+    if photon_counts is None:
+        photon_counts = get_photon_counts(event_ids, method, rng)
+    if method == 'thinning':
+        expect_list = get_expect_list()
+        max_expect = expect_list.max()
+    else:
+        cdf_list = get_cdf_list()
 
-    for event_id, photon_count in enumerate(tqdm(photon_counts)):
-        gen_time = np.sort(rng.random(photon_count) * T_MAX)
-        gen_time = gen_time[
-            rng.random() < linear_intp(gen_time, expect_list, PRECISION)/max_expect
-        ]
-        real_photon_count = gen_time.shape[0]
-        event_ids[start:(start + real_photon_count)] = event_id
-        photon_ids[start:(start + real_photon_count)] = np.arange(real_photon_count)
-        gen_times[start:(start + real_photon_count)] = gen_time
-        start = start + real_photon_count
-
-    # 生成PhotonTruth
-    pho_tr_dtype = [
-        ('EventID', '<i4'),
-        ('PhotonID', '<i4'),
-        ('GenTime', '<f8')
-    ]
-    Photon_Truth = np.zeros(start, dtype=pho_tr_dtype)
-    Photon_Truth['EventID'] = event_ids[:start]
-    Photon_Truth['PhotonID'] = photon_ids[:start]
-    Photon_Truth['GenTime'] = gen_times[:start]
-    print("PhotonTruth表生成完成！")
+    # 按候选光子数把事件分批，每批一次向量化处理
+    batch_ends = np.searchsorted(
+        np.cumsum(photon_counts),
+        np.arange(batch_size, photon_counts.sum(), batch_size)
+    ) + 1
+    batch_bounds = np.unique(np.concatenate(([0], batch_ends, [event_ids.shape[0]])))
 
-    return Particle_Truth, Photon_Truth
+    batch_begins = tqdm(batch_bounds[:-1]) if progress else batch_bounds[:-1]
+    position = 0
+    for begin, end in zip(batch_begins, batch_bounds[1:]):
+        if method == 'thinning':
+            events, times = thin_photons(
+                photon_counts[begin:end], event_ids[begin:end], expect_list, max_expect, rng
+            )
+            table = np.empty(events.shape[0], dtype=PHOTON_DTYPE)
+            table['GenTime'] = times
+        else:
+            # inverse方法的光子数即photon_counts，GenTime直接写入这批的表
+            count = photon_counts[begin:end].sum()
+            if out is None:
+                table = np.empty(count, dtype=PHOTON_DTYPE)
+            else:
+                table = out[position:position + count]
+            position += count
+            events, _ = inverse_photons(
+                photon_counts[begin:end], event_ids[begin:end], cdf_list, rng, table['GenTime']
+            )
+
+        # PhotonID由每个事件在这批光子中的起始位置相减得到
+        kept_counts = np.bincount(events, minlength=end - begin)
+        offsets = np.cumsum(kept_counts) - kept_counts
+        table['EventID'] = event_ids[begin:end][events]
+        table['PhotonID'] = np.arange(events.shape[0]) - offsets[events]
+        yield table
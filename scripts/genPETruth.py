@@ -2,379 +2,759 @@
 genPETruth.py: 光学过程，模拟光子打到的PMT与传播时间
 
 主要接口：get_PE_Truth
+光子输运由Tracer迭代完成：光子按下一次相互作用的类型放在不同的队列中，
+每次取出一批统一处理，产生的新光子放回队列，击中PMT的光子写入PEBuffer
+加权模式下只追踪一部分光子，在界面上按反射率分支，由WeightedPEBuffer按权重重抽样得到PE
 '''
 
+import atexit
+import hashlib
 import numpy as np
 from tqdm import tqdm
-import numexpr as ne
-from scipy.spatial import KDTree
-from .utils import xyz_from_spher, n_water, n_LS, n_glass, Ri, Ro, r_PMT
+from numba import njit
+from .utils import xyz_from_spher, share_array, attach_array, shard_bounds, cached_pool, \
+    close_pool, attach_inputs, single_thread, n_water, n_LS, n_glass, Ri, Ro, r_PMT
+from .geometry import PMTIndex
+from .optics import interface, refract, reflect
+from .tracking import NumbaTracer
+from .event import generate_photons
+from .probe import sample_PE
+from .rng import CounterRNG, STREAM_DIRECTION, STREAM_OPTICS, STREAM_ROULETTE, \
+    STREAM_SPLIT, STREAM_RESAMPLE
 
 c = 0.3 # 这里的单位制需要是m/ns
 eta = n_LS / n_water
 
-# 声明全局变量，值是随便取的
-PETruth = {}
-PETruth['EventID'] = []
-PETruth['ChannelID'] = []
-PETruth['PETime'] = []
-PMTs = np.array([[1, 2], [1, 2], [1, 2]])
-kdtree = KDTree(PMTs)
-
-def get_PE_Truth(ParticleTruth, PhotonTruth, PMT_list):
+BATCH_SIZE = 1 << 18 # 每批处理的光子数，决定光学过程的峰值内存
+MAX_BOUNCES = 4 # 每个光子默认最多的反射次数
+SURVIVAL = 1.0 # 轮盘赌默认的存活概率，1为不进行轮盘赌
+MIN_WEIGHT = 0.1 # 加权模式中继续追踪的分支的最小权重，更轻的分支进行轮盘赌
+# 加权模式中分支编号为uint64，从1开始，每经过一个界面追加一位，最多追加63位。
+# 每次反射之间至多经过3个界面，路径上的界面数不超过4*(max_bounces+1)
+MAX_WEIGHTED_BOUNCES = 63 // 4 - 1
+DTYPES = ('<f8', '<f4') # 光子状态与PETime可选的浮点类型
+
+# 相互作用类型，按处理的优先级从高到低排列
+# 先处理走得最远的光子，使各队列的长度保持在一批左右
+GO_INSIDE = 0 # 从PMT反射，射向液闪球
+HIT_PMT_AGAIN = 1 # 从PMT反射，继续在水中行进
+HIT_PMT = 2 # 从液闪折射出来，射向PMT
+TRANSIST = 3 # 在液闪内，射向液闪边界
+KINDS = (GO_INSIDE, HIT_PMT_AGAIN, HIT_PMT, TRANSIST)
+
+# 光学过程的实现: 'numpy' 分批的数组运算, 'numba' 逐光子并行追踪,
+# 'table' 不追踪光子，由探针表直接抽取每个PMT的PE（只在统计上正确）
+BACKENDS = ('numpy', 'numba', 'table')
+
+
+def get_PE_Truth(ParticleTruth, PhotonTruth, PMT_list, rng=None, batch_size=BATCH_SIZE,
+                 backend='numpy', workers=1, sampler='inverse', photon_sink=None,
+                 max_bounces=MAX_BOUNCES, survival=SURVIVAL, weight=None, dtype='<f8'):
     '''
     从ParticleTruth和PhotonTruth, 结合PMT几何信息，给出PETruth
-    一次并行计算event_num // 10 个event
+    一次处理batch_size个光子
+    rng为CounterRNG，每个光子的随机数只由seed, EventID, PhotonID决定
+    backend为BACKENDS之一，两者的物理过程与随机数相同
+    workers大于1时把事件分给多个进程，EventID与ChannelID与单进程相同，
+    PETime在舍入误差内相同: 分批的边界改变时numpy可能走不同的向量化路径，相差约1 ulp，
+    见benchmarks.validate_shards
+
+    PhotonTruth为None时，光子在光学过程中按事件分批用sampler方法生成，用完即弃，
+    不保存整个PhotonTruth表，结果在舍入误差内与先生成PhotonTruth相同;
+    此时photon_sink不为None则每批PhotonTruth都交给photon_sink（例如写入文件），
+    只能在单进程时使用
+
+    max_bounces与survival为每个光子最多的反射次数与轮盘赌的存活概率，见Tracer
+    weight不为None时为加权模式：平均每weight个光子追踪一个，界面上反射与折射两支都追踪，
+    最后按权重重抽样得到PE，PE数与各PMT的PE数的期望与逐光子模拟相同，不使用survival，
+    此时max_bounces不超过MAX_WEIGHTED_BOUNCES，否则分支编号溢出
+    dtype为DTYPES之一，光子的位置、方向、时间以及PETime的浮点类型，
+    '<f4'时内存与带宽减半，精度见benchmarks.validate_float32
+
+    backend为'table'时不需要PhotonTruth，由probe.sample_PE对每个事件一次抽取所有PMT的PE
     '''
     print("正在模拟光子打到哪个PMT，以及传播时间...")
-    # 初始化全局变量，我担心跑两遍会出奇怪的问题
-    global PETruth, PMTs, kdtree
-    PETruth = {}
-    PETruth['EventID'] = []
-    PETruth['ChannelID'] = []
-    PETruth['PETime'] = []
-
-    rng = np.random.default_rng()
+    if rng is None:
+        rng = CounterRNG()
+    if backend not in BACKENDS:
+        raise ValueError(f'Unknown optics backend {backend}')
+    if dtype not in DTYPES:
+        raise ValueError(f'Unsupported float type {dtype}')
+    if photon_sink is not None and (PhotonTruth is not None or workers > 1):
+        raise ValueError('photon_sink requires the fused mode in a single process')
+    if weight is not None and max_bounces > MAX_WEIGHTED_BOUNCES:
+        raise ValueError(f'The weighted mode allows at most {MAX_WEIGHTED_BOUNCES} bounces')
+
+    if backend == 'table':
+        if weight is not None:
+            raise ValueError('The weighted mode requires photon tracing')
+        pe_buffer = PEBuffer(time_dtype=dtype)
+        sample_PE(ParticleTruth, PMT_list, rng, pe_buffer)
+        print("PETruth表生成完成！")
+        return pe_buffer.to_structured()
 
-    event_num = ParticleTruth.shape[0]
     PMT_x, PMT_y, PMT_z = xyz_from_spher(
         Ro, PMT_list['theta']/180*np.pi, PMT_list['phi']/180*np.pi
     )
-    PMTs = np.stack((PMT_x, PMT_y, PMT_z))
-    kdtree = KDTree(np.stack((PMT_x, PMT_y, PMT_z), axis=-1))
-
-    # 生成每个photon的坐标coordinates
-    photon_num_per_event = np.roll(PhotonTruth[
-        np.unique(PhotonTruth['EventID'], return_index=True)[1] - 1
-    ]['PhotonID'], -1) + 1
-    repeated_par_tr = np.repeat(ParticleTruth, photon_num_per_event)
-    coordinates = np.stack(
-        (repeated_par_tr['x']/1000, repeated_par_tr['y']/1000, repeated_par_tr['z']/1000)
-    )
-
-    # 将问题分成10次循环，以防止内存爆炸
-    start_coordinate_index = 0
-    step = event_num // 10
-    for event_index in tqdm(range(0, step*11, step)):
-        photon = np.sum(photon_num_per_event[event_index:event_index+step])
-        if photon == 0:
-            continue
-        end_coordinate_index = start_coordinate_index + photon
-
-        chunk_coordinates = coordinates[
-            :, start_coordinate_index:end_coordinate_index
-        ]
-
-        t = np.pi/2 + rng.choice([-1, 1], size=photon)*(np.pi/2 - np.arcsin(rng.random(photon)))
-        p = rng.random(photon) * 2 * np.pi
-        vxs = np.sin(t) * np.cos(p)
-        vys = np.sin(t) * np.sin(p)
-        vzs = np.cos(t)
-        try_velocities = np.stack((vxs, vys, vzs))
-        events = PhotonTruth[start_coordinate_index:end_coordinate_index]['EventID']
-        times = PhotonTruth[start_coordinate_index:end_coordinate_index]['GenTime']
-        can_reflect = np.ones(photon)
-        transist(chunk_coordinates, try_velocities, times, events, can_reflect)
-        start_coordinate_index = end_coordinate_index
-
-    # 将dict转成structured array
-    names = ['EventID', 'ChannelID', 'PETime']
-    formats = ['<i4', '<i4', '<f8']
-    dtype = dict(names=names, formats=formats)
-    PETruth_structured = np.empty(len(PETruth['EventID']), dtype=dtype)
-    PETruth_structured['EventID'] = PETruth['EventID']
-    PETruth_structured['ChannelID'] = PETruth['ChannelID']
-    PETruth_structured['PETime'] = PETruth['PETime']
+    index = PMTIndex(np.stack((PMT_x, PMT_y, PMT_z)))
+    transport = (max_bounces, survival, weight, dtype)
 
-    # 按event排序
-    order = np.argsort(PETruth_structured['EventID'])
-    PETruth_structured = PETruth_structured[order]
+    if workers > 1:
+        PETruth_structured = trace_sharded(
+            ParticleTruth, PhotonTruth, index, rng, batch_size, backend, workers, sampler,
+            transport
+        )
+    else:
+        if PhotonTruth is None:
+            batches = generate_photons(ParticleTruth, sampler, rng, batch_size)
+            if photon_sink is not None:
+                batches = sink_photons(batches, photon_sink)
+            total = None
+        else:
+            batches = split_photons(PhotonTruth, batch_size)
+            total = -(-PhotonTruth.shape[0] // batch_size)
+        pe_buffer = make_buffer(rng, transport)
+        tracer = make_tracer(backend, index, rng, pe_buffer, batch_size, transport)
+        tracer.run(tqdm(emit_photons(ParticleTruth, batches, rng, weight, dtype), total=total))
+
+        # 按event排好序的PETruth
+        PETruth_structured = pe_buffer.to_structured()
 
     print("PETruth表生成完成！")
 
     return PETruth_structured
 
 
-def transist(coordinates, velocities, times, events, can_reflect, must_transist=False):
+def make_tracer(backend, index, rng, pe_buffer, batch_size, transport):
     '''
-    模拟在液闪内的光子下一次到达液闪边界的过程
+    给出backend对应的光子输运引擎，transport为(max_bounces, survival, weight, dtype)
     '''
-    # 求解折射点，ts为到达液闪边界的时间
-    cv = np.einsum('kn, kn->n', coordinates, velocities)
-    ts = -cv + np.sqrt(cv**2 - np.einsum('kn, kn->n', coordinates, coordinates) + Ri**2)
-    edge_points = coordinates + ts * velocities
-
-    # 计算增加的时间
-    new_times = times + (n_LS/c)*ts
-
-    # 计算入射角，出射角
-    normal_vectors = -edge_points / Ri
-    incidence_vectors = velocities
-    vertical_of_incidence = np.maximum(np.einsum('kn, kn->n', incidence_vectors, normal_vectors), -1)
-    incidence_angles = np.arccos(-vertical_of_incidence)
-
-    # 判断全反射
-    max_incidence_angle = np.arcsin(n_water/n_LS)
-    can_transmit = (incidence_angles < max_incidence_angle)
-    # print(f'all photon = {times.shape[0]}')
-    # print(f'can transimit = {can_transmit.sum()}')
-
-    #计算折射光，反射光矢量与位置
-    reflected_velocities = velocities - 2 * vertical_of_incidence * normal_vectors
-
-    delta = ne.evaluate('1 - eta**2 * (1 - vertical_of_incidence**2)')
-    new_velocities = ne.evaluate(
-        '(eta*incidence_vectors - (eta*vertical_of_incidence + sqrt(abs(delta))) * normal_vectors) * can_transmit'
-    ) #取绝对值避免出错
-
-    # 计算折射系数
-    emergence_angles = np.arccos(np.minimum(np.einsum('kn, kn->n', new_velocities, -normal_vectors), 1))
-    Rs = ne.evaluate('(sin(emergence_angles - incidence_angles)/sin(emergence_angles + incidence_angles))**2')
-    Rp = ne.evaluate('(tan(emergence_angles - incidence_angles)/tan(emergence_angles + incidence_angles))**2')
-    R = (Rs+Rp)/2
-
-    # 选出需要折射和反射的光子
-    rng = np.random.default_rng()
-    probs = rng.random(times.shape[0])
-    need_transmit = (probs > R) * can_transmit
-    need_reflect = np.logical_not(need_transmit) * can_transmit * can_reflect.astype(bool)
-
-    # 处理在液闪内已经反射一次的光子，必须全部折射出去（如果不是全反射）
-    if must_transist:
-        hit_PMT(
-            edge_points[:, can_transmit],
-            new_velocities[:, can_transmit],
-            new_times[can_transmit],
-            events[can_transmit],
-            np.zeros(can_transmit.sum()),
-            must_transist=True
+    max_bounces, survival, weight, dtype = transport
+    if backend == 'numba':
+        return NumbaTracer(
+            index.PMTs, rng, pe_buffer, index, max_bounces, survival, weight, dtype=dtype
         )
-    else:
-        # 处理需要折射出去的光子
-        if need_transmit.any():
-            hit_PMT(
-                edge_points[:, need_transmit],
-                new_velocities[:, need_transmit],
-                new_times[need_transmit],
-                events[need_transmit],
-                can_reflect[need_transmit],
-                must_transist=True
-            )
+    return Tracer(
+        index.PMTs, rng, pe_buffer, batch_size, index, max_bounces, survival, weight, dtype=dtype
+    )
 
-        # 处理需要继续反射的光子
-        if need_reflect.any():
-            transist(
-                edge_points[:, need_reflect],
-                reflected_velocities[:, need_reflect],
-                new_times[need_reflect],
-                events[need_reflect],
-                np.zeros(need_reflect.sum()),
-                must_transist=True
-            )
 
+def make_buffer(rng, transport):
+    '''
+    给出存放PE的缓冲区，加权模式下为WeightedPEBuffer
+    '''
+    max_bounces, survival, weight, dtype = transport
+    if weight is None:
+        return PEBuffer(time_dtype=dtype)
+    return WeightedPEBuffer(rng, time_dtype=dtype)
 
-def find_hit_PMT(coordinates, velocities, fromPMT=False):
+
+def trace_sharded(ParticleTruth, PhotonTruth, index, rng, batch_size, backend, workers,
+                  sampler, transport):
     '''
-    通过KDTree寻找一组光子最终能否击中PMT以及击中PMT的序号
+    多进程的光学过程
+    进程池由shard_pool给出，在各次调用（各分块）之间复用，
+    每次只把ParticleTruth和PhotonTruth放在新的共享内存中，各段的PETruth按EventID的顺序拼接
+    PhotonTruth为None时按事件分段，各进程自己生成光子
     '''
-    # 查找在球面上最邻近的PMT
-    cv1 = np.einsum('kn, kn->n', coordinates, velocities)
-    # ts为到达液闪边界的时间
-    ts1 = -cv1 + np.sqrt(cv1**2 - (np.einsum('kn, kn->n', coordinates, coordinates)-(Ro+r_PMT)**2))
-    edge_points1 = coordinates + ts1 * velocities
-    outer_points = np.stack((edge_points1[0, :], edge_points1[1, :], edge_points1[2, :]), axis=-1)
-
-    inserted_points = np.empty(1)
-    if fromPMT:
-        insert_num = 1000
-        inner_points = np.stack((coordinates[0, :], coordinates[1, :], coordinates[2, :]), axis=-1)
-        inserted_points = np.linspace(inner_points, outer_points, insert_num)[1:, :, :]
+    pool = shard_pool(index, rng, backend, workers, batch_size, sampler, transport)
+    # 每个进程分到几段，平衡各段的耗时差异
+    arrays = dict(ParticleTruth=ParticleTruth)
+    if PhotonTruth is None:
+        bounds = shard_bounds(ParticleTruth['EventID'], 4 * workers)
     else:
-        insert_num = 10
-        cv2 = np.einsum('kn, kn->n', coordinates, velocities)
-        ts2 = -cv2 + np.sqrt(cv2**2 - (np.einsum('kn, kn->n', coordinates, coordinates)-(Ro-r_PMT)**2))
-        edge_points2 = coordinates + ts2 * velocities
-        inner_points = np.stack((edge_points2[0, :], edge_points2[1, :], edge_points2[2, :]), axis=-1)
-        inserted_points = np.linspace(inner_points, outer_points, insert_num)
-
-    # 返回搜索得到的最邻近点距离和最邻近点index
-    search_distances, search_indexs = kdtree.query(
-        inserted_points, workers=-1, distance_upper_bound=r_PMT
+        bounds = shard_bounds(PhotonTruth['EventID'], 4 * workers)
+        arrays['PhotonTruth'] = PhotonTruth
+    shared = {}
+    try:
+        for name, array in arrays.items():
+            shared[name] = share_array(array)
+        specs = {name: spec for name, (shm, spec) in shared.items()}
+        tasks = [(specs, bound) for bound in bounds]
+        PETruths = list(tqdm(pool.imap(trace_shard, tasks), total=len(tasks)))
+    finally:
+        for shm, spec in shared.values():
+            shm.close()
+            shm.unlink()
+
+    if len(PETruths) == 0:
+        return PEBuffer(time_dtype=transport[3]).to_structured()
+    return np.concatenate(PETruths)
+
+
+# 光学过程的进程池与其共享的PMT几何，由shard_pool创建，退出时关闭
+shard_pools = {}
+
+
+def shard_pool(index, rng, backend, workers, batch_size, sampler, transport):
+    '''
+    给出光学过程的进程池，参数与PMT几何不变时复用已有的进程池，否则关闭旧的再新建
+    工作进程的启动（导入numba、编译内核、建立PMTIndex）只在新建时发生一次
+    '''
+    key = (
+        hashlib.sha1(index.PMTs.tobytes()).hexdigest(), index.n_theta, index.piece_length,
+        rng.seed, backend, workers, batch_size, sampler, transport
     )
-    allowed_distances = search_distances < np.inf
-    possible_photon = np.where(np.any(allowed_distances, axis=0))[0]
-    first_point_index = np.argmax(allowed_distances[:, possible_photon], axis=0)
+    return cached_pool(
+        shard_pools, key, workers, init_shard_worker,
+        dict(PMTs=index.PMTs, table=index.table),
+        index.n_theta, index.piece_length, rng.seed, backend, batch_size, sampler, transport
+    )
+
 
-    nearest_PMT_index = search_indexs[first_point_index, possible_photon]
+atexit.register(close_pool, shard_pools)
 
-    return nearest_PMT_index, possible_photon
 
+# 工作进程中的PMT几何与索引，由init_shard_worker设置
+shard_worker = {}
+# 工作进程中本次调用的ParticleTruth与PhotonTruth，由utils.attach_inputs设置
+shard_inputs = {}
 
-def hit_PMT(coordinates, velocities, times, events, can_reflect, fromPMT=False, must_transist=False):
+
+def init_shard_worker(specs, n_theta, piece_length, seed, backend, batch_size, sampler,
+                      transport):
     '''
-    模拟光子在PMT表面反射的过程
+    工作进程的初始化：连接PMT几何的共享内存，建立PMTIndex
     '''
-    # 给出打到的PMT编号和能打中PMT光子的编号
-    nearest_PMT_index, possible_photon = find_hit_PMT(coordinates, velocities, fromPMT)
-    possible_coordinates = coordinates[:, possible_photon]
-    possible_velocities = velocities[:, possible_photon]
-    possible_times = times[possible_photon]
-    possible_events = events[possible_photon]
-    possible_reflect = can_reflect[possible_photon]
-    possible_PMT = PMTs[:, nearest_PMT_index]
-    # print(f'ratio = {possible_photon.shape[0]/times.shape[0]}')
-
-    # 计算到达时间
-    PMT2edge = possible_coordinates - possible_PMT
-    ts = -np.einsum('kn, kn->n', PMT2edge, possible_velocities) -\
-        np.sqrt(
-            np.einsum('kn, kn->n', PMT2edge, possible_velocities)**2 -\
-            np.einsum('kn, kn->n', PMT2edge, PMT2edge) +\
-            r_PMT**2
-        )
-    arrive_times = possible_times + (n_water/c)*ts
-
-    # 计算到达点，以及入射角、出射角
-    edge_points = possible_coordinates + ts*possible_velocities
-    normal_vectors = (edge_points - possible_PMT) / r_PMT
-    incidence_vectors = possible_velocities
-    incidence_angles = np.arccos(
-        -np.maximum(np.einsum('kn, kn->n', incidence_vectors, normal_vectors), -1)
+    single_thread()
+    for name, spec in specs.items():
+        shard_worker[name + '_shm'], shard_worker[name] = attach_array(spec)
+    shard_worker['index'] = PMTIndex(
+        shard_worker['PMTs'], n_theta, piece_length, shard_worker['table']
     )
-    # print(f'incidence_angles = {incidence_angles.mean()}, var = {incidence_angles.var()}')
-    emergence_angles = np.arcsin((n_water/n_glass) * np.sin(incidence_angles))
-    # print(f'emergence_angles = {emergence_angles.mean()}, var = {emergence_angles.var()}')
+    shard_worker['rng'] = CounterRNG(seed)
+    shard_worker['backend'] = backend
+    shard_worker['batch_size'] = batch_size
+    shard_worker['sampler'] = sampler
+    shard_worker['transport'] = transport
 
-    # 计算反射系数->反射概率
-    Rs = ne.evaluate(
-        '(sin(emergence_angles - incidence_angles)/sin(emergence_angles + incidence_angles))**2'
-    )
-    Rp = ne.evaluate(
-        '(tan(emergence_angles - incidence_angles)/tan(emergence_angles + incidence_angles))**2'
-    )
-    R = (Rs+Rp)/2
-    # print(f'R average = {R.mean()}')
-
-    rng = np.random.default_rng()
-    probs = rng.random(possible_photon.shape[0])
-    need_transmit = probs > R  # 水的折射率小于玻璃，不可能全反射
-    need_reflect = np.logical_not(need_transmit) * possible_reflect.astype(bool)
-
-    if must_transist:
-        # 如果之前以及反射过，这次必须折射
-        # print(f'must_transmit = {arrive_times.shape[0]}')
-        write(possible_events, nearest_PMT_index, arrive_times, PETruth)
+
+def trace_shard(task):
+    '''
+    在工作进程中模拟PhotonTruth[start:stop]，返回这一段的PETruth
+    没有共享的PhotonTruth时，模拟ParticleTruth[start:stop]中的事件
+    task为(共享内存的specs, (start, stop))
+    '''
+    specs, (start, stop) = task
+    attach_inputs(shard_inputs, specs)
+    rng = shard_worker['rng']
+    batch_size = shard_worker['batch_size']
+    if 'PhotonTruth' in shard_inputs:
+        batches = split_photons(shard_inputs['PhotonTruth'][start:stop], batch_size)
     else:
-        # 处理折射进入PMT的光子
-        if need_transmit.any():
-            # print(f'need_transmit = {need_transmit.sum()}')
-            write(
-                possible_events[need_transmit],
-                nearest_PMT_index[need_transmit],
-                arrive_times[need_transmit],
-                PETruth
+        batches = generate_photons(
+            shard_inputs['ParticleTruth'][start:stop], shard_worker['sampler'], rng, batch_size
+        )
+    transport = shard_worker['transport']
+    pe_buffer = make_buffer(rng, transport)
+    tracer = make_tracer(
+        shard_worker['backend'], shard_worker['index'], rng, pe_buffer, batch_size, transport
+    )
+    tracer.run(emit_photons(shard_inputs['ParticleTruth'], batches, rng, *transport[2:]))
+    return pe_buffer.to_structured()
+
+
+def split_photons(PhotonTruth, batch_size):
+    '''
+    把PhotonTruth按顺序切成batch_size个光子一批
+    '''
+    for start in range(0, PhotonTruth.shape[0], batch_size):
+        yield PhotonTruth[start:start + batch_size]
+
+
+def sink_photons(batches, photon_sink):
+    '''
+    把每批PhotonTruth交给photon_sink后再继续传递
+    '''
+    for chunk in batches:
+        photon_sink(chunk)
+        yield chunk
+
+
+def emit_photons(ParticleTruth, batches, rng, weight=None, dtype='<f8'):
+    '''
+    batches依次给出一批批PhotonTruth，对每批给出从顶点出发的光子
+    weight不为None时每个光子以1/weight的概率被追踪，权重为weight
+    位置、方向与时间的浮点类型为dtype
+    '''
+    for chunk in batches:
+        if weight is not None:
+            chunk = chunk[
+                rng.random(STREAM_SPLIT, chunk['EventID'], chunk['PhotonID'], 0) * weight < 1
+            ]
+        events = chunk['EventID']
+        photons = chunk['PhotonID']
+
+        # EventID不一定从0开始（分块生成时），按EventID查找顶点
+        vertices = ParticleTruth[np.searchsorted(ParticleTruth['EventID'], events)]
+        coordinates = np.stack(
+            (vertices['x']/1000, vertices['y']/1000, vertices['z']/1000)
+        )
+
+        direction_random = rng.random(
+            STREAM_DIRECTION, events, photons, np.arange(3).reshape(-1, 1)
+        )
+        t = np.pi/2 + np.where(direction_random[0] < 0.5, -1, 1)*(np.pi/2 - np.arcsin(direction_random[1]))
+        p = direction_random[2] * 2 * np.pi
+        vxs = np.sin(t) * np.cos(p)
+        vys = np.sin(t) * np.sin(p)
+        vzs = np.cos(t)
+
+        yield dict(
+            coordinates=coordinates.astype(dtype),
+            velocities=np.stack((vxs, vys, vzs)).astype(dtype),
+            times=chunk['GenTime'].astype(dtype),
+            events=events,
+            photons=photons,
+            hops=np.zeros(events.shape[0], dtype=np.int32),
+            bounces=np.zeros(events.shape[0], dtype=np.int32),
+            weights=np.full(events.shape[0], 1.0 if weight is None else float(weight)),
+            branches=np.ones(events.shape[0], dtype=np.uint64)
+        )
+
+
+class PhotonQueue:
+    '''
+    某一种相互作用的待处理光子
+    预分配的列式存储，容量不足时翻倍，从尾部取出，不移动数据
+    '''
+    # 字段名: (每个光子的分量数, 类型)，类型为None的是光子状态，使用队列的浮点类型
+    fields = {
+        'coordinates': (3, None),
+        'velocities': (3, None),
+        'times': (None, None),
+        'events': (None, '<i4'),
+        'photons': (None, '<i4'),
+        'hops': (None, '<i4'), # 光子此前经过的界面数，用作随机数的槽位
+        'bounces': (None, '<i4'), # 光子此前的反射次数
+        'weights': (None, '<f8'), # 轮盘赌存活的光子权重增大，加权模式中为分支代表的光子数
+        'branches': (None, '<u8'), # 加权模式中的分支编号，从1开始，每次分支追加一位
+    }
+
+    def __init__(self, capacity=1 << 12, dtype='<f8'):
+        self.size = 0
+        self.columns = {
+            name: np.empty(
+                capacity if k is None else (k, capacity), dtype=dtype if kind is None else kind
             )
+            for name, (k, kind) in self.fields.items()
+        }
+
+    def push(self, **photons):
+        '''
+        放入一组光子，参数为各字段的数组
+        '''
+        n = photons['times'].shape[0]
+        if n == 0:
+            return
+        if self.size + n > self.columns['times'].shape[0]:
+            capacity = max(2 * self.columns['times'].shape[0], self.size + n)
+            for name, column in self.columns.items():
+                grown = np.empty(column.shape[:-1] + (capacity,), dtype=column.dtype)
+                grown[..., :self.size] = column[..., :self.size]
+                self.columns[name] = grown
+        for name, column in self.columns.items():
+            column[..., self.size:self.size + n] = photons[name]
+        self.size += n
+
+    def pop(self, n):
+        '''
+        取出至多n个光子，返回各字段数组的dict
+        '''
+        start = max(self.size - n, 0)
+        photons = {
+            name: column[..., start:self.size].copy()
+            for name, column in self.columns.items()
+        }
+        self.size = start
+        return photons
+
+
+class Tracer:
+    '''
+    迭代式的光子输运引擎
+    每种相互作用一个队列，每次从优先级最高的非空队列中取出一批光子处理，
+    峰值内存只与batch_size有关
+
+    每个界面上按反射率随机选择反射或折射，反射次数不限，
+    超过max_bounces次的光子丢弃（截断，有偏）;
+    第二次及以后的每次反射进行轮盘赌，光子以survival的概率存活，权重除以survival，
+    击中PMT时按权重随机取整为几份PE（无偏，survival越小越快、涨落越大）
+
+    加权模式（weight不为None）中不再随机选择，反射与折射两支都继续追踪，
+    权重分别乘以R与1-R; 继续追踪的分支权重低于min_weight时进行轮盘赌，
+    以weight/min_weight的概率存活，权重提高到min_weight。击中PMT的分支连同权重
+    写入WeightedPEBuffer，最后统一重抽样
+    '''
+
+    def __init__(self, PMTs, rng, pe_buffer, batch_size=BATCH_SIZE, index=None,
+                 max_bounces=MAX_BOUNCES, survival=SURVIVAL, weight=None,
+                 min_weight=MIN_WEIGHT, dtype='<f8'):
+        '''
+        PMTs: (3, n)的PMT球心坐标
+        rng: CounterRNG
+        pe_buffer: 写入PE的PEBuffer
+        index: 求光子击中哪个PMT的索引，默认为PMTIndex
+        max_bounces: 每个光子最多的反射次数
+        survival: 轮盘赌的存活概率，1为不进行轮盘赌
+        weight: 加权模式中每个光子的初始权重，None为逐光子模拟
+        min_weight: 加权模式中继续追踪的分支的最小权重
+        dtype: 光子的位置、方向与时间的浮点类型，计算都在这一类型中进行
+        '''
+        self.PMTs = PMTs.astype(dtype)
+        self.index = PMTIndex(PMTs) if index is None else index
+        self.rng = rng
+        self.pe_buffer = pe_buffer
+        self.batch_size = batch_size
+        self.max_bounces = max_bounces
+        self.survival = survival
+        self.weight = weight
+        self.min_weight = min_weight
+        self.queues = {kind: PhotonQueue(dtype=dtype) for kind in KINDS}
+        self.handlers = {
+            GO_INSIDE: self.go_inside,
+            HIT_PMT_AGAIN: lambda photons: self.hit_PMT(photons, fromPMT=True),
+            HIT_PMT: self.hit_PMT,
+            TRANSIST: self.transist,
+        }
+
+    def run(self, source):
+        '''
+        source依次给出从顶点出发的光子，每放入一批就处理到所有队列为空
+        '''
+        for photons in source:
+            self.queues[TRANSIST].push(**photons)
+            self.drain()
+
+    def drain(self):
+        '''
+        处理队列中所有的光子
+        '''
+        while True:
+            for kind in KINDS:
+                if self.queues[kind].size > 0:
+                    self.handlers[kind](self.queues[kind].pop(self.batch_size))
+                    break
+            else:
+                return
+
+    def push(self, kind, photons, selected, coordinates, velocities, times):
+        '''
+        把photons中selected的光子以新的位置、方向与时间放入kind队列，经过的界面数加一
+        '''
+        self.queues[kind].push(
+            coordinates=coordinates[:, selected],
+            velocities=velocities[:, selected],
+            times=times[selected],
+            events=photons['events'][selected],
+            photons=photons['photons'][selected],
+            hops=photons['hops'][selected] + 1,
+            bounces=photons['bounces'][selected],
+            weights=photons['weights'][selected],
+            branches=photons['branches'][selected]
+        )
+
+    def bounce(self, photons, reflected):
+        '''
+        photons中reflected的光子各反射一次，更新反射次数与权重，
+        返回仍需追踪的光子（超过最多反射次数或轮盘赌失败的丢弃）
+        '''
+        bounces = photons['bounces'] + reflected
+        alive = reflected & (bounces <= self.max_bounces)
+        if self.survival < 1:
+            roulette = reflected & (bounces > 1)
+            probs = self.rng.random(
+                STREAM_ROULETTE, photons['events'], photons['photons'], photons['hops']
+            )
+            alive &= ~roulette | (probs < self.survival)
+            photons['weights'] = np.where(
+                roulette, photons['weights'] / self.survival, photons['weights']
+            )
+        photons['bounces'] = bounces
+        return alive
+
+    def split(self, photons, R, can_transmit=True, detected=False):
+        '''
+        按反射率R把photons分为折射与反射两支，
+        返回(折射的光子, 是否折射, 反射的光子, 是否反射)，can_transmit为False的光子两支都丢弃
+        逐光子模拟时每个光子按随机数只走一支;
+        加权模式中两支都保留，分支编号各追加一位，detected为True时折射的一支成为PE，不进行轮盘赌
+        '''
+        if self.weight is None:
+            probs = self.rng.random(STREAM_OPTICS, photons['events'], photons['photons'], photons['hops'])
+            need_transmit = (probs > R) & can_transmit
+            need_reflect = self.bounce(photons, ~need_transmit & can_transmit)
+            return photons, need_transmit, photons, need_reflect
+
+        can_transmit = np.broadcast_to(can_transmit, R.shape)
+        weights = photons['weights']
+        branches = photons['branches'] * 2
+        transmitted = dict(photons, weights=weights * (1 - R), branches=branches)
+        reflected = dict(
+            photons, weights=weights * R, branches=branches + 1, bounces=photons['bounces'] + 1
+        )
+        need_transmit = can_transmit if detected else can_transmit & self.roulette(transmitted)
+        need_reflect = can_transmit & (reflected['bounces'] <= self.max_bounces) & \
+            self.roulette(reflected)
+        return transmitted, need_transmit, reflected, need_reflect
+
+    def roulette(self, photons):
+        '''
+        加权模式中对权重低于min_weight的分支进行轮盘赌，更新存活分支的权重，返回是否存活
+        '''
+        weights = photons['weights']
+        light = weights < self.min_weight
+        probs = self.rng.random(STREAM_SPLIT, photons['events'], photons['photons'], photons['branches'])
+        photons['weights'] = np.where(light, self.min_weight, weights)
+        return ~light | (probs * self.min_weight < weights)
+
+    def transist(self, photons):
+        '''
+        模拟在液闪内的光子下一次到达液闪边界的过程
+        '''
+        coordinates = photons['coordinates']
+        velocities = photons['velocities']
+
+        # 求解折射点，ts为到达液闪边界的时间
+        cv = np.einsum('kn, kn->n', coordinates, velocities)
+        ts = -cv + np.sqrt(cv**2 - np.einsum('kn, kn->n', coordinates, coordinates) + Ri**2)
+        edge_points = coordinates + ts * velocities
+
+        # 计算增加的时间
+        new_times = photons['times'] + (n_LS/c)*ts
+
+        # 计算入射角、出射角的余弦与反射率，cos_t为0即全反射
+        normal_vectors = -edge_points / Ri
+        cos_i, cos_t, R = interface(velocities, normal_vectors, eta)
+        can_transmit = cos_t > 0
+
+        #计算折射光，反射光矢量
+        reflected_velocities = reflect(velocities, normal_vectors, cos_i)
+        new_velocities = refract(velocities, normal_vectors, cos_i, cos_t, eta)
+
+        # 选出需要折射和反射的光子
+        # 全反射后入射角不变，光子永远留在液闪内，直接丢弃
+        transmitted, need_transmit, reflected, need_reflect = self.split(photons, R, can_transmit)
+
+        # 需要折射出去的光子
+        self.push(HIT_PMT, transmitted, need_transmit, edge_points, new_velocities, new_times)
+
+        # 需要继续反射的光子
+        self.push(
+            TRANSIST, reflected, need_reflect, edge_points, reflected_velocities, new_times
+        )
+
+    def hit_PMT(self, photons, fromPMT=False):
+        '''
+        模拟光子在PMT表面反射的过程
+        '''
+        # 给出打到的PMT编号和能打中PMT光子的编号
+        nearest_PMT_index, possible_photon = self.index.first_hit(
+            photons['coordinates'], photons['velocities'], fromPMT
+        )
+        possible = {name: value[..., possible_photon] for name, value in photons.items()}
+        possible_coordinates = possible['coordinates']
+        possible_velocities = possible['velocities']
+        possible_PMT = self.PMTs[:, nearest_PMT_index]
+
+        # 计算到达时间，擦过PMT的光线判别式可能因舍入略小于0（float32时更常见）
+        PMT2edge = possible_coordinates - possible_PMT
+        ts = -np.einsum('kn, kn->n', PMT2edge, possible_velocities) -\
+            np.sqrt(np.maximum(
+                np.einsum('kn, kn->n', PMT2edge, possible_velocities)**2 -\
+                np.einsum('kn, kn->n', PMT2edge, PMT2edge) +\
+                r_PMT**2, 0
+            ))
+        arrive_times = possible['times'] + (n_water/c)*ts
+
+        # 计算到达点，以及反射率
+        edge_points = possible_coordinates + ts*possible_velocities
+        normal_vectors = (edge_points - possible_PMT) / r_PMT
+        cos_i, cos_t, R = interface(possible_velocities, normal_vectors, n_water/n_glass)
+
+        # 水的折射率小于玻璃，不可能全反射
+        transmitted, need_transmit, reflected, need_reflect = self.split(possible, R, detected=True)
+
+        # 处理折射进入PMT的光子
+        self.detect(
+            {name: value[..., need_transmit] for name, value in transmitted.items()},
+            nearest_PMT_index[need_transmit], arrive_times[need_transmit]
+        )
 
         # 处理需要继续反射的光子
         if need_reflect.any():
-            # print(f'need_reflect = {need_reflect.sum()}')
-            reflect_coordinates = edge_points[:, need_reflect]
-            reflect_velocities = incidence_vectors[:, need_reflect] -\
-                                 2 * np.einsum(
-                                     'kn ,kn->n',
-                                     incidence_vectors[:, need_reflect],
-                                     normal_vectors[:, need_reflect]
-                                 ) *\
-                                 normal_vectors[:, need_reflect]
-            reflect_times = arrive_times[need_reflect]
-            reflect_events = possible_events[need_reflect]
+            reflect_velocities = reflect(possible_velocities, normal_vectors, cos_i)
 
             # 计算反射光线到球心的距离，判断是否会射回液闪内
-            rt = -np.einsum('kn, kn->n', reflect_coordinates, reflect_velocities)
-            ds = np.linalg.norm(reflect_coordinates + rt*reflect_velocities, axis=0)
+            rt = -np.einsum('kn, kn->n', edge_points, reflect_velocities)
+            ds = np.linalg.norm(edge_points + rt*reflect_velocities, axis=0)
             go_into_LS = ds < Ri
-            hit_PMT_again = np.logical_not(go_into_LS)
-
-            # 找出会射回液闪球内的
-            # print(f'go_into_LS = {go_into_LS.sum()}')
-            go_inside(
-                reflect_coordinates[:, go_into_LS],
-                reflect_velocities[:, go_into_LS],
-                reflect_times[go_into_LS],
-                reflect_events[go_into_LS]
+
+            # 会射回液闪球内的
+            self.push(
+                GO_INSIDE, reflected, need_reflect & go_into_LS,
+                edge_points, reflect_velocities, arrive_times
             )
 
-            # 找出继续在水中行进的
-            # print(f'hit_PMT_again = {hit_PMT_again.sum()}')
-            hit_PMT(
-                reflect_coordinates[:, hit_PMT_again],
-                reflect_velocities[:, hit_PMT_again],
-                reflect_times[hit_PMT_again],
-                reflect_events[hit_PMT_again],
-                np.zeros(hit_PMT_again.sum()),
-                fromPMT=True
+            # 继续在水中行进的
+            self.push(
+                HIT_PMT_AGAIN, reflected, need_reflect & ~go_into_LS,
+                edge_points, reflect_velocities, arrive_times
             )
 
+    def detect(self, photons, PMT_indexs, times):
+        '''
+        把进入PMT的光子写入pe_buffer
+        逐光子模拟时按权重随机取整为几份PE，加权模式中连同权重与分支编号写入，最后重抽样
+        '''
+        if self.weight is not None:
+            self.pe_buffer.append(
+                photons['events'], PMT_indexs, times, photons['photons'],
+                photons['weights'], photons['branches']
+            )
+            return
+        if self.survival < 1:
+            copies = np.floor(photons['weights'] + self.rng.random(
+                STREAM_ROULETTE, photons['events'], photons['photons'], photons['hops']
+            )).astype(np.int64)
+        else:
+            copies = 1
+        self.pe_buffer.append(
+            np.repeat(photons['events'], copies), np.repeat(PMT_indexs, copies),
+            np.repeat(times, copies), np.repeat(photons['photons'], copies)
+        )
 
+    def go_inside(self, photons):
+        '''
+        模拟从PMT表面反射回液闪内的光子在液闪表面的行为
+        '''
+        coordinates = photons['coordinates']
+        velocities = photons['velocities']
 
-def go_inside(coordinates, velocities, times, events):
-    '''
-    模拟从PMT表面反射回液闪内的光子在液闪表面的行为
-    '''
-    # 求解折射点，ts为到达液闪边界的时间
-    cv = np.einsum('kn, kn->n', coordinates, velocities)
-    ts = -cv - np.sqrt(cv**2 - np.einsum('kn, kn->n', coordinates, coordinates) + Ri**2)
-    edge_points = coordinates + ts * velocities
-    new_times = times + (n_water/c)*ts
-
-    # 计算入射角，出射角
-    normal_vectors = edge_points / Ri
-    incidence_vectors = velocities
-    vertical_of_incidence = np.maximum(
-        np.einsum('kn, kn->n', incidence_vectors, normal_vectors), -1
-    )
-    incidence_angles = np.arccos(-vertical_of_incidence)
+        # 求解折射点，ts为到达液闪边界的时间
+        cv = np.einsum('kn, kn->n', coordinates, velocities)
+        ts = -cv - np.sqrt(np.maximum(
+            cv**2 - np.einsum('kn, kn->n', coordinates, coordinates) + Ri**2, 0
+        ))
+        edge_points = coordinates + ts * velocities
+        new_times = photons['times'] + (n_water/c)*ts
 
-    #计算折射光，反射光矢量与位置
-    reflected_velocities = velocities - 2 * vertical_of_incidence * normal_vectors
+        # 从水射入液闪，计算反射率与折射光矢量
+        normal_vectors = edge_points / Ri
+        cos_i, cos_t, R = interface(velocities, normal_vectors, 1/eta)
+        new_velocities = refract(velocities, normal_vectors, cos_i, cos_t, 1/eta)
+        reflected_velocities = reflect(velocities, normal_vectors, cos_i)
 
-    delta = ne.evaluate('1 - eta**2 * (1 - vertical_of_incidence**2)')
-    new_velocities = ne.evaluate(
-        'eta*incidence_vectors - (eta*vertical_of_incidence + sqrt(delta)) * normal_vectors'
-    ) #取绝对值避免出错
+        # 折射进入液闪，或在液闪外表面反射回到水中
+        transmitted, need_transmit, reflected, need_reflect = self.split(photons, R)
 
-    # 计算折射系数
-    emergence_angles = np.arccos(
-        np.minimum(np.einsum('kn, kn->n', new_velocities, -normal_vectors), 1)
-    )
-    Rs = ne.evaluate(
-        '(sin(emergence_angles - incidence_angles)/sin(emergence_angles + incidence_angles))**2'
-    )
-    Rp = ne.evaluate(
-        '(tan(emergence_angles - incidence_angles)/tan(emergence_angles + incidence_angles))**2'
-    )
-    R = (Rs+Rp)/2
-
-    # 选出需要折射和反射的光子
-    rng = np.random.default_rng()
-    probs = rng.random(times.shape[0])
-    need_transmit = probs > R
-
-    if need_transmit.any():
-        transist(
-            edge_points[:, need_transmit],
-            new_velocities[:, need_transmit],
-            new_times[need_transmit],
-            events[need_transmit],
-            np.zeros(need_transmit.sum())
-        )
+        self.push(TRANSIST, transmitted, need_transmit, edge_points, new_velocities, new_times)
+        self.push(HIT_PMT, reflected, need_reflect, edge_points, reflected_velocities, new_times)
 
 
+@njit(cache=True)
+def counting_order(keys, key_num, order):
+    '''
+    按keys（0到key_num-1）对order做一次稳定的计数排序
+    '''
+    offsets = np.zeros(key_num + 1, dtype=np.int64)
+    for i in range(order.shape[0]):
+        offsets[keys[order[i]] + 1] += 1
+    for i in range(key_num):
+        offsets[i + 1] += offsets[i]
+    sorted_order = np.empty(order.shape[0], dtype=np.int64)
+    for i in range(order.shape[0]):
+        k = keys[order[i]]
+        sorted_order[offsets[k]] = order[i]
+        offsets[k] += 1
+    return sorted_order
+
+
+class PEBuffer:
+    '''
+    PETruth的列式缓冲区
+    按列存放EventID, ChannelID, PETime，以及用于排序的PhotonID，容量不足时翻倍
+    '''
+    names = ['EventID', 'ChannelID', 'PETime']
 
-def write(events, PMT_indexs, times, PETruth):
+    def __init__(self, capacity=1 << 16, time_dtype='<f8'):
+        self.size = 0
+        self.formats = ['<i4', '<i4', time_dtype]
+        self.columns = [np.empty(capacity, dtype=f) for f in self.formats + ['<i4']]
+
+    def append(self, events, PMT_indexs, times, photons, *extra):
+        '''
+        将确定发生的事件写入缓冲区，extra为子类中额外各列的值
+        '''
+        n = len(events)
+        if self.size + n > self.columns[0].shape[0]:
+            capacity = max(2 * self.columns[0].shape[0], self.size + n)
+            for k, column in enumerate(self.columns):
+                grown = np.empty(capacity, dtype=column.dtype)
+                grown[:self.size] = column[:self.size]
+                self.columns[k] = grown
+        for column, values in zip(self.columns, (events, PMT_indexs, times, photons) + extra):
+            column[self.size:self.size + n] = values
+        self.size += n
+
+    def to_structured(self):
+        '''
+        给出按(EventID, PhotonID)排好序的PETruth结构化数组
+        排序结果与光子被处理的先后无关，因此与分批方式无关
+        '''
+        dtype = dict(names=self.names, formats=self.formats)
+        PETruth = np.empty(self.size, dtype=dtype)
+        if self.size == 0:
+            return PETruth
+        events = self.columns[0][:self.size]
+        photons = self.columns[3][:self.size]
+        first_event = events.min()
+
+        # 两次计数排序：先按PhotonID，再按EventID
+        order = counting_order(photons, photons.max() + 1, np.arange(self.size))
+        order = counting_order(events - first_event, events.max() - first_event + 1, order)
+        for name, column in zip(self.names, self.columns):
+            PETruth[name] = column[:self.size][order]
+        return PETruth
+
+
+class WeightedPEBuffer(PEBuffer):
     '''
-    将确定发生的事件写入PETruth
+    加权模式中击中PMT的分支的缓冲区，除PEBuffer的各列外还存放权重与分支编号
+    to_structured时对每个事件做系统重抽样：按(PhotonID, 分支编号)的顺序累加权重C，
+    取一个均匀随机数u，每个分支的PE数为区间[C_prev, C)中u+k（k为整数）的个数，
+    期望恰为其权重，每个事件的PE数为总权重向下或向上取整
     '''
-    PETruth['EventID'].extend(list(events))
-    PETruth['ChannelID'].extend(list(PMT_indexs))
-    PETruth['PETime'].extend(list(times))
+
+    def __init__(self, rng, capacity=1 << 16, time_dtype='<f8'):
+        super().__init__(capacity, time_dtype)
+        self.rng = rng
+        self.columns += [np.empty(capacity, dtype='<f8'), np.empty(capacity, dtype='<u8')]
+
+    def to_structured(self):
+        '''
+        重抽样，给出按(EventID, PhotonID)排好序的PETruth结构化数组
+        分支的顺序与处理的先后无关，因此结果与分批方式无关
+        '''
+        events, channels, times, photons, weights, branches = (
+            column[:self.size] for column in self.columns
+        )
+        order = np.lexsort((branches, photons, events))
+        events, weights = events[order], weights[order]
+
+        # 每个事件内的累积权重，u+k落在[C_prev, C)中的个数为ceil(C-u)-ceil(C_prev-u)
+        cumulative = np.cumsum(weights)
+        starts = np.flatnonzero(np.diff(events, prepend=events[:1] - 1))
+        event_counts = np.diff(np.append(starts, events.shape[0]))
+        cumulative -= np.repeat(cumulative[starts] - weights[starts], event_counts)
+        u = np.repeat(self.rng.random(STREAM_RESAMPLE, events[starts]), event_counts)
+        reached = np.maximum(np.ceil(cumulative - u), 0).astype(np.int64)
+        copies = np.diff(reached, prepend=0)
+        copies[starts] = reached[starts]
+
+        resampled = PEBuffer(max(int(copies.sum()), 1), self.formats[2])
+        resampled.append(
+            np.repeat(events, copies), np.repeat(channels[order], copies),
+            np.repeat(times[order], copies), np.repeat(photons[order], copies)
+        )
+        return resampled.to_structured()
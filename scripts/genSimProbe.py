@@ -1,7 +1,7 @@
 '''
 genSimProbe: double-search法，模拟光子打到某个PMT上的概率
 
-主要接口：gen_interp
+主要接口：gen_interp, gen_table
 '''
 import multiprocessing
 import numpy as np
@@ -9,6 +9,7 @@ import numexpr as ne
 from scipy.interpolate import RectBivariateSpline
 from tqdm import tqdm
 from .utils import n_water, n_LS, n_glass, Ri, Ro, r_PMT, c
+from .optics import interface, refract, reflect
 
 # 设置ne最大线程数，防止在并行时占用太多资源
 ne.set_num_threads(2)
@@ -33,43 +34,22 @@ def transist_once(coordinates, velocities, intensities, times):
     # 计算增加的时间
     new_times = times + (n_LS/c)*ts
 
-    # 计算入射角，出射角
+    # 计算入射角、出射角的余弦与反射率，全反射时反射率为1
     normal_vectors = -edge_points / Ri
-    incidence_vectors = velocities
-    vertical_of_incidence = np.maximum(
-        np.einsum('kn, kn->n', incidence_vectors, normal_vectors), -1
-    )
-    incidence_angles = np.arccos(-vertical_of_incidence)
-
-    # 判断全反射
-    max_incidence_angle = np.arcsin(n_water/n_LS)
-    can_transmit = (incidence_angles < max_incidence_angle)
-    all_reflect = 1 - can_transmit
+    cos_i, cos_t, R = interface(velocities, normal_vectors, eta)
+    can_transmit = cos_t > 0
+    T = 1 - R
 
     #计算折射光，反射光矢量与位置
-    reflected_velocities = velocities - 2 * vertical_of_incidence * normal_vectors
+    reflected_velocities = reflect(velocities, normal_vectors, cos_i)
     reflected_coordinates = edge_points
 
-    delta = ne.evaluate('1 - eta**2 * (1 - vertical_of_incidence**2)')
-    new_velocities = ne.evaluate(
-        '(eta*incidence_vectors - (eta*vertical_of_incidence + sqrt(abs(delta))) * normal_vectors) * can_transmit'
-    ) #取绝对值避免出错
+    new_velocities = refract(velocities, normal_vectors, cos_i, cos_t, eta) * can_transmit
     new_coordinates = edge_points
 
-    # 计算折射系数
-    emergence_angles = np.arccos(np.minimum(np.einsum('kn, kn->n', new_velocities, -normal_vectors), 1))
-    Rs = ne.evaluate(
-        '(sin(emergence_angles - incidence_angles)/sin(emergence_angles + incidence_angles))**2'
-    )
-    Rp = ne.evaluate(
-        '(tan(emergence_angles - incidence_angles)/tan(emergence_angles + incidence_angles))**2'
-    )
-    R = (Rs+Rp) / 2
-    T = 1 - R
-
     # 计算折射光，反射光强度
-    new_intensities = np.einsum('n, n, n->n', intensities, T, can_transmit)
-    reflected_intensities = np.einsum('n, n, n->n', intensities, R, can_transmit) + all_reflect
+    new_intensities = intensities * T
+    reflected_intensities = intensities * R
 
     # 输出所有量，按需拿取
     return new_coordinates, new_velocities, new_intensities, new_times, \
@@ -130,9 +110,9 @@ def hit_PMT(coordinates, velocities, intensities, times, PMT_coordinates):
     allowed_times = times[hit_PMTs]
     allowed_PMT_coordinates = PMT_coordinates[:, :allowed_times.shape[0]]
 
-    # 计算到达时间
+    # 计算到达时间，到达点为光线与PMT球面的第一个交点
     PMT2edge = allowed_coordinates - allowed_PMT_coordinates
-    ts = -np.einsum('kn, kn->n', PMT2edge, allowed_velocities) +\
+    ts = -np.einsum('kn, kn->n', PMT2edge, allowed_velocities) -\
         np.sqrt(
             np.einsum('kn, kn->n', PMT2edge, allowed_velocities)**2 -\
             np.einsum('kn, kn->n', PMT2edge, PMT2edge) +\
@@ -141,23 +121,9 @@ def hit_PMT(coordinates, velocities, intensities, times, PMT_coordinates):
     all_times = allowed_times + (n_water/c)*ts
     edge_points = allowed_coordinates + ts * allowed_velocities
 
-    # 计算入射角，出射角
-    normal_vectors = (edge_points - allowed_PMT_coordinates) / r_PMT
-    incidence_vectors = allowed_velocities
-    incidence_angles = np.arccos(
-        -np.maximum(np.einsum('kn, kn->n', incidence_vectors, normal_vectors), -1)
-    )
-
     # Bonus: 计算进入PMT的折射系数
-    emergence_angles = np.arcsin((n_water/n_glass)*incidence_angles)
-    Rs = ne.evaluate(
-        '(sin(emergence_angles - incidence_angles)/sin(emergence_angles + incidence_angles))**2'
-    )
-    Rp = ne.evaluate(
-        '(tan(emergence_angles - incidence_angles)/tan(emergence_angles + incidence_angles))**2'
-    )
-    R = (Rs+Rp) / 2
-    T = 1 - R
+    normal_vectors = (edge_points - allowed_PMT_coordinates) / r_PMT
+    T = 1 - interface(allowed_velocities, normal_vectors, n_water/n_glass)[2]
 
     all_intensity = np.einsum('n, n->', allowed_intensities, T)
 
@@ -339,65 +305,57 @@ def gen_data(input_data):
     prob2, times2 = get_prob_time(x, y, z, PMT_phi, PMT_theta, 1, 150)
     return prob1, prob2, times1.mean(), times2.mean(), times1.std(), times2.std()
 
-def gen_interp():
+def gen_table(precision=100, processes=8):
     '''
-    生成插值函数，使用其中的插值函数来近似get_PE_probability与get_random_PE_time
-    生成的插值函数支持1D-array输入
+    在(r, theta)网格上模拟gen_data，theta为顶点与PMT的夹角
+    返回(ro, theta, tables)，tables形状为(6, ro.shape[0], precision)，
+    依次为gen_data给出的六个量
     '''
-    PRECISION = 100
-    print("正在生成插值函数...")
-
     # 插值用网格
     ro = np.concatenate(
         (
-            np.linspace(0.2, 16.5, PRECISION, endpoint=False),
-            np.linspace(16.5, Ri, PRECISION//2) # 在边缘处多取一些
+            np.linspace(0.2, 16.5, precision, endpoint=False),
+            np.linspace(16.5, Ri, precision//2) # 在边缘处多取一些
         )
     )
-    theta = np.linspace(0, np.pi, PRECISION)
+    theta = np.linspace(0, np.pi, precision)
     thetas, ros = np.meshgrid(theta, ro)
 
     # 测试点: yz平面
-    xs = np.zeros(PRECISION**2*3//2)
+    points = ros.size
+    xs = np.zeros(points)
     ys = (np.sin(thetas) * ros).flatten()
     zs = (np.cos(thetas) * ros).flatten()
 
-    prob_t, prob_r, mean_t, mean_r, std_t, std_r = np.zeros(
-        (6, PRECISION*3//2, PRECISION)
-    )
-
     # 多线程
-    pool = multiprocessing.Pool(8)
-
-    # 模拟光线
-    res = np.array(
-        list(
-            tqdm(
-                pool.imap(
-                    gen_data,
-                    np.stack(
-                        (
-                            xs,
-                            ys,
-                            zs,
-                            np.zeros(PRECISION**2*3//2),
-                            np.zeros(PRECISION**2*3//2)
-                        ),
-                        axis=-1
-                    )
-                ),
-                total=PRECISION**2*3//2
+    with multiprocessing.Pool(processes) as pool:
+        # 模拟光线
+        res = np.array(
+            list(
+                tqdm(
+                    pool.imap(
+                        gen_data,
+                        np.stack(
+                            (xs, ys, zs, np.zeros(points), np.zeros(points)),
+                            axis=-1
+                        )
+                    ),
+                    total=points
+                )
             )
         )
-    )
 
     # 储存插值点信息
-    prob_t = res[:, 0].reshape(-1, PRECISION)
-    prob_r = res[:, 1].reshape(-1, PRECISION)
-    mean_t = res[:, 2].reshape(-1, PRECISION)
-    mean_r = res[:, 3].reshape(-1, PRECISION)
-    std_t = res[:, 4].reshape(-1, PRECISION)
-    std_r = res[:, 5].reshape(-1, PRECISION)
+    return ro, theta, res.T.reshape(6, ro.shape[0], precision)
+
+def gen_interp(precision=100):
+    '''
+    生成插值函数，使用其中的插值函数来近似get_PE_probability与get_random_PE_time
+    生成的插值函数支持1D-array输入
+    '''
+    print("正在生成插值函数...")
+    ro, theta, tables = gen_table(precision)
+    prob_t, prob_r, mean_t, mean_r, std_t, std_r = tables
 
     # 插值函数
     get_prob_t = RectBivariateSpline(ro, theta, prob_t, kx=1, ky=1, bbox=[0, Ri, 0, np.pi]).ev
@@ -1,13 +1,66 @@
 '''
 genWaveform: 电子学任务，根据PETruth生成波形
 
-主要接口：get_waveform
+主要接口：get_waveform, get_waveform_bychunk（多进程）
+波形的合成方法见METHODS: 'dense'在(PE数, 1000)的网格上逐点计算双指数模型;
+'template'预先计算亚ns分辨率的脉冲模板，每个PE只把截断后插值的一段加到所在通道上;
+'fft'把每个通道的PE按起始采样点做直方图，对一个事件的所有通道批量地用rFFT与脉冲核卷积;
+'auto'对PE数不少于FFT_OCCUPANCY的通道用'fft'，其余用'template';
+'int'与'template'相同，但在int32定点数上用量化的模板累加，输出时饱和到int16并计数
+Waveform表按PETruth预先分配，按块压缩，由WaveformWriter整块写入，写入在后台线程中与合成重叠;
+可选的零压缩只保存超过阈值的各段采样点（SparseWaveformWriter），由readWaveform读取
+噪声可以取自预先生成的噪声库noise_bank，每行噪声只是库中随机偏移处的一段
 '''
+import atexit
 import multiprocessing as mp
+import queue
+import threading
+import time
+from functools import lru_cache
 import numpy as np
 from tqdm import tqdm
 import h5py
 import numexpr as ne
+from numba import njit
+from .rng import CounterRNG, STREAM_NOISE, STREAM_CONTROL_NOISE, STREAM_NOISE_BANK, \
+    STREAM_NOISE_OFFSET
+from .utils import share_array, attach_array, shard_bounds, cached_pool, close_pool, \
+    attach_inputs, single_thread, cache_path, load_cache, save_cache
+
+METHODS = ('dense', 'template', 'fft', 'auto', 'int') # 波形的合成方法
+NOISETYPES = ('normal', 'sin', 'bank') # 噪声形式
+WINDOW = 1000 # 每个波形的采样点数，采样间隔为1ns
+TEMPLATE_OVERSAMPLE = 100 # 模板每ns的点数，线性插值的误差约为1e-4*ampli/tr**2
+TEMPLATE_TOLERANCE = 1e-3 # 模板截断处脉冲的高度上界，远小于int16波形的分辨率
+QUANT_BITS = 12 # 'int'方法中定点数的小数位数，int32仍可累加约5e5 ADC，远超int16的范围
+FFT_LENGTH = 2048 # 卷积的rFFT长度，不小于2*WINDOW-1，避免循环卷积的混叠
+BLOCK_PES = 1 << 16 # 多进程时每段的PE数上限，每段的Waveform表约为每个PE 1KB
+BLOCKS_PER_WORKER = 4 # 多进程时每个进程至少分到几段，平衡各段的耗时差异
+WAVEFORM_DTYPE = np.dtype([
+    ('EventID', '<i4'),
+    ('ChannelID', '<i4'),
+    ('Waveform', '<i2', (WINDOW,))
+])
+BANK_SIZE = 1 << 22 # 噪声库的采样点数，float32共16MB，两行噪声的偏移相同的概率为1/BANK_SIZE
+BANK_SEED = 0 # 噪声库的种子，固定不变，因此噪声库可以缓存
+FFT_OCCUPANCY = 1024 # 'auto'中改用卷积的通道PE数，由benchmarks.bench_waveform的扫描得到
+COMPRESSIONS = ('gzip', 'lzf', 'none') # Waveform表的压缩方法
+COMPRESSION = 'gzip' # 默认的压缩方法，见benchmarks.bench_hdf5
+GZIP_LEVEL = 1 # gzip的压缩级别，噪声的熵限制了压缩率，更高的级别只是更慢
+SHUFFLE = False # 压缩前是否shuffle: 一行2008字节是一个元素，按元素shuffle反而压缩得更差更慢
+CHUNK_BYTES = 1 << 20 # Waveform表每块的大小上限，与HDF5默认的块缓存相同
+WRITE_CHUNKS = 16 # 每次写入的块数
+WRITER_DEPTH = 2 # 后台写入线程的队列长度，2即双缓冲: 写入上一段时合成下一段
+ZS_THRESHOLD = 50 # 零压缩的默认阈值/ADC，默认噪声标准差的5倍，脉冲峰值约为ampli的0.38
+ZS_PRE = 4 # 零压缩时超过阈值的采样点之前保留的点数
+ZS_POST = 20 # 零压缩时超过阈值的采样点之后保留的点数，约两个td，脉冲尾部已低于噪声
+SEGMENT_DTYPE = np.dtype([
+    ('EventID', '<i4'),
+    ('ChannelID', '<i4'),
+    ('Start', '<i2'),
+    ('Length', '<i2'),
+    ('Offset', '<i8')
+])
 
 
 def double_exp_model(t, ampli=1000, td=10, tr=5):
@@ -28,6 +81,213 @@ def double_exp_model(t, ampli=1000, td=10, tr=5):
     return ne.evaluate('(t > 0) * ampli * exp(- t / td) * (1 - exp(- t / tr))')
 
 
+@lru_cache(maxsize=None)
+def pulse_template(ampli=1000, td=10, tr=5):
+    '''
+    双指数模型的脉冲模板，每组(ampli, td, tr)只计算一次
+
+    返回: 形状为(TEMPLATE_OVERSAMPLE+1, 宽度)的数组，
+    第r行第m列为f(r/TEMPLATE_OVERSAMPLE + m)，宽度取到脉冲低于TEMPLATE_TOLERANCE为止
+    '''
+    width = int(np.ceil(td * np.log(max(ampli, TEMPLATE_TOLERANCE) / TEMPLATE_TOLERANCE))) + 1
+    width = min(width, WINDOW)
+    t = np.arange(TEMPLATE_OVERSAMPLE + 1).reshape(-1, 1) / TEMPLATE_OVERSAMPLE + np.arange(width)
+    return double_exp_model(t, ampli, td, tr)
+
+
+@lru_cache(maxsize=None)
+def quantized_template(ampli=1000, td=10, tr=5):
+    '''
+    pulse_template量化为QUANT_BITS位小数的int32定点数
+    '''
+    return np.rint(pulse_template(ampli, td, tr) * (1 << QUANT_BITS)).astype(np.int32)
+
+
+@lru_cache(maxsize=None)
+def pulse_spectra(ampli=1000, td=10, tr=5):
+    '''
+    双指数模型写成两个指数之差: f(t) = ampli*exp(-t/td) - ampli*exp(-t/tau), 1/tau = 1/td + 1/tr
+    每组(ampli, td, tr)只计算一次
+
+    返回: (各分量的衰减时间, 各分量的幅度, 各分量的核exp(-m/tau)在FFT_LENGTH上的rFFT)
+    '''
+    taus = np.array([td, 1 / (1/td + 1/tr)])
+    amplitudes = np.array([ampli, -ampli])
+    kernels = np.exp(-np.arange(WINDOW) / taus.reshape(-1, 1))
+    return taus, amplitudes, np.fft.rfft(kernels, FFT_LENGTH)
+
+
+def convolve_pulses(traces, rows, times, ampli=1000, td=10, tr=5):
+    '''
+    把PE的脉冲加到第rows个通道的波形traces上: 每个通道按PE之后的第一个采样点做直方图，
+    与脉冲核做批量的rFFT卷积
+    指数脉冲在采样点之间的平移只改变幅度，PE在直方图中的权重为exp(-x/tau)，
+    x为PE到该采样点的时间，因此对每个分量的卷积都是精确的，没有插值与截断误差
+    '''
+    taus, amplitudes, spectra = pulse_spectra(ampli, td, tr)
+    channels, local = np.unique(rows, return_inverse=True)
+    bins = np.maximum(np.floor(times).astype(np.int64) + 1, 0)
+    inside = bins < WINDOW
+    flat = local[inside] * WINDOW + bins[inside]
+    offsets = bins[inside] - times[inside]
+
+    histograms = np.stack([
+        np.bincount(flat, np.exp(-offsets / tau), len(channels) * WINDOW)
+        for tau in taus
+    ]).reshape(len(taus), len(channels), WINDOW)
+    pulses = np.fft.irfft(
+        np.fft.rfft(histograms, FFT_LENGTH) * spectra[:, None, :], FFT_LENGTH
+    )[..., :WINDOW]
+    traces[channels] += np.tensordot(amplitudes, pulses, 1)
+
+
+@njit(cache=True, nogil=True)
+def add_pulses(traces, rows, times, template, noise, pulse):
+    '''
+    把每个PE的噪声行加到第rows[j]个通道的波形traces上，pulse[j]为True时再加上它的脉冲
+    noise没有行时不加噪声
+    PE时间之后的第一个采样点在模板中的位置对所有采样点相同，只需插值一次
+    '''
+    oversample = template.shape[0] - 1
+    width = template.shape[1]
+    length = traces.shape[1]
+    for j in range(times.shape[0]):
+        c = rows[j]
+        if noise.shape[0] > 0:
+            for k in range(length):
+                traces[c, k] += noise[j, k]
+        if not pulse[j]:
+            continue
+        start = int(np.floor(times[j])) + 1
+        if start >= length:
+            continue
+        p = (start - times[j]) * oversample
+        i = min(int(p), oversample - 1)
+        w = p - i
+        for k in range(max(start, 0), min(start + width, length)):
+            m = k - start
+            traces[c, k] += template[i, m] * (1 - w) + template[i + 1, m] * w
+
+
+@njit(cache=True, nogil=True)
+def add_bank_noise(traces, rows, bank, offsets, scale):
+    '''
+    把取自噪声库的噪声行scale*bank[offsets[j]:offsets[j]+WINDOW]加到第rows[j]个通道的波形上
+    '''
+    length = traces.shape[1]
+    for j in range(rows.shape[0]):
+        c = rows[j]
+        o = offsets[j]
+        for k in range(length):
+            traces[c, k] += scale * bank[o + k]
+
+
+@njit(cache=True, nogil=True)
+def accumulate_int(traces, rows, times, template, noise, bank, offsets, scale):
+    '''
+    'int'方法: 把每个PE的噪声行与脉冲以QUANT_BITS位小数的定点数加到int32的traces上
+    noise有行时为各PE的噪声行，否则第j行噪声为scale*bank[offsets[j]:offsets[j]+WINDOW];
+    template为quantized_template，在相邻两行之间用整数权重插值
+    '''
+    one = 1 << QUANT_BITS
+    oversample = template.shape[0] - 1
+    width = template.shape[1]
+    length = traces.shape[1]
+    for j in range(times.shape[0]):
+        c = rows[j]
+        if noise.shape[0] > 0:
+            for k in range(length):
+                traces[c, k] += int(np.rint(noise[j, k] * one))
+        else:
+            o = offsets[j]
+            for k in range(length):
+                traces[c, k] += int(np.rint(bank[o + k] * scale * one))
+        start = int(np.floor(times[j])) + 1
+        if start >= length:
+            continue
+        p = int((start - times[j]) * oversample * one)
+        i = min(p >> QUANT_BITS, oversample - 1)
+        w = p - (i << QUANT_BITS)
+        for k in range(max(start, 0), min(start + width, length)):
+            m = k - start
+            traces[c, k] += (template[i, m] * (one - w) + template[i + 1, m] * w) >> QUANT_BITS
+
+
+@njit(cache=True, nogil=True)
+def saturate(traces, out):
+    '''
+    把定点数的traces向0取整（同float到int16的转换），饱和到int16的范围后写入out
+    返回饱和的采样点数
+    '''
+    saturated = 0
+    for c in range(traces.shape[0]):
+        for k in range(traces.shape[1]):
+            v = traces[c, k]
+            v = v >> QUANT_BITS if v >= 0 else -((-v) >> QUANT_BITS)
+            if v > 32767:
+                v = 32767
+                saturated += 1
+            elif v < -32768:
+                v = -32768
+                saturated += 1
+            out[c, k] = v
+    return saturated
+
+
+def synthesize(PETime, ChannelID, noise, ampli=1000, td=10, tr=5, method='dense'):
+    '''
+    合成一个事件的波形
+
+    输入: PETime, ChannelID, 事件中各PE的时间与通道;
+    noise, 各PE的噪声行, (PE数, WINDOW)的数组或BankNoise;
+
+    参数: ampli, td, tr, 双指数模型的参数; method, METHODS之一.
+
+    返回: (Channels, 各通道的波形), 同一通道的PE的脉冲与噪声相加;
+    'int'方法的波形为QUANT_BITS位小数的int32定点数, 由saturate转为int16
+    '''
+    Channels, idx = np.unique(ChannelID, return_inverse=True)
+    if method == 'int':
+        result = np.zeros((len(Channels), WINDOW), dtype=np.int32)
+        times = np.asarray(PETime, dtype=np.float64)
+        if isinstance(noise, BankNoise):
+            accumulate_int(result, idx, times, quantized_template(ampli, td, tr),
+                           np.empty((0, WINDOW)), noise.bank, noise.offsets, noise.scale)
+        else:
+            accumulate_int(result, idx, times, quantized_template(ampli, td, tr),
+                           np.asarray(noise, dtype=np.float64), np.empty(0, dtype=np.float32),
+                           np.empty(0, dtype=np.int64), 1.0)
+        return Channels, result
+    if method != 'dense':
+        result = np.zeros((len(Channels), WINDOW))
+        if isinstance(noise, BankNoise):
+            # 噪声直接从噪声库加到各通道上，不展开为(PE数, WINDOW)的矩阵
+            add_bank_noise(result, idx, noise.bank, noise.offsets, noise.scale)
+            noise = np.empty((0, WINDOW))
+        times = np.asarray(PETime, dtype=np.float64)
+        if method == 'template':
+            pulse = np.ones(times.shape[0], dtype=bool)
+        elif method == 'fft':
+            pulse = np.zeros(times.shape[0], dtype=bool)
+        else:
+            pulse = np.bincount(idx)[idx] < FFT_OCCUPANCY
+        add_pulses(result, idx, times, pulse_template(ampli, td, tr), noise, pulse)
+        if not pulse.all():
+            convolve_pulses(result, idx[~pulse], times[~pulse], ampli, td, tr)
+        return Channels, result
+
+    t = np.arange(WINDOW)
+    Waveform = np.asarray(noise) + double_exp_model(t - PETime.reshape(-1, 1), ampli, td, tr)
+
+    # numpy groupby
+    # ref:
+    # https://stackoverflow.com/questions/58546957/sum-of-rows-based-on-index-with-numpy
+    order = np.argsort(idx)
+    breaks = np.flatnonzero(np.concatenate(([1], np.diff(idx[order]))))
+    # 同Channel波形相加
+    return Channels, np.add.reduceat(Waveform[order], breaks, axis=0)
+
+
 def sin_noise(t, period=np.pi/1e30, ampli=1e-2):
     '''
     噪声 noise(t; period, ampli)
@@ -44,25 +304,486 @@ def sin_noise(t, period=np.pi/1e30, ampli=1e-2):
     return ampli * np.sin(2 * np.pi / period * t)
 
 
-def normal_noise(t, sigma=5):
+def normal_noise(t, sigma=5, rng=None, event=None):
     '''
     噪声 noise(t; sigma)
 
-    输入: t, 时间;
+    输入: t, 时间, 形状为(行数, 采样点数);
 
     参数:
-    sigma, 标准差
+    sigma, 标准差;
+    rng, CounterRNG, 为None时使用numpy的全局随机数;
+    event, EventID, 为None时给出各event相同的噪声.
 
     返回:
-    noise(t) = N(0, sigma^2)
+    noise(t) = N(0, sigma^2), 由(event, 行, t)唯一确定
+    '''
+    if rng is None:
+        return np.random.normal(0, sigma, t.shape)
+    rows = np.arange(t.shape[0]).reshape(-1, 1)
+    if event is None:
+        return sigma * rng.normal(STREAM_CONTROL_NOISE, 0, rows, t)
+    return sigma * rng.normal(STREAM_NOISE, event, rows, t)
+
+
+@lru_cache(maxsize=None)
+def noise_bank(size=BANK_SIZE, persist=True):
+    '''
+    噪声库: 由固定的种子BANK_SEED生成的size个标准正态噪声, float32,
+    末尾再接上开头的WINDOW-1个点成为环形缓冲区, 从任意偏移开始都能取到连续的WINDOW个点
+    与模拟的种子无关, persist为True时缓存在CACHE_DIR中, 各次模拟共用
+    '''
+    path = cache_path('noise-bank', size, BANK_SEED, WINDOW)
+    bank = load_cache(path) if persist else None
+    if bank is None:
+        rng = CounterRNG(BANK_SEED)
+        bank = np.empty(size + WINDOW - 1, dtype=np.float32)
+        # 分段生成，限制临时数组的大小
+        for start in range(0, size, 1 << 20):
+            stop = min(start + (1 << 20), size)
+            bank[start:stop] = rng.normal(STREAM_NOISE_BANK, 0, np.arange(start, stop))
+        bank[size:] = bank[:WINDOW - 1]
+        if persist:
+            save_cache(path, bank)
+    return bank
+
+
+class BankNoise:
+    '''
+    取自噪声库的若干行噪声: 第j行为scale*bank[offsets[j]:offsets[j]+WINDOW], 不展开为矩阵
+    切片给出其中若干行, np.asarray展开为(行数, WINDOW)的矩阵
+    不同的行偏移不同时互不相同; 偏移相近的两行在时间上错开, 同一采样点上仍然独立
+    '''
+
+    def __init__(self, bank, offsets, scale):
+        self.bank = bank
+        self.offsets = offsets
+        self.scale = scale
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, rows):
+        return BankNoise(self.bank, self.offsets[rows], self.scale)
+
+    def __array__(self, dtype=None, copy=None):
+        rows = self.scale * self.bank[self.offsets.reshape(-1, 1) + np.arange(WINDOW)].astype(np.float64)
+        return rows if dtype is None else rows.astype(dtype, copy=False)
+
+
+def bank_noise(count, sigma, rng=None, event=None, bank=None):
+    '''
+    从噪声库中取count行标准差为sigma的噪声, 每行只需一个随机数
+    rng, CounterRNG, 为None时使用numpy的全局随机数;
+    event, EventID, 为None时给出各event相同的噪声;
+    bank, 噪声库, 默认为noise_bank().
     '''
-    return np.random.normal(0, sigma, t.shape)
+    if bank is None:
+        bank = noise_bank()
+    size = len(bank) - WINDOW + 1
+    rows = np.arange(count)
+    if rng is None:
+        offsets = np.random.randint(0, size, count)
+    elif event is None:
+        offsets = (rng.random(STREAM_NOISE_OFFSET, 0, rows, 1) * size).astype(np.int64)
+    else:
+        offsets = (rng.random(STREAM_NOISE_OFFSET, event, rows, 0) * size).astype(np.int64)
+    return BankNoise(bank, offsets, sigma)
+
+
+def make_noise(t, ratio=1e-2, ampli=1000, noisetype='normal', rng=None, event=None):
+    '''
+    按noisetype给出采样时间t上的噪声，振幅为ratio*ampli
+    event为None时给出各event相同的噪声
+    '''
+    if noisetype == 'sin':
+        return sin_noise(t, np.pi/1e30, ratio * ampli)
+    if noisetype != 'normal':
+        print(f'{noisetype} noise not implemented, use normal noise instead!')
+    return normal_noise(t, ratio * ampli, rng, event)
+
+
+def noise_rows(count, ratio=1e-2, ampli=1000, noisetype='normal', rng=None, event=None, bank=None):
+    '''
+    给出count行噪声: noisetype为'bank'时为取自噪声库bank的BankNoise, 否则为make_noise的矩阵
+    event为None时给出各event相同的噪声
+    '''
+    if noisetype == 'bank':
+        return bank_noise(count, ratio * ampli, rng, event, bank)
+    return make_noise(np.tile(np.arange(WINDOW), (count, 1)), ratio, ampli, noisetype, rng, event)
+
+
+def common_noise(PETruth, ratio=1e-2, ampli=1000, noisetype='normal', controlnoise=True, rng=None):
+    '''
+    预先制备各event共用的噪声，行数为PE最多的事件的PE数; controlnoise为False时为None
+    '''
+    if not controlnoise:
+        return None
+    maxlength = np.max(np.unique(PETruth['EventID'], return_counts=True)[1], initial=0)
+    return noise_rows(maxlength, ratio, ampli, noisetype, rng)
+
+
+def event_waveforms(PETruth, noise_0, rng, ampli=1000, td=10, tr=5, ratio=1e-2,
+                    noisetype='normal', method='dense', bank=None, tally=None):
+    '''
+    逐个事件给出PETruth中各事件的Waveform表
+    noise_0为各event共用的噪声，为None时每个事件的噪声由rng与EventID决定
+    bank为noisetype为'bank'时的噪声库，默认为noise_bank()
+    tally为dict时，'int'方法饱和的采样点数累加到tally['saturated']
+    '''
+    Events, Eindex = np.unique(PETruth['EventID'], return_index=True)
+    Eindex = np.append(Eindex, len(PETruth))
+    for i, event in enumerate(Events):
+        PEs = PETruth[Eindex[i]:Eindex[i+1]]
+        if noise_0 is None:
+            noise = noise_rows(len(PEs), ratio, ampli, noisetype, rng, event, bank)
+        else:
+            noise = noise_0[:len(PEs)]
+
+        # 生成Waveform，同Channel波形相加
+        Channels, result = synthesize(
+            PEs['PETime'], PEs['ChannelID'], noise, ampli, td, tr, method
+        )
+
+        # 拼接WF表
+        WF = np.empty(len(Channels), dtype=WAVEFORM_DTYPE)
+        WF['EventID'] = event
+        WF['ChannelID'] = Channels
+        if method == 'int':
+            saturated = saturate(result, WF['Waveform'])
+            if tally is not None:
+                tally['saturated'] = tally.get('saturated', 0) + saturated
+        else:
+            WF['Waveform'] = result
+        yield WF
+
+
+def dataset_options(compression=COMPRESSION, shuffle=SHUFFLE):
+    '''
+    create_dataset的压缩参数，compression为COMPRESSIONS之一
+    '''
+    if compression not in COMPRESSIONS:
+        raise ValueError(f'Unknown compression {compression}')
+    if compression == 'none':
+        return {}
+    return dict(
+        compression=compression, shuffle=shuffle,
+        compression_opts=GZIP_LEVEL if compression == 'gzip' else None
+    )
+
+
+def count_waveforms(PETruth):
+    '''
+    给出PETruth对应的Waveform表的行数（不同的(EventID, ChannelID)数）与事件数
+    '''
+    keys = (PETruth['EventID'].astype(np.int64) << 32) | PETruth['ChannelID']
+    return len(np.unique(keys)), len(np.unique(PETruth['EventID']))
+
+
+class WaveformWriter:
+    '''
+    Waveform表的写入者: 按预先算出的行数一次建好（或扩大）Waveform表，
+    WF先攒在缓冲区中，凑满WRITE_CHUNKS个块再按块的边界整块写入，
+    压缩的块不会被部分写入后再读出重写
+    新建的表按块压缩，每块约为一个事件的通道数，至多CHUNK_BYTES，
+    读取一个事件只需解压少数几个块
+
+    参数:
+    f, 打开的hdf5文件;
+    rows, 将写入的行数;
+    events, 将写入的事件数，用于确定块的大小;
+    compression, COMPRESSIONS之一，'none'不压缩;
+    shuffle, 压缩前是否做HDF5的shuffle.
+    '''
+
+    def __init__(self, f, rows, events=1, compression=COMPRESSION, shuffle=SHUFFLE):
+        options = dataset_options(compression, shuffle)
+        if 'Waveform' not in f:
+            chunk = int(np.clip(round(rows / max(events, 1)), 1,
+                                CHUNK_BYTES // WAVEFORM_DTYPE.itemsize))
+            self.dataset = f.create_dataset(
+                'Waveform', (rows,), maxshape=(None,), dtype=WAVEFORM_DTYPE,
+                chunks=(chunk,), **options
+            )
+        else:
+            # 已有Waveform表时接在后面写（分块模拟），沿用原有的块与压缩设置
+            self.dataset = f['Waveform']
+            self.dataset.resize(self.dataset.shape[0] + rows, axis=0)
+        self.stop = self.dataset.shape[0]
+        self.position = self.stop - rows
+        self.block = self.dataset.chunks[0] * WRITE_CHUNKS
+        self.buffer = np.empty(min(self.block, rows), dtype=WAVEFORM_DTYPE)
+        self.filled = 0
+
+    def write(self, WF):
+        '''
+        按顺序写入WF，缓冲区为空且WF覆盖整块时直接写入
+        '''
+        while len(WF) > 0:
+            end = min((self.position // self.block + 1) * self.block, self.stop)
+            take = min(end - self.position - self.filled, len(WF))
+            if self.filled == 0 and take == end - self.position:
+                self.dataset[self.position:end] = WF[:take]
+                self.position = end
+            else:
+                self.buffer[self.filled:self.filled + take] = WF[:take]
+                self.filled += take
+                if self.position + self.filled == end:
+                    self.flush()
+            WF = WF[take:]
+
+    def flush(self):
+        '''
+        写入缓冲区中的WF
+        '''
+        if self.filled > 0:
+            self.dataset[self.position:self.position + self.filled] = self.buffer[:self.filled]
+            self.position += self.filled
+            self.filled = 0
+
+    def close(self):
+        '''
+        写入剩余的WF，检查写入的行数与预先分配的相同
+        '''
+        self.flush()
+        if self.position != self.stop:
+            raise ValueError(f'Waveform table has {self.stop - self.position} rows left unwritten')
+
+
+def suppress(WF, threshold=ZS_THRESHOLD, pre=ZS_PRE, post=ZS_POST):
+    '''
+    零压缩: 只保留每个通道中超过threshold的采样点及其前pre、后post个点
+
+    输入: WF, Waveform表;
+
+    返回: (segments, samples)
+    segments, SEGMENT_DTYPE的表, 每段连续保留的采样点一行, 按(EventID, ChannelID, Start)排序,
+              Start为段在波形中的起点, Offset为段在samples中的起点, 没有保留任何点的通道记一个空段;
+    samples, 各段的采样点依次拼接, '<i2'.
+    '''
+    traces = WF['Waveform']
+    # 第k个点保留，当且仅当[k-post, k+pre]中有超过阈值的点
+    crossed = np.zeros((len(WF), WINDOW + 1), dtype=np.int16)
+    np.cumsum(traces > threshold, axis=1, out=crossed[:, 1:])
+    k = np.arange(WINDOW)
+    keep = crossed[:, np.minimum(k + pre + 1, WINDOW)] > crossed[:, np.maximum(k - post, 0)]
+
+    edges = np.diff(keep.astype(np.int8), axis=1, prepend=0, append=0)
+    rows, starts = np.nonzero(edges == 1)
+    stops = np.nonzero(edges == -1)[1]
+    empty = np.flatnonzero(~keep.any(axis=1))
+    order = np.argsort(np.concatenate((rows, empty)), kind='stable')
+    rows = np.concatenate((rows, empty))[order]
+
+    segments = np.empty(len(rows), dtype=SEGMENT_DTYPE)
+    segments['EventID'] = WF['EventID'][rows]
+    segments['ChannelID'] = WF['ChannelID'][rows]
+    segments['Start'] = np.concatenate((starts, np.zeros(len(empty), dtype=starts.dtype)))[order]
+    segments['Length'] = np.concatenate((stops - starts, np.zeros(len(empty), dtype=starts.dtype)))[order]
+    segments['Offset'] = np.cumsum(segments['Length']) - segments['Length']
+    return segments, traces[keep]
+
+
+class SparseWaveformWriter:
+    '''
+    零压缩的Waveform的写入者，代替WaveformWriter，数据写入两个表:
+    WaveformSegments, SEGMENT_DTYPE, 各段的位置; WaveformSamples, '<i2', 各段的采样点
+    段数与采样点数事先未知，攒够WRITE_CHUNKS个块的采样点再扩大两个表并写入
+    已有这两个表时接在后面写，Offset接着已有的采样点计
+
+    参数:
+    f, 打开的hdf5文件;
+    threshold, 零压缩的阈值/ADC;
+    compression, shuffle, 同WaveformWriter.
+    '''
+
+    def __init__(self, f, threshold=ZS_THRESHOLD, compression=COMPRESSION, shuffle=SHUFFLE):
+        options = dataset_options(compression, shuffle)
+        self.threshold = threshold
+        self.tables = []
+        for name, dtype in (('WaveformSegments', SEGMENT_DTYPE), ('WaveformSamples', np.dtype('<i2'))):
+            if name not in f:
+                f.create_dataset(
+                    name, (0,), maxshape=(None,), dtype=dtype,
+                    chunks=(CHUNK_BYTES // dtype.itemsize,), **options
+                )
+            self.tables.append(f[name])
+        self.block = CHUNK_BYTES // 2 * WRITE_CHUNKS
+        self.pending = []
+        self.pending_samples = 0
+
+    def write(self, WF):
+        '''
+        零压缩后写入WF
+        '''
+        self.write_segments(*suppress(WF, self.threshold))
+
+    def write_segments(self, segments, samples):
+        '''
+        写入已经零压缩的一段，segments['Offset']从0开始
+        '''
+        self.pending.append((segments, samples))
+        self.pending_samples += len(samples)
+        if self.pending_samples >= self.block:
+            self.flush()
+
+    def flush(self):
+        '''
+        把缓冲的各段写入文件
+        '''
+        if len(self.pending) == 0:
+            return
+        segment_table, sample_table = self.tables
+        offset = sample_table.shape[0]
+        segments = np.concatenate([part[0] for part in self.pending])
+        samples = np.concatenate([part[1] for part in self.pending])
+        # 每一部分的Offset接着之前各部分的采样点计
+        shifts = np.cumsum([0] + [len(part[1]) for part in self.pending[:-1]])
+        segments['Offset'] += offset + np.repeat(shifts, [len(part[0]) for part in self.pending])
+        for table, data in ((segment_table, segments), (sample_table, samples)):
+            table.resize(table.shape[0] + len(data), axis=0)
+            table[table.shape[0] - len(data):] = data
+        self.pending = []
+        self.pending_samples = 0
+
+    def close(self):
+        '''
+        写入剩余的各段
+        '''
+        self.flush()
+
+
+class BackgroundWriter:
+    '''
+    在后台线程中调用writer（WaveformWriter或SparseWaveformWriter）的写入:
+    主线程只把各段放入至多depth段的队列就继续合成，写入上一段与合成下一段重叠，
+    depth为2即双缓冲，depth为0时在主线程中同步写入，用于比较
+    HDF5的写入与带nogil的numba内核运行时都不占用GIL，两个线程才能同时运行
+    用with语句使用: 正常结束时写完队列中的各段并关闭writer，后台写入出错时在主线程中抛出;
+    主线程出错时丢弃队列中剩余的段
+
+    stats: blocks, 写入的段数; write, 写入的总用时/s; stall, 主线程等待写入的总用时/s
+    overlap按墙钟时间计，单核上两个线程只是分时运行，实际节省的时间见benchmarks.bench_writer
+    '''
+
+    def __init__(self, writer, depth=WRITER_DEPTH):
+        self.writer = writer
+        self.depth = depth
+        self.stats = dict(blocks=0, write=0.0, stall=0.0)
+        self.error = None
+        self.cancelled = False
+        if depth > 0:
+            self.queue = queue.Queue(depth)
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        # submit可能因后台写入已出错而抛出，此时仍要结束后台线程，再抛出它的异常
+        try:
+            if exc_type is None:
+                self.submit(self.writer.close)
+            else:
+                self.cancelled = True
+        finally:
+            self.stop(exc_type is None)
+
+    def run(self):
+        '''
+        后台线程: 依次执行队列中的写入，出错或取消后丢弃其余的段
+        '''
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is None and not self.cancelled:
+                self.execute(*item)
+
+    def execute(self, method, *args):
+        '''
+        执行一次写入并计时，异常记在self.error中
+        '''
+        begin = time.perf_counter()
+        try:
+            method(*args)
+        except Exception as error:
+            self.error = error
+        self.stats['write'] += time.perf_counter() - begin
+
+    def submit(self, method, *args):
+        '''
+        把一次写入放入队列（depth为0时直接执行），队列满时等待
+        '''
+        if self.error is not None:
+            raise self.error
+        begin = time.perf_counter()
+        if self.depth > 0:
+            self.queue.put((method,) + args)
+        else:
+            self.execute(method, *args)
+        self.stats['stall'] += time.perf_counter() - begin
+        if self.error is not None:
+            raise self.error
+
+    def write(self, WF):
+        '''
+        写入WF，同writer.write
+        '''
+        self.submit(self.writer.write, WF)
+        self.stats['blocks'] += 1
+
+    def write_segments(self, segments, samples):
+        '''
+        写入已经零压缩的一段，同SparseWaveformWriter.write_segments
+        '''
+        self.submit(self.writer.write_segments, segments, samples)
+        self.stats['blocks'] += 1
+
+    def stop(self, check=True):
+        '''
+        等待后台线程写完，check为True时抛出写入中的异常
+        '''
+        if self.depth > 0:
+            begin = time.perf_counter()
+            # 后台线程意外退出时队列可能一直是满的，不能无限等待
+            while self.thread.is_alive():
+                try:
+                    self.queue.put(None, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            self.thread.join()
+            self.stats['stall'] += time.perf_counter() - begin
+        if check and self.error is not None:
+            raise self.error
+
+    @property
+    def overlap(self):
+        '''
+        写入的用时中与合成重叠的比例，即主线程不必等待的部分
+        '''
+        if self.stats['write'] == 0:
+            return 0.0
+        return min(max(1 - self.stats['stall'] / self.stats['write'], 0.0), 1.0)
+
+    def report(self):
+        '''
+        一行的重叠情况
+        '''
+        return (f"写入{self.stats['blocks']}段，用时{self.stats['write']:.2f}s，"
+                f"主线程等待{self.stats['stall']:.2f}s，重叠{self.overlap:.0%}")
 
 
 def get_waveform(filename, PETruth, ampli=1000, td=10, tr=5,
-                 ratio=1e-2, noisetype='normal', controlnoise=True):
+                 ratio=1e-2, noisetype='normal', controlnoise=True, rng=None,
+                 method='dense', workers=1, compression=COMPRESSION, zero_suppress=None,
+                 depth=WRITER_DEPTH):
     '''
     根据PETruth单进程生成波形(对于每个Event分步进行,以节省内存)并保存
+    文件中已有Waveform表时追加写入，Waveform表按PETruth预先分配，由WaveformWriter整块写入;
+    零压缩时改由SparseWaveformWriter写入，用readWaveform.SparseWaveform读取
 
     输入: PETruth (Structured Array) [EventID, ChannelID, PETime]
 
@@ -71,290 +792,202 @@ def get_waveform(filename, PETruth, ampli=1000, td=10, tr=5,
     td, 整体衰减时间;
     tr, 峰值位置;
     ratio, 噪声振幅/波形高度;
-    noisetype, 噪声形式: 'normal' 正态分布噪声, 'sin' 正弦噪声;
+    noisetype, 噪声形式, NOISETYPES之一: 'normal' 正态分布噪声, 'sin' 正弦噪声,
+               'bank' 取自噪声库noise_bank的正态分布噪声, 每行噪声只需一个随机数;
     controlnoise, 是否对噪声控制变量: True则噪声event-wise相同,
                                       False则噪声event-wise随机,
-                  无论如何channel-wise均随机.
+                  无论如何channel-wise均随机;
+    rng, CounterRNG, 噪声由(seed, EventID, 行, 采样点)决定;
+    method, 波形的合成方法, METHODS之一, 结果只差模板的插值与截断误差,
+            'int'方法饱和的采样点数累加到文件的saturated属性中;
+    workers, 大于1时由get_waveform_bychunk多进程生成, 结果相同;
+    compression, 新建Waveform表时的压缩方法, COMPRESSIONS之一;
+    zero_suppress, 零压缩的阈值/ADC, 为None时保存完整的波形;
+    depth, 后台写入线程BackgroundWriter的队列长度, 为0时在主线程中同步写入.
 
     返回:
     无
     '''
-    print("正在生成波形...")
-    # Event切割
-    EventID = PETruth['EventID']
-
-    Events, Eindex = np.unique(EventID, return_index=True)
-    Eindex = np.hstack([Eindex, np.array(len(EventID))])
-
-    # 预先制备时间采样和噪声以加速
-    maxlength = np.max(Eindex[1:] - Eindex[:-1])
-    t0 = np.tile(np.arange(0, 1000, 1), (maxlength, 1))
-    if controlnoise:
-        if noisetype == 'normal':
-            noise_0 = normal_noise(t0, ratio * ampli)
-        elif noisetype == 'sin':
-            noise_0 = sin_noise(t0, np.pi/1e30, ratio * ampli)
-        else:
-            print(f'{noisetype} noise not implemented, use normal noise instead!')
-            noise_0 = normal_noise(t0, ratio * ampli)
-
-    init = True
-
-    f = h5py.File(filename, "a")
-
-    # 读取PETruth
-    for i in tqdm(range(len(Eindex)-1)):
-        # 采样
-        length = Eindex[i+1] - Eindex[i]
-        t = t0[:length]
-
-        if not controlnoise:
-            if noisetype == 'normal':
-                noise_0 = normal_noise(t, ratio * ampli)
-            elif noisetype == 'sin':
-                noise_0 = sin_noise(t, np.pi/1e30, ratio * ampli)
-            else:
-                print(f'{noisetype} noise not implemented, use normal noise instead!')
-                noise_0 = normal_noise(t, ratio * ampli)
-
-        # 生成Waveform
-        Waveform = noise_0[:length] + double_exp_model(
-            t - PETruth[Eindex[i]:Eindex[i+1]]['PETime'].reshape(-1, 1),
-            ampli,
-            td,
-            tr
+    if workers > 1:
+        get_waveform_bychunk(
+            filename, PETruth, ampli, td, tr, ratio, noisetype, controlnoise, rng, method, workers,
+            compression, zero_suppress, depth
         )
+        return
 
-        # numpy groupby
-        # ref:
-        # https://stackoverflow.com/questions/58546957/sum-of-rows-based-on-index-with-numpy
-        Channels, idx = np.unique(
-            PETruth[Eindex[i]:Eindex[i+1]]['ChannelID'],
-            return_inverse=True
-        )
-        order = np.argsort(idx)
-        breaks = np.flatnonzero(np.concatenate(([1], np.diff(idx[order]))))
-        # 同Channel波形相加
-        result = np.add.reduceat(Waveform[order], breaks, axis=0)
-
-        # 拼接WF表
-        WF = np.empty(
-            len(Channels),
-            dtype=[('EventID', '<i4'),
-                   ('ChannelID', '<i4'),
-                   ('Waveform', '<i2', (1000,))]
+    print("正在生成波形...")
+    if rng is None:
+        rng = CounterRNG()
+
+    # 预先制备噪声以加速
+    noise_0 = common_noise(PETruth, ratio, ampli, noisetype, controlnoise, rng)
+
+    rows, events = count_waveforms(PETruth)
+    if rows == 0:
+        return
+    with h5py.File(filename, "a") as f:
+        tally = {}
+        waveforms = event_waveforms(
+            PETruth, noise_0, rng, ampli, td, tr, ratio, noisetype, method, tally=tally
         )
-        WF['EventID'] = np.ones(len(Channels))*Events[i]
-        WF['ChannelID'] = Channels
-        WF['Waveform'] = result
-
-        if init:
-            # 初始化Waveform表
-            wfds = f.create_dataset(
-                'Waveform',
-                (len(WF),),
-                maxshape=(None,),
-                dtype=np.dtype(
-                    [('EventID', '<i4'),
-                     ('ChannelID', '<i4'),
-                     ('Waveform', '<i2', (1000,))]
-                )
-            )
-            init = False
-        else:
-            # 扩大Waveform表
-            wfds.resize(wfds.shape[0] + len(WF), axis=0)
+        writer = BackgroundWriter(open_writer(f, rows, events, compression, zero_suppress), depth)
+        with writer:
+            for WF in tqdm(waveforms, total=events):
+                writer.write(WF)
+        print(writer.report())
+        if method == 'int':
+            record_saturation(f, tally.get('saturated', 0))
 
-        # 写入WF
-        wfds[-len(WF):] = WF
 
-    f.close()
+def open_writer(f, rows, events, compression=COMPRESSION, zero_suppress=None):
+    '''
+    zero_suppress为None时给出WaveformWriter，否则给出以它为阈值的SparseWaveformWriter
+    '''
+    if zero_suppress is None:
+        return WaveformWriter(f, rows, events, compression)
+    return SparseWaveformWriter(f, zero_suppress, compression)
 
 
+def record_saturation(f, saturated):
+    '''
+    把'int'方法饱和的采样点数累加到文件f的saturated属性中，有饱和时给出提示
+    '''
+    f.attrs['saturated'] = f.attrs.get('saturated', 0) + saturated
+    if saturated > 0:
+        print(f'{saturated}个采样点超出int16的范围，已饱和')
 
 
 def get_waveform_bychunk(filename, PETruth, ampli=1000, td=10, tr=5,
-                         ratio=1e-2, noisetype='normal', controlnoise=True):
+                         ratio=1e-2, noisetype='normal', controlnoise=True, rng=None,
+                         method='dense', workers=None, compression=COMPRESSION,
+                         zero_suppress=None, depth=WRITER_DEPTH):
     '''
-    根据PETruth多进程生成波形(对于每个Event分步进行,以节省内存)并保存
+    根据PETruth多进程生成波形并保存，文件中已有Waveform表时追加写入，结果与get_waveform相同
+    进程池由waveform_pool给出，在各次调用（各分块）之间复用;
+    每次把PETruth与各event共用的噪声放在新的共享内存中，PETruth在事件边界上切成连续的若干段，
+    每段至多约BLOCK_PES个PE，工作进程各自生成一段事件的波形，
+    主进程是唯一的写入者，按EventID的顺序逐段由WaveformWriter写入预先分配的Waveform表，
+    写入在后台线程中进行，主进程同时接收下一段;
+    零压缩时工作进程顺便做零压缩，只把保留的段传回主进程
 
     输入:
     filename, 保存文件名;
-    ParticleTruth; PETruth;
     PETruth (Structured Array) [EventID, ChannelID, PETime];
 
     参数:
-    ampli, 波形高度;
-    td, 整体衰减时间;
-    tr, 峰值位置;
-    ratio, 噪声振幅/波形高度;
-    noisetype, 噪声形式: 'normal' 正态分布噪声, 'sin' 正弦噪声;
-    controlnoise, 是否对噪声控制变量: True则噪声event-wise相同,
-                                      False则噪声event-wise随机,
-                  无论如何channel-wise均随机.
+    ampli, td, tr, ratio, noisetype, controlnoise, rng, method, compression, zero_suppress, depth,
+    同get_waveform;
+    workers, 进程数, 默认为CPU数.
 
     返回:
     无
     '''
+    print("正在生成波形...")
+    if rng is None:
+        rng = CounterRNG()
+    if workers is None:
+        workers = mp.cpu_count()
+    rows, events = count_waveforms(PETruth)
+    if rows == 0:
+        return
+
+    params = (ampli, td, tr, ratio, noisetype, method, zero_suppress)
+    pool = waveform_pool(workers, rng.seed, params)
+    arrays = dict(PETruth=PETruth)
+    noise_0 = common_noise(PETruth, ratio, ampli, noisetype, controlnoise, rng)
+    if noisetype == 'bank':
+        # 噪声库随进程池共享，各event共用的噪声只需传偏移
+        if noise_0 is not None:
+            arrays['offsets'] = noise_0.offsets
+    elif noise_0 is not None:
+        arrays['noise'] = noise_0
+    shards = max(BLOCKS_PER_WORKER * workers, -(-len(PETruth) // BLOCK_PES))
+    bounds = shard_bounds(PETruth['EventID'], shards)
+
+    shared = {}
+    try:
+        for name, array in arrays.items():
+            shared[name] = share_array(array)
+        specs = {name: spec for name, (shm, spec) in shared.items()}
+        tasks = [(specs, bound) for bound in bounds]
+        with h5py.File(filename, "a") as f:
+            # imap按提交的顺序返回，各段依次写入
+            saturated = 0
+            writer = BackgroundWriter(open_writer(f, rows, events, compression, zero_suppress), depth)
+            with writer:
+                for result, count in tqdm(pool.imap(waveform_block, tasks), total=len(tasks)):
+                    if zero_suppress is None:
+                        writer.write(result)
+                    else:
+                        writer.write_segments(*result)
+                    saturated += count
+            print(writer.report())
+            if method == 'int':
+                record_saturation(f, saturated)
+    finally:
+        for shm, spec in shared.values():
+            shm.close()
+            shm.unlink()
 
-    # Event切割
-    EventID = PETruth['EventID']
 
-    Events, Eindex = np.unique(EventID, return_index=True)
-    Eindex = np.hstack([Eindex, np.array(len(EventID))])
+# 波形的进程池与其共享的噪声库，由waveform_pool创建，退出时关闭
+waveform_pools = {}
 
-    # 预先制备时间采样和噪声以加速
-    maxlength = np.max(Eindex[1:] - Eindex[:-1])
-    t0 = np.tile(np.arange(0, 1000, 1), (maxlength, 1))
-    if controlnoise:
-        if noisetype == 'normal':
-            noise_0 = normal_noise(t0, ratio * ampli)
-        elif noisetype == 'sin':
-            noise_0 = sin_noise(t0, np.pi/1e30, ratio * ampli)
-        else:
-            print(f'{noisetype} noise not implemented, use normal noise instead!')
-            noise_0 = normal_noise(t0, ratio * ampli)
 
-    # 分Event并行化生成Waveform
-    # ref:
-    # https://stackoverflow.com/questions/15704010/write-data-to-hdf-file-using-multiprocessing
-    num_processes = 1
-    sentinal = None
-    write_chunk = 50
-    pbar_write = tqdm(total=(len(Eindex)-1)/write_chunk)
-    pbar_getwf = tqdm(total=(len(Eindex)-1))
-
-    def getWF_mp(inqueue, output):
-        for i in iter(inqueue.get, sentinal):
-            # 采样
-            length = Eindex[i+1] - Eindex[i]
-            t = t0[:length]
-
-            if not controlnoise:
-                if noisetype == 'normal':
-                    noise_0 = normal_noise(t, ratio * ampli)
-                elif noisetype == 'sin':
-                    noise_0 = sin_noise(t, np.pi/1e30, ratio * ampli)
-                else:
-                    print(f'{noisetype} noise not implemented, use normal noise instead!')
-                    noise_0 = normal_noise(t, ratio * ampli)
-
-            # 生成Waveform
-            Waveform = noise_0[:length] + double_exp_model(
-                t - PETruth[Eindex[i]:Eindex[i+1]]['PETime'].reshape(-1, 1),
-                ampli,
-                td,
-                tr
-            )
+def waveform_pool(workers, seed, params):
+    '''
+    给出波形的进程池，参数不变时复用已有的进程池，否则关闭旧的再新建
+    工作进程的启动（导入numba、scipy与本模块）只在新建时发生一次
+    params同init_waveform_worker，噪声为'bank'时噪声库随进程池放在共享内存中
+    '''
+    noisetype = params[4]
+    arrays = dict(bank=noise_bank()) if noisetype == 'bank' else {}
+    return cached_pool(
+        waveform_pools, (workers, seed, params), workers, init_waveform_worker, arrays,
+        seed, params
+    )
 
-            # numpy groupby
-            # ref:
-            # https://stackoverflow.com/questions/58546957/sum-of-rows-based-on-index-with-numpy
-            Channels, idx = np.unique(
-                PETruth[Eindex[i]:Eindex[i+1]]['ChannelID'],
-                return_inverse=True
-            )
-            order = np.argsort(idx)
-            breaks = np.flatnonzero(np.concatenate(([1], np.diff(idx[order]))))
-            # 同Channel波形相加
-            result = np.add.reduceat(Waveform[order], breaks, axis=0)
-
-            # 拼接WF表
-            WF = np.empty(
-                len(Channels),
-                dtype=[('EventID', '<i4'),
-                       ('ChannelID', '<i4'),
-                       ('Waveform', '<i2', (1000,))]
-            )
-            WF['EventID'] = np.ones(len(Channels))*Events[i]
-            WF['ChannelID'] = Channels
-            WF['Waveform'] = result
 
-            # 放入output队列等待写入文件
-            pbar_getwf.update()
-            output.put([1, WF], block=False)
+atexit.register(close_pool, waveform_pools)
 
 
-    def write_file(output):
-        # open file
-        f = h5py.File(filename, "a")
-        # 初始化Waveform表的Flag
-        init = True
-        # 多Event同时写入
-        ev = write_chunk
+# 工作进程中的噪声库与参数，由init_waveform_worker设置
+waveform_worker = {}
+# 工作进程中本次调用的PETruth与各event共用的噪声，由utils.attach_inputs设置
+waveform_inputs = {}
 
-        while True:
-            # 获取待写入WF
-            getoutput = output.get()
-            flag = getoutput[0]
-            if flag:
-                if ev == write_chunk:
-                    WF = getoutput[1]
-                else:
-                    WF = np.concatenate((WF, getoutput[1]), axis=0)
-                ev -= 1
-                if ev == 0:
-                    if init:
-                        # 初始化Waveform表
-                        wfds = f.create_dataset(
-                            'Waveform',
-                            (len(WF),),
-                            maxshape=(None,),
-                            dtype=np.dtype(
-                                [('EventID', '<i4'),
-                                 ('ChannelID', '<i4'),
-                                 ('Waveform', '<i2', (1000,))]
-                            )
-                        )
-                        init = False
-                    else:
-                        # 扩大Waveform表
-                        wfds.resize(wfds.shape[0] + len(WF), axis=0)
 
-                    # 写入WF
-                    wfds[-len(WF):] = WF
-                    pbar_write.update()
-                    ev = write_chunk
-            else:
-                # 写入完成
-                if len(WF) > 0:
-                    wfds.resize(wfds.shape[0] + len(WF), axis=0)
-                    wfds[-len(WF):] = WF
-                    pbar_write.update()
-                break
-
-        # 关闭文件
-        f.close()
-
-    # 待写入文件队列
-    output = mp.Queue()
-    # 待执行任务队列
-    inqueue = mp.Queue()
-    # 进程表
-    jobs = []
-    # 写入文件进程
-    proc = mp.Process(target=write_file, args=(output, ))
-    proc.start()
-
-    for i in range(num_processes):
-        # 生成WF进程
-        p = mp.Process(target=getWF_mp, args=(inqueue, output))
-        jobs.append(p)
-        p.start()
-
-    for i in range(len(Eindex)-1):
-        # 分配任务
-        inqueue.put(i)
-
-    for i in range(num_processes):
-        # 结束任务
-        inqueue.put(sentinal)
-
-    for p in jobs:
-        p.join()
-
-    # 结束文件写入
-    output.put([0, None], block=False)
-    proc.join()
-    pbar_write.close()
-    pbar_getwf.close()
+def init_waveform_worker(specs, seed, params):
+    '''
+    工作进程的初始化：连接噪声库的共享内存
+    params为(ampli, td, tr, ratio, noisetype, method, zero_suppress)
+    '''
+    single_thread()
+    for name, spec in specs.items():
+        waveform_worker[name + '_shm'], waveform_worker[name] = attach_array(spec)
+    waveform_worker['rng'] = CounterRNG(seed)
+    waveform_worker['params'] = params
+
+
+def waveform_block(task):
+    '''
+    在工作进程中生成PETruth[start:stop]中各事件的Waveform表，零压缩时为suppress的结果
+    task为(共享内存的specs, (start, stop))
+    返回(结果, 'int'方法饱和的采样点数)
+    '''
+    specs, (start, stop) = task
+    ampli, td, tr, ratio, noisetype, method, zero_suppress = waveform_worker['params']
+    if attach_inputs(waveform_inputs, specs) and 'offsets' in waveform_inputs:
+        waveform_inputs['noise'] = BankNoise(
+            waveform_worker['bank'], waveform_inputs['offsets'], ratio * ampli
+        )
+    tally = {}
+    WFs = list(event_waveforms(
+        waveform_inputs['PETruth'][start:stop], waveform_inputs.get('noise'),
+        waveform_worker['rng'], ampli, td, tr, ratio, noisetype, method, waveform_worker.get('bank'),
+        tally
+    ))
+    WF = np.concatenate(WFs) if len(WFs) > 0 else np.empty(0, dtype=WAVEFORM_DTYPE)
+    if zero_suppress is not None:
+        WF = suppress(WF, zero_suppress)
+    return WF, tally.get('saturated', 0)
@@ -0,0 +1,220 @@
+'''
+geometry.py: 光子与PMT的求交
+
+主要接口：PMTIndex, KDTreeIndex
+PMT球心都在半径Ro的球面上，PMT只占据Ro-r_PMT到Ro+r_PMT的球壳。
+PMTIndex把球壳按(θ, φ)分成网格，预先算出每个格子附近可能被击中的PMT，
+每个光子只需在经过球壳的一小段路径上查表，再对候选PMT精确求解光线与球的交点
+'''
+
+import numpy as np
+from numba import njit
+from scipy.spatial import KDTree
+from .utils import Ro, r_PMT
+
+R_INNER = Ro - r_PMT # PMT球壳的内半径
+R_OUTER = Ro + r_PMT # PMT球壳的外半径
+EPS = 1e-6 # 小于这个距离的交点视为光线的起点本身，单位m
+
+
+class PMTIndex:
+    '''
+    (θ, φ)分桶的PMT索引
+    光子在球壳内的路径被切成长度不超过piece_length的小段，
+    每段的中点所在格子的候选表包含了这段路径可能击中的所有PMT
+    '''
+
+    def __init__(self, PMTs, n_theta=128, piece_length=1.0, table=None):
+        '''
+        PMTs: (3, n)的PMT球心坐标
+        n_theta: θ方向的格子数，φ方向为其两倍
+        piece_length: 每次查表的路径长度，单位m
+        table: 已经建好的候选表（例如在共享内存中），为None时新建
+        '''
+        self.PMTs = np.ascontiguousarray(PMTs, dtype=np.float64)
+        self.n_theta = n_theta
+        self.n_phi = 2 * n_theta
+        self.piece_length = piece_length
+        self.table = self.build_table() if table is None else table
+
+    def build_table(self):
+        '''
+        给出每个格子的候选PMT表，形状为(格子数, 最大候选数)，不足的用-1补齐
+        '''
+        d_theta = np.pi / self.n_theta
+        d_phi = 2 * np.pi / self.n_phi
+        theta_edges = np.arange(self.n_theta + 1) * d_theta
+        theta_centers = (theta_edges[:-1] + theta_edges[1:]) / 2
+        phi_centers = (np.arange(self.n_phi) + 0.5) * d_phi
+
+        # 格子内任一点到格子中心的角距离不超过 dθ/2 + max(sinθ)*dφ/2
+        sin_max = np.maximum(np.sin(theta_edges[:-1]), np.sin(theta_edges[1:]))
+        sin_max[(theta_edges[:-1] < np.pi/2) & (theta_edges[1:] > np.pi/2)] = 1
+        cell_radius = d_theta/2 + sin_max*d_phi/2
+
+        # 路径上的点与小段中点的距离不超过piece_length/2，且都在球壳内，
+        # 能击中的PMT球心与中点的角距离不超过hit_radius
+        hit_radius = 2 * np.arcsin(
+            (r_PMT + self.piece_length/2) / (2 * np.sqrt(R_INNER * Ro))
+        )
+
+        # 在单位球面上按弦长查找，留一点余量
+        angles = np.repeat(cell_radius, self.n_phi) + hit_radius
+        chords = 2 * np.sin(np.minimum(angles, np.pi) / 2) * (1 + 1e-9)
+        t, p = np.meshgrid(theta_centers, phi_centers, indexing='ij')
+        centers = np.stack(
+            (np.sin(t)*np.cos(p), np.sin(t)*np.sin(p), np.cos(t)), axis=-1
+        ).reshape(-1, 3)
+        directions = self.PMTs.T / np.linalg.norm(self.PMTs, axis=0).reshape(-1, 1)
+        candidates = KDTree(directions).query_ball_point(centers, chords)
+
+        width = max(len(c) for c in candidates)
+        table = np.full((len(candidates), width), -1, dtype=np.int32)
+        for k, c in enumerate(candidates):
+            table[k, :len(c)] = c
+        return table
+
+    def first_hit(self, coordinates, velocities, fromPMT=False):
+        '''
+        求一组光子最先击中的PMT
+
+        输入: coordinates, velocities, (3, n)的起点与单位方向矢量;
+        fromPMT, 是否从PMT表面出发，精确求交时不需要区分.
+
+        返回: (击中的PMT序号, 能击中PMT的光子序号)
+        '''
+        hit_index = np.empty(coordinates.shape[1], dtype=np.int64)
+        first_hit_kernel(
+            np.ascontiguousarray(coordinates), np.ascontiguousarray(velocities),
+            self.PMTs, self.table, self.n_theta, self.n_phi, self.piece_length,
+            hit_index
+        )
+        possible_photon = np.flatnonzero(hit_index >= 0)
+        return hit_index[possible_photon], possible_photon
+
+
+@njit(cache=True)
+def first_hit_kernel(coordinates, velocities, PMTs, table, n_theta, n_phi,
+                     piece_length, hit_index):
+    '''
+    逐个光子求最先击中的PMT，没有击中时为-1
+    '''
+    for i in range(coordinates.shape[1]):
+        hit_index[i] = first_hit_one(
+            coordinates[0, i], coordinates[1, i], coordinates[2, i],
+            velocities[0, i], velocities[1, i], velocities[2, i],
+            PMTs, table, n_theta, n_phi, piece_length
+        )[0]
+
+
+@njit(cache=True)
+def first_hit_one(ox, oy, oz, vx, vy, vz, PMTs, table, n_theta, n_phi, piece_length):
+    '''
+    单个光子最先击中的PMT，返回(PMT序号, 到达交点的路程)，没有击中时为(-1, inf)
+    '''
+    d_theta = np.pi / n_theta
+    d_phi = 2 * np.pi / n_phi
+    b = ox*vx + oy*vy + oz*vz
+    oo = ox*ox + oy*oy + oz*oz
+
+    # 光线在球壳内的部分：[0, t_out]去掉穿过内球的(t1, t2)，至多两段
+    t_out = -b + np.sqrt(max(b*b - oo + R_OUTER**2, 0.0))
+    disc = b*b - oo + R_INNER**2
+    if disc > 0:
+        s = np.sqrt(disc)
+        end_a = min(max(-b - s, 0.0), t_out)
+        start_b = min(max(-b + s, 0.0), t_out)
+    else:
+        end_a = t_out
+        start_b = t_out
+
+    best_t = np.inf
+    best_j = -1
+    for segment in range(2):
+        if segment == 0:
+            t0, t1 = 0.0, end_a
+        else:
+            t0, t1 = start_b, t_out
+        length = t1 - t0
+        if length <= 0:
+            continue
+        pieces = int(np.ceil(length / piece_length))
+        step = length / pieces
+        for piece in range(pieces):
+            # 小段中点所在的格子
+            tm = t0 + (piece + 0.5) * step
+            mx, my, mz = ox + tm*vx, oy + tm*vy, oz + tm*vz
+            r = np.sqrt(mx*mx + my*my + mz*mz)
+            theta = np.arccos(min(max(mz / r, -1.0), 1.0))
+            phi = np.arctan2(my, mx)
+            if phi < 0:
+                phi += 2 * np.pi
+            cell = min(int(theta / d_theta), n_theta - 1) * n_phi + \
+                min(int(phi / d_phi), n_phi - 1)
+
+            # 与候选PMT精确求交，取最近的交点
+            for k in range(table.shape[1]):
+                j = table[cell, k]
+                if j < 0:
+                    break
+                wx, wy, wz = ox - PMTs[0, j], oy - PMTs[1, j], oz - PMTs[2, j]
+                bw = wx*vx + wy*vy + wz*vz
+                d = bw*bw - (wx*wx + wy*wy + wz*wz) + r_PMT**2
+                if d < 0:
+                    continue
+                t = -bw - np.sqrt(d)
+                if EPS < t < best_t:
+                    best_t = t
+                    best_j = j
+    return best_j, best_t
+
+
+class KDTreeIndex:
+    '''
+    在光线上取若干个点，用KDTree查找最邻近的PMT
+    可能漏掉擦边的光子，保留用于对比
+    '''
+
+    def __init__(self, PMTs):
+        '''
+        PMTs: (3, n)的PMT球心坐标
+        '''
+        self.PMTs = PMTs
+        self.kdtree = KDTree(PMTs.T)
+
+    def first_hit(self, coordinates, velocities, fromPMT=False):
+        '''
+        通过KDTree寻找一组光子最终能否击中PMT以及击中PMT的序号
+        返回: (击中的PMT序号, 能击中PMT的光子序号)
+        '''
+        # 查找在球面上最邻近的PMT
+        cv1 = np.einsum('kn, kn->n', coordinates, velocities)
+        # ts为到达液闪边界的时间
+        ts1 = -cv1 + np.sqrt(cv1**2 - (np.einsum('kn, kn->n', coordinates, coordinates)-(Ro+r_PMT)**2))
+        edge_points1 = coordinates + ts1 * velocities
+        outer_points = np.stack((edge_points1[0, :], edge_points1[1, :], edge_points1[2, :]), axis=-1)
+
+        inserted_points = np.empty(1)
+        if fromPMT:
+            insert_num = 1000
+            inner_points = np.stack((coordinates[0, :], coordinates[1, :], coordinates[2, :]), axis=-1)
+            inserted_points = np.linspace(inner_points, outer_points, insert_num)[1:, :, :]
+        else:
+            insert_num = 10
+            cv2 = np.einsum('kn, kn->n', coordinates, velocities)
+            ts2 = -cv2 + np.sqrt(cv2**2 - (np.einsum('kn, kn->n', coordinates, coordinates)-(Ro-r_PMT)**2))
+            edge_points2 = coordinates + ts2 * velocities
+            inner_points = np.stack((edge_points2[0, :], edge_points2[1, :], edge_points2[2, :]), axis=-1)
+            inserted_points = np.linspace(inner_points, outer_points, insert_num)
+
+        # 返回搜索得到的最邻近点距离和最邻近点index
+        search_distances, search_indexs = self.kdtree.query(
+            inserted_points, workers=-1, distance_upper_bound=r_PMT
+        )
+        allowed_distances = search_distances < np.inf
+        possible_photon = np.where(np.any(allowed_distances, axis=0))[0]
+        first_point_index = np.argmax(allowed_distances[:, possible_photon], axis=0)
+
+        nearest_PMT_index = search_indexs[first_point_index, possible_photon]
+
+        return nearest_PMT_index, possible_photon
@@ -0,0 +1,97 @@
+'''
+optics.py: 界面上的折射与反射
+
+主要接口：interface, refract, reflect, 以及供numba代码调用的interface_one, refract_one
+全部由入射角的余弦计算，不经过反三角函数，一次numexpr调用给出一个结果
+
+约定:
+velocities为单位入射方向，normals为指向入射一侧的单位法向量，
+cos_i = -v·n 为入射角的余弦，eta = n1/n2 为入射一侧与出射一侧的折射率之比;
+全反射时出射角的余弦cos_t取0，此时反射率恰为1;
+numexpr把Python的float当作float64，eta先转为与数组相同的类型，float32的光线保持float32
+'''
+
+import numpy as np
+import numexpr as ne
+from numba import njit
+
+
+def incidence_cosines(velocities, normals):
+    '''
+    入射角的余弦，(3, n) -> (n,)
+    '''
+    return np.minimum(-np.einsum('kn, kn->n', velocities, normals), 1)
+
+
+def snell(cos_i, eta):
+    '''
+    出射角的余弦，全反射时为0
+    '''
+    eta = cos_i.dtype.type(eta)
+    return ne.evaluate('sqrt(where(1 - eta**2*(1 - cos_i**2) > 0, 1 - eta**2*(1 - cos_i**2), 0))')
+
+
+def fresnel(cos_i, cos_t, eta):
+    '''
+    非偏振光的反射率 (Rs+Rp)/2
+    '''
+    eta = cos_i.dtype.type(eta)
+    return ne.evaluate(
+        '(((eta*cos_i - cos_t)/(eta*cos_i + cos_t))**2'
+        ' + ((cos_i - eta*cos_t)/(cos_i + eta*cos_t))**2) / 2'
+    )
+
+
+def interface(velocities, normals, eta):
+    '''
+    一组光线到达界面，给出(cos_i, cos_t, 反射率)
+    能否折射由cos_t > 0判断
+    '''
+    cos_i = incidence_cosines(velocities, normals)
+    cos_t = snell(cos_i, eta)
+    return cos_i, cos_t, fresnel(cos_i, cos_t, eta)
+
+
+def refract(velocities, normals, cos_i, cos_t, eta):
+    '''
+    折射光的方向，(3, n)
+    '''
+    eta = velocities.dtype.type(eta)
+    return ne.evaluate('eta*velocities + (eta*cos_i - cos_t)*normals')
+
+
+def reflect(velocities, normals, cos_i):
+    '''
+    反射光的方向，(3, n)
+    '''
+    return ne.evaluate('velocities + 2*cos_i*normals')
+
+
+@njit(cache=True)
+def interface_one(vx, vy, vz, nx, ny, nz, eta):
+    '''
+    单条光线的interface，返回(cos_i, cos_t, 反射率)
+    '''
+    cos_i = min(-(vx*nx + vy*ny + vz*nz), 1.0)
+    delta = 1 - eta**2*(1 - cos_i**2)
+    cos_t = np.sqrt(delta) if delta > 0 else 0.0
+    rs = (eta*cos_i - cos_t)/(eta*cos_i + cos_t)
+    rp = (cos_i - eta*cos_t)/(cos_i + eta*cos_t)
+    return cos_i, cos_t, (rs**2 + rp**2) / 2
+
+
+@njit(cache=True)
+def refract_one(vx, vy, vz, nx, ny, nz, cos_i, cos_t, eta):
+    '''
+    单条光线折射后的方向
+    '''
+    k = eta*cos_i - cos_t
+    return eta*vx + k*nx, eta*vy + k*ny, eta*vz + k*nz
+
+
+@njit(cache=True)
+def reflect_one(vx, vy, vz, nx, ny, nz, cos_i):
+    '''
+    单条光线反射后的方向
+    '''
+    return vx + 2*cos_i*nx, vy + 2*cos_i*ny, vz + 2*cos_i*nz
@@ -0,0 +1,169 @@
+'''
+planner.py: 按内存预算安排分块
+
+主要接口：plan_memory
+根据光子数估计各阶段的内存，给出每块的事件数与光学过程每批的光子数，
+使峰值内存不超过预算，同时块与批尽量大以减少开销
+'''
+
+import numpy as np
+from .event import get_cdf_list
+from .geometry import PMTIndex, KDTreeIndex
+from .genWaveform import WAVEFORM_DTYPE, BLOCK_PES, BLOCKS_PER_WORKER, BANK_SIZE, WINDOW, \
+    CHUNK_BYTES, WRITE_CHUNKS, WRITER_DEPTH
+
+# 以下每光子、每PE的字节数由tracemalloc实测得到（包括临时数组）
+GEN_BYTES = {'inverse': 110, 'thinning': 250} # 生成光子时每个光子的峰值
+PHOTON_BYTES = 16 # PhotonTruth每行
+PE_PER_PHOTON = 0.81 # 每个光子平均产生的PE数
+MAX_PE_PER_PHOTON = 0.95 # 顶点靠近液闪边缘的事件每个光子产生的PE数较多
+PE_BYTES = 60 # 每个PE在PEBuffer与排序时的峰值
+PE_ROW_BYTES = 16 # PETruth每行
+TRACE_BYTES = {'numpy': 420, 'numba': 100, 'table': 0} # 光学过程每批中每个光子的临时数组
+FLOAT32_TRACE = {'numpy': 0.66, 'numba': 0.85, 'table': 1} # float32时临时数组的比例（实测）
+# 求交时每个光子额外的临时数组，KDTreeIndex在fromPMT时每条光线取1000个点
+INDEX_BYTES = {PMTIndex: 16, KDTreeIndex: 999 * (3*8 + 8 + 8 + 1)}
+# 合成一个事件的波形时每个PE的峰值，通道数按不超过PE数计。dense为实测（包括展开的噪声），
+# 其余由数组的大小估计: template/auto为float64的各通道波形与Waveform表，
+# fft另有两个分量的直方图、rFFT与逆变换，int为int32的各通道波形
+WAVEFORM_BYTES = {'dense': 45000, 'template': 10000, 'auto': 10000, 'fft': 92000, 'int': 6000}
+# 噪声矩阵每个PE一行，dense已计入; 噪声库只存每行的偏移
+NOISE_BYTES = {'normal': WINDOW * 8, 'sin': WINDOW * 8, 'bank': 8}
+BANK_BYTES = (BANK_SIZE + WINDOW) * 4 # 噪声库，多进程时在共享内存中只有一份
+ROW_BYTES = WAVEFORM_DTYPE.itemsize # Waveform表每行，每个PE至多一行
+WORKER_BYTES = 128 * 2**20 # 每个波形工作进程的解释器与各个库（估计）
+USABLE = 0.85 # 内存碎片使RSS高于估计，只按预算的85%安排
+BASE_BYTES = 256 * 2**20 # 解释器与各个库（实测RSS），几何、索引与各种表
+
+MIN_BATCH = 1 << 12
+MAX_BATCH = 1 << 20
+
+
+class MemoryPlan:
+    '''
+    分块方案，打印时给出各部分的估计
+    '''
+
+    def __init__(self, max_memory, chunk_size, batch_size, photons_per_event, parts):
+        '''
+        max_memory: 预算/B; chunk_size: 每块的事件数; batch_size: 每批的光子数;
+        photons_per_event: 每个事件光子数的上界; parts: 各部分的估计/B
+        '''
+        self.max_memory = max_memory
+        self.chunk_size = chunk_size
+        self.batch_size = batch_size
+        self.photons_per_event = photons_per_event
+        self.parts = parts
+
+    @property
+    def peak(self):
+        '''
+        估计的峰值内存/B
+        '''
+        return sum(self.parts.values())
+
+    def __str__(self):
+        lines = [
+            f'内存预算 {self.max_memory/2**20:.0f} MB: 每块 {self.chunk_size} 个事件'
+            f'（约 {self.chunk_size*self.photons_per_event:.3g} 个光子），'
+            f'光学过程每批 {self.batch_size} 个光子，预计峰值 {self.peak/2**20:.0f} MB'
+        ]
+        lines += [f'  {name}: {size/2**20:.0f} MB' for name, size in self.parts.items()]
+        if self.peak > self.max_memory:
+            lines.append('  警告: 最小的分块也超过内存预算')
+        return '\n'.join(lines)
+
+
+def waveform_bytes(chunk_size, pes_per_event, max_pes, method='dense', workers=1,
+                   noisetype='normal'):
+    '''
+    波形阶段的峰值/B（PETruth之外）
+
+    输入: chunk_size, 每块的事件数; pes_per_event, 每个事件平均的PE数;
+    max_pes, 最大的事件的PE数; method, 波形的合成方法; workers, 波形的进程数;
+    noisetype, 噪声形式
+
+    每个进程一次合成一个事件，这一部分只与最大的事件有关;
+    等待写入的Waveform表随块增大，单进程时至多为写入线程队列中的几段，
+    多进程时为各进程正在生成的一段与主进程中等待写入的几段
+    '''
+    noise = 0 if method == 'dense' else NOISE_BYTES[noisetype]
+    synthesis = max_pes * (WAVEFORM_BYTES[method] + noise)
+    bank = BANK_BYTES if noisetype == 'bank' else 0
+    chunk_rows = chunk_size * pes_per_event * ROW_BYTES
+    if workers <= 1:
+        block = min(chunk_rows, WRITE_CHUNKS * CHUNK_BYTES)
+        return synthesis + bank + (WRITER_DEPTH + 1) * block
+    shard = min(chunk_rows / (BLOCKS_PER_WORKER * workers), BLOCK_PES * ROW_BYTES)
+    return bank + workers * (WORKER_BYTES + synthesis + shard) + (workers + WRITER_DEPTH) * shard
+
+
+def plan_memory(number_of_events, max_memory, sampler='inverse', backend='numpy',
+                workers=1, index=PMTIndex, fused=False, dtype='<f8', waveform='dense',
+                waveform_workers=1, noisetype='normal'):
+    '''
+    给出不超过max_memory字节的分块方案
+
+    输入: number_of_events, 总事件数; max_memory, 内存预算/B;
+    sampler, GenTime采样方法; backend, 光学过程的实现; workers, 光学过程的进程数;
+    index, 求交所用的索引类; fused, 是否在光学过程中逐批生成光子;
+    dtype, 光子状态与PETime的浮点类型;
+    waveform, 波形的合成方法; waveform_workers, 波形的进程数; noisetype, 噪声形式
+
+    返回: MemoryPlan
+    '''
+    budget = max_memory * USABLE
+
+    # 每个事件的光子数服从泊松分布，取均值加5倍标准差
+    mean = get_cdf_list()[-1]
+    photons_per_event = mean + 5 * np.sqrt(mean)
+
+    # 生成下一块时上一块的PhotonTruth与PETruth仍然存在，
+    # 多进程时PhotonTruth在共享内存中多存一份
+    # float32时PETime每行少4字节
+    pe_row = PE_ROW_BYTES - (4 if dtype == '<f4' else 0)
+    resident = PHOTON_BYTES + PE_PER_PHOTON * pe_row
+    per_photon = max(
+        GEN_BYTES[sampler] + resident,
+        PHOTON_BYTES * (2 if workers > 1 else 1) + PE_PER_PHOTON * PE_BYTES
+    )
+    trace = TRACE_BYTES[backend] * (FLOAT32_TRACE[backend] if dtype == '<f4' else 1) + \
+        INDEX_BYTES[index]
+    if fused:
+        # 不存在整块的PhotonTruth，光子只在光学过程的每批中生成
+        per_photon = PE_PER_PHOTON * PE_BYTES
+        trace += GEN_BYTES[sampler] + PHOTON_BYTES
+    per_event = photons_per_event * per_photon
+    pes_per_event = photons_per_event * PE_PER_PHOTON
+    max_pes = photons_per_event * MAX_PE_PER_PHOTON
+    waveform_peak = lambda chunk: waveform_bytes(
+        chunk, pes_per_event, max_pes, waveform, waveform_workers, noisetype
+    )
+
+    # 光学过程的每批至多用去预算的四分之一，取2的幂
+    batch_size = (budget - BASE_BYTES) / 4 / (trace * workers)
+    batch_size = int(2 ** np.floor(np.log2(max(batch_size, MIN_BATCH))))
+    batch_size = min(max(batch_size, MIN_BATCH), MAX_BATCH)
+
+    # 光学过程的临时数组与波形的临时数组不同时存在，剩下的内存全部给事件
+    optics = batch_size * trace * workers
+    peak = lambda chunk: BASE_BYTES + chunk * per_event + max(optics, waveform_peak(chunk))
+
+    # 波形的写入缓冲在块足够大时达到上限，峰值随块分段线性、单调不减，
+    # 二分求峰值不超过预算的最大块
+    low, high = 1, number_of_events
+    while low < high:
+        middle = (low + high + 1) // 2
+        if peak(middle) <= budget:
+            low = middle
+        else:
+            high = middle - 1
+    chunk_size = low
+    transient = max(optics, waveform_peak(chunk_size))
+
+    parts = {
+        '解释器、库与几何': BASE_BYTES,
+        '事件与PE': chunk_size * per_event,
+        '光学过程/波形的临时数组': transient,
+    }
+    return MemoryPlan(max_memory, chunk_size, batch_size, photons_per_event, parts)
@@ -0,0 +1,173 @@
+'''
+probe.py: 由探针表代替光线追踪的光学过程
+
+主要接口：ProbeTable, sample_PE
+genSimProbe在(r, theta)网格上给出一个光子直接折射、或经一次反射后到达PMT的概率，
+以及到达时间的均值与标准差。对每个事件，一次求出所有PMT的期望PE数，
+按泊松分布抽取每个PMT的PE数，再抽取每个PE的GenTime与传播时间。
+不追踪光子，只保证PETruth在统计上正确
+'''
+
+import numpy as np
+from numba import njit
+from tqdm import tqdm
+from .utils import xyz_from_spher, cache_path, load_cache, save_cache, \
+    Ri, Ro, r_PMT, n_LS, n_water, n_glass, c
+from .event import get_cdf_list, PRECISION
+from .rng import uniform, STREAM_PROBE_COUNT, STREAM_PROBE_TIME
+
+TABLE_PRECISION = 100 # 探针表的网格精度，同genSimProbe.gen_table
+TABLE_VERSION = 2 # 探针表的格式与genSimProbe中物理过程的版本，二者改变时须加一，使旧缓存失效
+INVERSE_POINTS = 1 << 16 # GenTime逆CDF表的点数
+TRANSMIT = 0 # 直接折射到达PMT
+REFLECT = 1 # 在液闪边界反射一次后到达PMT
+
+
+def load_table(precision=TABLE_PRECISION):
+    '''
+    读取缓存的探针表，没有时由genSimProbe.gen_table生成并缓存
+    返回(ro, theta, tables)，格式同gen_table
+    表按网格精度、几何尺寸、折射率与TABLE_VERSION缓存，其中任何一项改变都会重新生成
+    '''
+    path = cache_path(
+        'probe', TABLE_VERSION, precision, Ri, Ro, r_PMT, n_LS, n_water, n_glass, c
+    )
+    cached = load_cache(path)
+    if cached is None:
+        # genSimProbe在导入时修改numexpr的线程数并生成试探光线，只在需要时导入
+        from .genSimProbe import gen_table
+        print("正在生成探针表，只在第一次使用时进行...")
+        ro, theta, tables = gen_table(precision)
+        thetas, ros = np.meshgrid(theta, ro)
+        cached = np.concatenate((ros[None], thetas[None], tables))
+        save_cache(path, cached)
+    return cached[0, :, 0], cached[1, 0, :], cached[2:]
+
+
+class ProbeTable:
+    '''
+    探针表，与genSimProbe.gen_interp同为双线性插值
+    一个事件中所有PMT的r相同，先由rows在r方向插值，再由probe_PMTs对theta插值
+    '''
+
+    def __init__(self, precision=TABLE_PRECISION):
+        self.ro, self.theta, tables = load_table(precision)
+        prob_t, prob_r, mean_t, mean_r, std_t, std_r = tables
+
+        # 插值概率加权的一阶、二阶矩而不是均值与标准差本身，
+        # 这样在概率为0的格点附近（没有光线到达，均值记为0）不会把到达时间拉向0
+        self.grids = np.stack((
+            prob_t, prob_r,
+            prob_t * mean_t, prob_r * mean_r,
+            prob_t * (std_t**2 + mean_t**2), prob_r * (std_r**2 + mean_r**2)
+        ))
+
+        self.theta_step = self.theta[1] - self.theta[0]
+
+    def rows(self, r):
+        '''
+        在r方向插值，给出半径为r/m的顶点的各表，形状为(6, theta.shape[0])
+        '''
+        i = np.clip(np.searchsorted(self.ro, r) - 1, 0, self.ro.shape[0] - 2)
+        w = np.clip((r - self.ro[i]) / (self.ro[i+1] - self.ro[i]), 0, 1)
+        return self.grids[:, i] * (1 - w) + self.grids[:, i+1] * w
+
+
+@njit(cache=True)
+def poisson_one(u, lam):
+    '''
+    期望为lam的泊松分布的逆CDF，逐项累加概率
+    每个PMT的期望PE数很小，比scipy.stats.poisson.ppf快得多
+    '''
+    p = np.exp(-lam)
+    cdf = p
+    k = 0
+    # 累加的舍入误差可能使cdf始终小于u，k超过期望很多时截止
+    while cdf < u and k < 10 * lam + 100:
+        k += 1
+        p *= lam / k
+        cdf += p
+    return k
+
+
+@njit(cache=True)
+def probe_PMTs(rows, theta_step, cos_theta, photons, key, event, counts, mean, std):
+    '''
+    对一个事件的所有PMT在theta方向插值，抽取直接/反射到达的PE数，写入counts，
+    到达时间的均值与标准差/ns写入mean, std，三者形状均为(2, PMT数)，
+    第TRANSMIT行为直接折射，第REFLECT行为反射一次
+    photons为事件光子数的期望，key为CounterRNG.key，
+    随机数与CounterRNG.random(STREAM_PROBE_COUNT, event, PMT编号, 直接/反射)相同
+    '''
+    last = rows.shape[1] - 1
+    for j in range(cos_theta.shape[0]):
+        x = np.arccos(min(max(cos_theta[j], -1.0), 1.0)) / theta_step
+        k = min(int(x), last - 1)
+        f = x - k
+        for kind in range(2):
+            p = rows[kind, k] * (1 - f) + rows[kind, k+1] * f
+            m1 = rows[2+kind, k] * (1 - f) + rows[2+kind, k+1] * f
+            m2 = rows[4+kind, k] * (1 - f) + rows[4+kind, k+1] * f
+            if p > 0:
+                mean[kind, j] = m1 / p * 1e9
+                std[kind, j] = np.sqrt(max(m2 / p - (m1 / p)**2, 0.0)) * 1e9
+            else:
+                p = 0.0
+                mean[kind, j] = 0.0
+                std[kind, j] = 0.0
+            counts[kind, j] = poisson_one(
+                uniform(key, STREAM_PROBE_COUNT, event, j, kind), photons * p
+            )
+
+
+def sample_PE(ParticleTruth, PMT_list, rng, pe_buffer, table=None):
+    '''
+    用探针表抽取ParticleTruth中各事件的PE，写入pe_buffer（genPETruth.PEBuffer），
+    PhotonID一列为PE在事件中的编号
+    rng为CounterRNG，结果只由seed与EventID决定; table为ProbeTable，默认读取缓存
+    每个PMT的PE数: 光子数服从Poisson(N)，每个光子独立地到达各PMT，
+    因此各PMT直接/反射到达的PE数是相互独立的Poisson(N*prob)
+    '''
+    if table is None:
+        table = ProbeTable()
+
+    # PMT方向的单位向量
+    PMTs = np.stack(xyz_from_spher(
+        1, PMT_list['theta']/180*np.pi, PMT_list['phi']/180*np.pi
+    ))
+    counts = np.empty((2, PMTs.shape[1]), dtype=np.int64)
+    mean, std = np.empty((2, 2, PMTs.shape[1]))
+    cdf_list = get_cdf_list()
+    # 在均匀的u上预先求逆，每个PE直接按下标插值，不再在整个累积积分表中查找
+    inverse = np.interp(
+        np.linspace(0, cdf_list[-1], INVERSE_POINTS + 1),
+        cdf_list, np.arange(cdf_list.shape[0]) / PRECISION
+    )
+
+    for particle in tqdm(ParticleTruth):
+        event = particle['EventID']
+        vertex = np.array([particle['x'], particle['y'], particle['z']]) / 1000
+        r = np.linalg.norm(vertex)
+        cos_theta = PMTs.T @ vertex / r if r > 0 else np.ones(PMTs.shape[1])
+        probe_PMTs(
+            table.rows(r), table.theta_step, cos_theta, cdf_list[-1],
+            rng.key, event, counts, mean, std
+        )
+
+        # 展开为每个PE，PE按(直接/反射, PMT)编号
+        hit_kinds, hit_channels = np.nonzero(counts)
+        repeats = counts[hit_kinds, hit_channels]
+        PE_kinds = np.repeat(hit_kinds, repeats)
+        PE_channels = np.repeat(hit_channels, repeats)
+        PE_index = np.arange(PE_channels.shape[0])
+
+        # GenTime由lambda的累积积分表求逆，传播时间取正态分布
+        u = rng.random(STREAM_PROBE_TIME, event, PE_index, 0) * INVERSE_POINTS
+        i = u.astype(np.int64)
+        gen_times = inverse[i] + (u - i) * (inverse[i+1] - inverse[i])
+        transit_times = mean[PE_kinds, PE_channels] + std[PE_kinds, PE_channels] * \
+            rng.normal(STREAM_PROBE_TIME, event, PE_index, 1)
+        pe_buffer.append(
+            np.full(PE_index.shape[0], event), PE_channels,
+            gen_times + transit_times, PE_index
+        )
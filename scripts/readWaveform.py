@@ -0,0 +1,87 @@
+'''
+readWaveform: 读取零压缩的波形
+
+主要接口：SparseWaveform
+genWaveform.SparseWaveformWriter把每个通道超过阈值的若干段采样点依次写入WaveformSamples，
+各段的位置写入WaveformSegments。SparseWaveform按需只读取所需事件的段与采样点，
+重建为与Waveform表格式相同的完整波形，被丢弃的采样点为0
+'''
+
+import numpy as np
+from .genWaveform import WAVEFORM_DTYPE, WINDOW
+
+
+def expand(segments, samples):
+    '''
+    把连续的若干段重建为Waveform表
+
+    输入:
+    segments, WaveformSegments中连续的若干行, 按(EventID, ChannelID, Start)排序;
+    samples, 从segments第一段的Offset开始读取的采样点.
+
+    返回: Waveform表, 每个通道一行
+    '''
+    keys = (segments['EventID'].astype(np.int64) << 32) | segments['ChannelID']
+    change = np.diff(keys, prepend=-1) != 0
+    rows = np.cumsum(change) - 1
+    first = np.flatnonzero(change)
+
+    # 第i段的第m个采样点在展平的波形中的位置为rows*WINDOW + Start + m
+    lengths = segments['Length'].astype(np.int64)
+    local = segments['Offset'] - segments['Offset'][0] if len(segments) > 0 else lengths
+    positions = np.arange(lengths.sum()) + np.repeat(rows * WINDOW + segments['Start'] - local, lengths)
+    traces = np.zeros((len(first), WINDOW), dtype='<i2')
+    traces.reshape(-1)[positions] = samples[:len(positions)]
+
+    WF = np.empty(len(first), dtype=WAVEFORM_DTYPE)
+    WF['EventID'] = segments['EventID'][first]
+    WF['ChannelID'] = segments['ChannelID'][first]
+    WF['Waveform'] = traces
+    return WF
+
+
+class SparseWaveform:
+    '''
+    零压缩的波形的读取者，打开时只读取各段的EventID一列用于定位事件
+    f为打开的hdf5文件，读取时文件须保持打开
+
+    event(EventID)给出一个事件的Waveform表; read(first, last)给出
+    EventID在[first, last)中各事件的Waveform表; 迭代时逐个事件给出
+    '''
+
+    def __init__(self, f):
+        self.segments = f['WaveformSegments']
+        self.samples = f['WaveformSamples']
+        events = self.segments.fields('EventID')[...]
+        self.events, self.starts = np.unique(events, return_index=True)
+        self.starts = np.append(self.starts, len(events))
+
+    def __len__(self):
+        return len(self.events)
+
+    def rows(self, start, stop):
+        '''
+        重建WaveformSegments[start:stop]，采样点一次连续读取
+        '''
+        segments = self.segments[start:stop]
+        if len(segments) == 0:
+            return np.empty(0, dtype=WAVEFORM_DTYPE)
+        end = segments['Offset'][-1] + segments['Length'][-1]
+        return expand(segments, self.samples[segments['Offset'][0]:end])
+
+    def read(self, first, last):
+        '''
+        EventID在[first, last)中各事件的Waveform表
+        '''
+        i, j = np.searchsorted(self.events, [first, last])
+        return self.rows(self.starts[i], self.starts[j])
+
+    def event(self, EventID):
+        '''
+        一个事件的Waveform表，没有该事件时为空表
+        '''
+        return self.read(EventID, EventID + 1)
+
+    def __iter__(self):
+        for i in range(len(self.events)):
+            yield self.rows(self.starts[i], self.starts[i+1])
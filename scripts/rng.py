@@ -0,0 +1,129 @@
+'''
+rng.py: 基于计数器的随机数
+
+主要接口：CounterRNG
+每个随机数由(seed, 随机数流, EventID, 序号, 槽位)经哈希直接算出，与生成的先后顺序无关。
+因此任意事件区间都可以在任意进程、以任意顺序、任意分块方式模拟，用到的随机数与串行运行逐位相同，
+也可以单独重新模拟某一个事件
+'''
+
+import numpy as np
+from numba import njit
+from scipy.special import ndtri
+from scipy.stats import poisson
+
+# 各阶段使用的随机数流，不同的流互不相关
+STREAM_VERTEX = 1 # 顶点位置，(EventID, 0, 槽位)
+STREAM_PHOTON_COUNT = 2 # 每个事件的光子数，(EventID, 0, 0)
+STREAM_PHOTON_TIME = 3 # GenTime，(EventID, 候选光子序号, 槽位)
+STREAM_DIRECTION = 4 # 光子出射方向，(EventID, PhotonID, 槽位)
+STREAM_OPTICS = 5 # 光学过程中的反射/折射选择，(EventID, PhotonID, 第几次选择)
+STREAM_NOISE = 6 # 波形噪声，(EventID, 行, 采样点)
+STREAM_CONTROL_NOISE = 7 # 各event相同的波形噪声，(0, 行, 采样点)
+STREAM_PROBE_COUNT = 8 # 探针表模式中每个PMT的PE数，(EventID, PMT编号, 直接/反射)
+STREAM_PROBE_TIME = 9 # 探针表模式中PE的时间，(EventID, PE编号, 槽位)
+STREAM_ROULETTE = 10 # 光学过程中的轮盘赌与PE取整，(EventID, PhotonID, 第几次选择)
+STREAM_SPLIT = 11 # 加权模式中光子的抽选与分支的轮盘赌，(EventID, PhotonID, 分支编号)
+STREAM_RESAMPLE = 12 # 加权模式中PE的重抽样，(EventID, 0, 0)
+STREAM_NOISE_BANK = 13 # 噪声库的内容，(0, 序号, 0)，种子固定，与模拟的种子无关
+STREAM_NOISE_OFFSET = 14 # 每行噪声在噪声库中的偏移，(EventID, 行, 0)，各event相同时为(0, 行, 1)
+
+
+@njit(cache=True)
+def _mix(x):
+    '''
+    splitmix64的终混函数，是uint64上的双射
+    '''
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+
+@njit(cache=True)
+def _hash(key, stream, events, indexs, slots, out):
+    '''
+    逐个元素计算哈希，依次混入流、EventID、序号和槽位
+    '''
+    base = _mix(np.uint64(key) ^ np.uint64(stream))
+    for i in range(out.shape[0]):
+        h = _mix(base ^ events[i])
+        h = _mix(h ^ indexs[i])
+        out[i] = _mix(h ^ slots[i])
+
+
+@njit(cache=True)
+def uniform(key, stream, event, index, slot):
+    '''
+    供numba代码调用的单个[0, 1)均匀随机数，与CounterRNG.random逐位相同
+    key为CounterRNG.key
+    '''
+    h = _mix(_mix(np.uint64(key) ^ np.uint64(stream)) ^ np.uint64(event))
+    h = _mix(h ^ np.uint64(index))
+    return (_mix(h ^ np.uint64(slot)) >> np.uint64(11)) * 2.0**-53
+
+
+class CounterRNG:
+    '''
+    基于计数器的随机数生成器，没有内部状态
+    所有方法的event, index, slot参数都可以是数组，按numpy规则广播
+    '''
+
+    def __init__(self, seed=None):
+        '''
+        seed为None时随机取一个种子，可由self.seed读出以便复现
+        '''
+        if seed is None:
+            seed = np.random.SeedSequence().entropy % 2**63
+        self.seed = int(seed)
+        self._key = np.uint64(_mix(np.uint64(self.seed)))
+
+    @property
+    def key(self):
+        '''
+        由seed导出的哈希密钥，传给numba代码中的uniform
+        '''
+        return self._key
+
+    def bits(self, stream, event, index=0, slot=0):
+        '''
+        给出uint64的随机数
+        '''
+        arrays = [np.asarray(a, dtype=np.uint64) for a in (event, index, slot)]
+        shape = np.broadcast_shapes(*(a.shape for a in arrays))
+        # broadcast_arrays给出的视图交给numba时会有FutureWarning，展开为连续的数组
+        events, indexs, slots = (
+            np.ascontiguousarray(np.broadcast_to(a, shape)).ravel() for a in arrays
+        )
+        out = np.empty(events.size, dtype=np.uint64)
+        _hash(self._key, stream, events, indexs, slots, out)
+        return out.reshape(shape)
+
+    def random(self, stream, event, index=0, slot=0):
+        '''
+        [0, 1)上的均匀分布
+        '''
+        return (self.bits(stream, event, index, slot) >> np.uint64(11)) * 2.0**-53
+
+    def open_random(self, stream, event, index=0, slot=0):
+        '''
+        (0, 1)上的均匀分布，用于求逆时避开端点
+        '''
+        return ((self.bits(stream, event, index, slot) >> np.uint64(11)) + 0.5) * 2.0**-53
+
+    def exponential(self, stream, event, index=0, slot=0):
+        '''
+        均值为1的指数分布
+        '''
+        return -np.log(self.open_random(stream, event, index, slot))
+
+    def normal(self, stream, event, index=0, slot=0):
+        '''
+        标准正态分布，由逆CDF给出
+        '''
+        return ndtri(self.open_random(stream, event, index, slot))
+
+    def poisson(self, lam, stream, event, index=0, slot=0):
+        '''
+        期望为lam的泊松分布，由逆CDF给出
+        '''
+        return poisson.ppf(self.random(stream, event, index, slot), lam).astype(np.int64)
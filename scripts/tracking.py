@@ -0,0 +1,379 @@
+'''
+tracking.py: 逐光子的光学过程
+
+主要接口：NumbaTracer
+与genPETruth.Tracer的物理过程和随机数完全相同，但每个光子在一个numba循环里
+从液闪内一直追踪到被PMT吸收或丢失，不产生中间数组，光子之间并行
+光子状态只在寄存器中，始终以float64计算，float32模式只改变输入的光子与输出的PE时间
+加权模式中每个光子的所有分支在split_one中深度优先地追踪
+'''
+
+import numpy as np
+from numba import njit, prange
+from .utils import n_water, n_LS, n_glass, Ri, r_PMT
+from .rng import uniform, STREAM_OPTICS, STREAM_ROULETTE, STREAM_SPLIT
+from .geometry import PMTIndex, first_hit_one
+from .optics import interface_one, refract_one, reflect_one
+
+c = 0.3 # 这里的单位制需要是m/ns
+eta = n_LS / n_water
+
+# 光子下一次相互作用的类型，与genPETruth中的相同
+GO_INSIDE = 0
+HIT_PMT_AGAIN = 1
+HIT_PMT = 2
+TRANSIST = 3
+
+# 默认的最多反射次数、轮盘赌存活概率与加权模式的最小权重，与genPETruth中的相同
+MAX_BOUNCES = 4
+SURVIVAL = 1.0
+MIN_WEIGHT = 0.1
+
+
+class NumbaTracer:
+    '''
+    numba后端，接口与genPETruth.Tracer相同
+    每个光子至多在一个PMT上产生PE（轮盘赌后可能是几份相同的PE），
+    写入以光子序号为下标的输出槽位，不需要加锁
+    加权模式中每个光子击中PMT的分支数不定，先数出各光子的分支数，再按偏移写入
+    '''
+
+    def __init__(self, PMTs, rng, pe_buffer, index=None, max_bounces=MAX_BOUNCES,
+                 survival=SURVIVAL, weight=None, min_weight=MIN_WEIGHT, dtype='<f8'):
+        '''
+        PMTs: (3, n)的PMT球心坐标
+        rng: CounterRNG
+        pe_buffer: 写入PE的PEBuffer
+        index: PMTIndex，默认按PMTs新建
+        max_bounces, survival: 最多反射次数与轮盘赌的存活概率，见genPETruth.Tracer
+        weight, min_weight: 加权模式的初始权重与最小权重，weight为None时逐光子模拟
+        dtype: 输入的光子与输出的PE时间的浮点类型
+        '''
+        self.index = PMTIndex(PMTs) if index is None else index
+        self.rng = rng
+        self.pe_buffer = pe_buffer
+        self.max_bounces = max_bounces
+        self.survival = survival
+        self.weight = weight
+        self.min_weight = min_weight
+        self.dtype = dtype
+
+    def run(self, source):
+        '''
+        source依次给出从顶点出发的光子
+        '''
+        for photons in source:
+            self.trace(photons)
+
+    def trace(self, photons):
+        '''
+        追踪一批从顶点出发的光子，把PE写入pe_buffer
+        '''
+        if self.weight is not None:
+            self.trace_weighted(photons)
+            return
+        n = photons['times'].shape[0]
+        PMT_indexs = np.empty(n, dtype=np.int64)
+        times = np.empty(n, dtype=self.dtype)
+        copies = np.empty(n, dtype=np.int64)
+        track_kernel(
+            self.rng.key,
+            np.ascontiguousarray(photons['coordinates']),
+            np.ascontiguousarray(photons['velocities']),
+            photons['times'], photons['events'], photons['photons'],
+            self.index.PMTs, self.index.table, self.index.n_theta,
+            self.index.n_phi, self.index.piece_length,
+            self.max_bounces, self.survival,
+            PMT_indexs, times, copies
+        )
+        self.pe_buffer.append(
+            np.repeat(photons['events'], copies), np.repeat(PMT_indexs, copies),
+            np.repeat(times, copies), np.repeat(photons['photons'], copies)
+        )
+
+    def trace_weighted(self, photons):
+        '''
+        加权模式: 追踪一批光子的所有分支，把击中PMT的分支写入WeightedPEBuffer
+        '''
+        args = (
+            self.rng.key,
+            np.ascontiguousarray(photons['coordinates']),
+            np.ascontiguousarray(photons['velocities']),
+            photons['times'], photons['events'], photons['photons'], photons['weights'],
+            self.index.PMTs, self.index.table, self.index.n_theta,
+            self.index.n_phi, self.index.piece_length, self.max_bounces, self.min_weight
+        )
+        # 第一遍只数出每个光子击中PMT的分支数，第二遍按偏移写入，两遍的追踪完全相同
+        counts = np.empty(photons['times'].shape[0], dtype=np.int64)
+        empty = np.empty(0)
+        split_kernel(*args, counts, False, np.empty(0, dtype=np.int64), empty, empty,
+                     np.empty(0, dtype=np.uint64))
+        offsets = np.cumsum(counts) - counts
+        total = int(counts.sum())
+        PMT_indexs = np.empty(total, dtype=np.int64)
+        times = np.empty(total, dtype=self.dtype)
+        weights = np.empty(total)
+        branches = np.empty(total, dtype=np.uint64)
+        split_kernel(*args, offsets, True, PMT_indexs, times, weights, branches)
+        self.pe_buffer.append(
+            np.repeat(photons['events'], counts), PMT_indexs, times,
+            np.repeat(photons['photons'], counts), weights, branches
+        )
+
+
+@njit(parallel=True, cache=True)
+def track_kernel(key, coordinates, velocities, times, events, photons,
+                 PMTs, table, n_theta, n_phi, piece_length, max_bounces, survival,
+                 PMT_indexs, PE_times, copies):
+    '''
+    并行追踪每个光子，PMT_indexs为击中的PMT，PE_times为PE时间，copies为PE的份数（0为没有PE）
+    '''
+    for i in prange(times.shape[0]):
+        PMT_indexs[i], PE_times[i], copies[i] = track_one(
+            key, np.float64(coordinates[0, i]), np.float64(coordinates[1, i]),
+            np.float64(coordinates[2, i]), np.float64(velocities[0, i]),
+            np.float64(velocities[1, i]), np.float64(velocities[2, i]),
+            np.float64(times[i]), events[i], photons[i],
+            PMTs, table, n_theta, n_phi, piece_length, max_bounces, survival
+        )
+
+
+@njit(cache=True)
+def track_one(key, x, y, z, vx, vy, vz, t, event, photon,
+              PMTs, table, n_theta, n_phi, piece_length, max_bounces, survival):
+    '''
+    追踪单个光子，返回(击中的PMT, PE时间, PE的份数)，没有PE时为(-1, nan, 0)
+    各步的公式、判断条件与随机数槽位与Tracer的对应方法一致
+    '''
+    kind = TRANSIST
+    hops = 0
+    bounces = 0
+    weight = 1.0
+    while True:
+        prob = uniform(key, STREAM_OPTICS, event, photon, hops)
+        if kind == TRANSIST:
+            # 到达液闪边界
+            cv = x*vx + y*vy + z*vz
+            ts = -cv + np.sqrt(cv**2 - (x*x + y*y + z*z) + Ri**2)
+            x, y, z = x + ts*vx, y + ts*vy, z + ts*vz
+            t += (n_LS/c)*ts
+            nx, ny, nz = -x/Ri, -y/Ri, -z/Ri
+            cos_i, cos_t, R = interface_one(vx, vy, vz, nx, ny, nz, eta)
+
+            # 全反射后入射角不变，光子永远留在液闪内
+            if not cos_t > 0:
+                break
+
+            if prob > R:
+                # 折射出液闪
+                vx, vy, vz = refract_one(vx, vy, vz, nx, ny, nz, cos_i, cos_t, eta)
+                kind = HIT_PMT
+                hops += 1
+                continue
+            # 在液闪内反射
+            vx, vy, vz = reflect_one(vx, vy, vz, nx, ny, nz, cos_i)
+        elif kind == GO_INSIDE:
+            # 从PMT反射回液闪表面
+            cv = x*vx + y*vy + z*vz
+            ts = -cv - np.sqrt(cv**2 - (x*x + y*y + z*z) + Ri**2)
+            x, y, z = x + ts*vx, y + ts*vy, z + ts*vz
+            t += (n_water/c)*ts
+            nx, ny, nz = x/Ri, y/Ri, z/Ri
+            cos_i, cos_t, R = interface_one(vx, vy, vz, nx, ny, nz, 1/eta)
+            if prob > R:
+                vx, vy, vz = refract_one(vx, vy, vz, nx, ny, nz, cos_i, cos_t, 1/eta)
+                kind = TRANSIST
+                hops += 1
+                continue
+            # 在液闪外表面反射，回到水中
+            vx, vy, vz = reflect_one(vx, vy, vz, nx, ny, nz, cos_i)
+            kind = HIT_PMT
+        else:
+            # 射向PMT
+            j = first_hit_one(x, y, z, vx, vy, vz, PMTs, table, n_theta, n_phi, piece_length)[0]
+            if j < 0:
+                break
+            wx, wy, wz = x - PMTs[0, j], y - PMTs[1, j], z - PMTs[2, j]
+            bw = wx*vx + wy*vy + wz*vz
+            ts = -bw - np.sqrt(bw**2 - (wx*wx + wy*wy + wz*wz) + r_PMT**2)
+            t += (n_water/c)*ts
+            x, y, z = x + ts*vx, y + ts*vy, z + ts*vz
+            nx = (x - PMTs[0, j]) / r_PMT
+            ny = (y - PMTs[1, j]) / r_PMT
+            nz = (z - PMTs[2, j]) / r_PMT
+            cos_i, cos_t, R = interface_one(vx, vy, vz, nx, ny, nz, n_water/n_glass)
+
+            # 水的折射率小于玻璃，不可能全反射
+            if prob > R:
+                return j, t, pe_copies(key, event, photon, hops, weight, survival)
+
+            # 在PMT表面反射，判断是否会射回液闪内
+            vx, vy, vz = reflect_one(vx, vy, vz, nx, ny, nz, cos_i)
+            rt = -(x*vx + y*vy + z*vz)
+            ds = np.sqrt((x + rt*vx)**2 + (y + rt*vy)**2 + (z + rt*vz)**2)
+            kind = GO_INSIDE if ds < Ri else HIT_PMT_AGAIN
+
+        # 反射: 超过最多反射次数的光子丢弃，之后的每次反射进行轮盘赌
+        bounces += 1
+        if bounces > max_bounces:
+            break
+        if bounces > 1 and survival < 1:
+            if uniform(key, STREAM_ROULETTE, event, photon, hops) >= survival:
+                break
+            weight /= survival
+        hops += 1
+    return -1, np.nan, 0
+
+
+@njit(cache=True)
+def pe_copies(key, event, photon, hops, weight, survival):
+    '''
+    权重为weight的PE随机取整为floor(weight)或floor(weight)+1份，期望等于weight
+    '''
+    if survival == 1:
+        return 1
+    return int(np.floor(weight + uniform(key, STREAM_ROULETTE, event, photon, hops)))
+
+
+@njit(parallel=True, cache=True)
+def split_kernel(key, coordinates, velocities, times, events, photons, weights,
+                 PMTs, table, n_theta, n_phi, piece_length, max_bounces, min_weight,
+                 offsets, write, PMT_indexs, PE_times, PE_weights, branches):
+    '''
+    加权模式中并行追踪每个光子的所有分支
+    write为False时把每个光子击中PMT的分支数写入offsets，
+    为True时从offsets处开始写入各分支击中的PMT、时间、权重与分支编号
+    '''
+    for i in prange(times.shape[0]):
+        hits = split_one(
+            key, np.float64(coordinates[0, i]), np.float64(coordinates[1, i]),
+            np.float64(coordinates[2, i]), np.float64(velocities[0, i]),
+            np.float64(velocities[1, i]), np.float64(velocities[2, i]),
+            np.float64(times[i]), events[i], photons[i], weights[i],
+            PMTs, table, n_theta, n_phi, piece_length, max_bounces, min_weight,
+            offsets[i] if write else 0, write, PMT_indexs, PE_times, PE_weights, branches
+        )
+        if not write:
+            offsets[i] = hits
+
+
+@njit(cache=True)
+def roulette_one(key, event, photon, branch, weight, min_weight):
+    '''
+    权重低于min_weight的分支以weight/min_weight的概率存活，返回存活后的权重，丢弃时为0
+    '''
+    if weight >= min_weight:
+        return weight
+    if uniform(key, STREAM_SPLIT, event, photon, branch) * min_weight < weight:
+        return min_weight
+    return 0.0
+
+
+@njit(cache=True)
+def split_one(key, x, y, z, vx, vy, vz, t, event, photon, weight,
+              PMTs, table, n_theta, n_phi, piece_length, max_bounces, min_weight,
+              start, write, PMT_indexs, PE_times, PE_weights, branches):
+    '''
+    加权模式中追踪单个光子的所有分支，返回击中PMT的分支数，write为True时从start处写入
+    与genPETruth.Tracer.split相同：反射与折射两支的权重分别乘以R与1-R，
+    分支编号追加一位（反射为1），继续追踪的分支经过roulette_one
+    界面上先把反射的一支压栈，继续追踪折射的一支，栈深不超过路径上的界面数
+    '''
+    depth = 4 * (max_bounces + 1)
+    stack = np.empty((depth, 8))
+    kinds = np.empty(depth, dtype=np.int64)
+    bounce_stack = np.empty(depth, dtype=np.int64)
+    branch_stack = np.empty(depth, dtype=np.uint64)
+    top = 0
+    hits = 0
+    kind = TRANSIST
+    bounces = 0
+    branch = np.uint64(1)
+    alive = True
+    while True:
+        if not alive:
+            if top == 0:
+                return hits
+            top -= 1
+            x, y, z = stack[top, 0], stack[top, 1], stack[top, 2]
+            vx, vy, vz = stack[top, 3], stack[top, 4], stack[top, 5]
+            t, weight = stack[top, 6], stack[top, 7]
+            kind, bounces, branch = kinds[top], bounce_stack[top], branch_stack[top]
+        alive = True
+        reflected_branch = branch * np.uint64(2) + np.uint64(1)
+        if kind == TRANSIST or kind == GO_INSIDE:
+            cv = x*vx + y*vy + z*vz
+            if kind == TRANSIST:
+                # 到达液闪边界
+                ts = -cv + np.sqrt(cv**2 - (x*x + y*y + z*z) + Ri**2)
+                x, y, z = x + ts*vx, y + ts*vy, z + ts*vz
+                t += (n_LS/c)*ts
+                nx, ny, nz = -x/Ri, -y/Ri, -z/Ri
+                ratio = eta
+                transmit_kind, reflect_kind = HIT_PMT, TRANSIST
+            else:
+                # 从PMT反射回液闪表面
+                ts = -cv - np.sqrt(cv**2 - (x*x + y*y + z*z) + Ri**2)
+                x, y, z = x + ts*vx, y + ts*vy, z + ts*vz
+                t += (n_water/c)*ts
+                nx, ny, nz = x/Ri, y/Ri, z/Ri
+                ratio = 1/eta
+                transmit_kind, reflect_kind = TRANSIST, HIT_PMT
+            cos_i, cos_t, R = interface_one(vx, vy, vz, nx, ny, nz, ratio)
+
+            # 全反射后入射角不变，光子永远留在液闪内
+            if not cos_t > 0:
+                alive = False
+                continue
+
+            # 反射的一支压栈
+            reflected_weight = roulette_one(
+                key, event, photon, reflected_branch, weight * R, min_weight
+            )
+            if bounces + 1 <= max_bounces and reflected_weight > 0:
+                rx, ry, rz = reflect_one(vx, vy, vz, nx, ny, nz, cos_i)
+                stack[top, 0], stack[top, 1], stack[top, 2] = x, y, z
+                stack[top, 3], stack[top, 4], stack[top, 5] = rx, ry, rz
+                stack[top, 6], stack[top, 7] = t, reflected_weight
+                kinds[top], bounce_stack[top], branch_stack[top] = reflect_kind, bounces + 1, reflected_branch
+                top += 1
+
+            # 继续追踪折射的一支
+            vx, vy, vz = refract_one(vx, vy, vz, nx, ny, nz, cos_i, cos_t, ratio)
+            branch = branch * np.uint64(2)
+            weight = roulette_one(key, event, photon, branch, weight * (1 - R), min_weight)
+            alive = weight > 0
+            kind = transmit_kind
+        else:
+            # 射向PMT
+            j = first_hit_one(x, y, z, vx, vy, vz, PMTs, table, n_theta, n_phi, piece_length)[0]
+            if j < 0:
+                alive = False
+                continue
+            wx, wy, wz = x - PMTs[0, j], y - PMTs[1, j], z - PMTs[2, j]
+            bw = wx*vx + wy*vy + wz*vz
+            ts = -bw - np.sqrt(bw**2 - (wx*wx + wy*wy + wz*wz) + r_PMT**2)
+            t += (n_water/c)*ts
+            x, y, z = x + ts*vx, y + ts*vy, z + ts*vz
+            nx = (x - PMTs[0, j]) / r_PMT
+            ny = (y - PMTs[1, j]) / r_PMT
+            nz = (z - PMTs[2, j]) / r_PMT
+            cos_i, cos_t, R = interface_one(vx, vy, vz, nx, ny, nz, n_water/n_glass)
+
+            # 折射进入PMT的一支连同权重写入，不进行轮盘赌
+            if write:
+                PMT_indexs[start + hits] = j
+                PE_times[start + hits] = t
+                PE_weights[start + hits] = weight * (1 - R)
+                branches[start + hits] = branch * np.uint64(2)
+            hits += 1
+
+            # 继续追踪在PMT表面反射的一支
+            weight = roulette_one(key, event, photon, reflected_branch, weight * R, min_weight)
+            bounces += 1
+            alive = bounces <= max_bounces and weight > 0
+            branch = reflected_branch
+            vx, vy, vz = reflect_one(vx, vy, vz, nx, ny, nz, cos_i)
+            rt = -(x*vx + y*vy + z*vz)
+            ds = np.sqrt((x + rt*vx)**2 + (y + rt*vy)**2 + (z + rt*vz)**2)
+            kind = GO_INSIDE if ds < Ri else HIT_PMT_AGAIN
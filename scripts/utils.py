@@ -1,7 +1,12 @@
+import os
+import hashlib
+import multiprocessing as mp
+from multiprocessing import shared_memory
 import numpy as np
 import scipy.constants
 import h5py
 import numexpr as ne
+from numba import set_num_threads
 
 '''
 utility functions
@@ -16,6 +21,21 @@ given axis (theta0, phi0) and rotational invariance about the axis
 save_file:
 save data file
 
+append_file:
+append data to a (possibly new) data file
+
+cache_path, load_cache, save_cache:
+persistent on-disk cache of precomputed tables
+
+share_array, attach_array:
+place an array in shared memory for worker processes
+
+worker_context, single_thread:
+start worker processes and restrict each of them to one thread
+
+cached_pool, close_pool, attach_inputs:
+keep a process pool across calls, and switch its workers to new shared arrays
+
 '''
 
 # 常数定义
@@ -27,6 +47,12 @@ n_glass = 1.5 # 玻璃的折射率
 c = scipy.constants.c # 光速，单位m/s
 r_PMT = 0.508/2 # PMT的半径，单位m
 
+# 预计算表的缓存目录，可用环境变量JUNO_CACHE_DIR覆盖
+CACHE_DIR = os.environ.get(
+    'JUNO_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache', 'juno-simulation')
+)
+
 
 def xyz_from_spher(r, theta, phi):
     '''
@@ -74,3 +100,181 @@ def save_file(filename, ParticleTruth, PETruth, Waveform=None):
         opt['PETruth'] = PETruth
         if Waveform != None:
             opt['Waveform'] = Waveform
+
+def append_file(filename, ParticleTruth, PETruth):
+    '''
+    append data to file, resizable datasets are created if absent
+
+    input:
+    filename, path of output file;
+    ParticleTruth, PETruth, structured arrays;
+    '''
+    append_table(filename, 'ParticleTruth', ParticleTruth)
+    append_table(filename, 'PETruth', PETruth)
+
+def append_table(filename, name, data):
+    '''
+    append a structured array to the dataset name, created resizable if absent
+
+    input:
+    filename, path of output file;
+    name, dataset name;
+    data, structured array;
+    '''
+    with h5py.File(filename, "a") as opt:
+        if name not in opt:
+            opt.create_dataset(name, data=data, maxshape=(None,), chunks=True)
+        elif len(data) > 0:
+            ds = opt[name]
+            ds.resize(ds.shape[0] + len(data), axis=0)
+            ds[-len(data):] = data
+
+def cache_path(prefix, *key):
+    '''
+    give the path of a cached table
+
+    input: prefix, name of the table; key, parameters the table depends on
+    output: path under CACHE_DIR, unique for (prefix, key)
+    '''
+    digest = hashlib.sha1(repr((prefix,) + key).encode()).hexdigest()[:16]
+    return os.path.join(CACHE_DIR, f'{prefix}-{digest}.npy')
+
+def load_cache(path):
+    '''
+    load a cached table
+
+    input: path, given by cache_path
+    output: the array, or None if not cached (or unreadable)
+    '''
+    try:
+        return np.load(path, allow_pickle=False)
+    except (OSError, ValueError):
+        return None
+
+def save_cache(path, array):
+    '''
+    save a table to the cache, silently skipped if CACHE_DIR is not writable
+
+    input: path, given by cache_path; array, table to save
+    '''
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 先写临时文件再改名，防止并行的任务读到写了一半的文件
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp, path)
+    except OSError:
+        pass
+
+def share_array(array):
+    '''
+    copy an array into a new shared memory block
+
+    input: array, numpy array (structured arrays allowed)
+    output: (shm, spec), the SharedMemory to be closed and unlinked by the caller,
+            and the picklable spec to be passed to attach_array
+    '''
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    view = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+    view[...] = array
+    return shm, (shm.name, array.shape, array.dtype)
+
+def attach_array(spec):
+    '''
+    view an array placed in shared memory by share_array, without copying
+
+    input: spec, given by share_array
+    output: (shm, array), shm must be kept alive as long as the array is used
+    '''
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+def worker_context():
+    '''
+    give the multiprocessing context in which worker processes are started
+
+    output: the 'spawn' context
+    '''
+    # numba的TBB线程池在fork之后不可用，工作进程由spawn启动
+    return mp.get_context('spawn')
+
+def single_thread():
+    '''
+    restrict the calling worker process to one numba and one numexpr thread
+    '''
+    # 并行由进程完成，进程内不再开线程，避免线程数超过核数
+    set_num_threads(1)
+    ne.set_num_threads(1)
+
+def cached_pool(cache, key, workers, initializer, arrays, *initargs):
+    '''
+    give a process pool kept in the dict cache, reused as long as key is unchanged,
+    otherwise the old pool is closed and a new one started
+
+    input: cache, dict holding the pool; key, parameters the workers depend on;
+           workers, number of processes; initializer, called in each worker with
+           (specs of arrays, *initargs); arrays, dict of arrays placed in shared memory
+           once per pool
+    output: the multiprocessing Pool
+    '''
+    if cache.get('key') != key:
+        close_pool(cache)
+        cache['shared'] = {}
+        for name, array in arrays.items():
+            cache['shared'][name] = share_array(array)
+        specs = {name: spec for name, (shm, spec) in cache['shared'].items()}
+        cache['pool'] = worker_context().Pool(
+            workers, initializer=initializer, initargs=(specs,) + initargs
+        )
+        cache['key'] = key
+    return cache['pool']
+
+def close_pool(cache):
+    '''
+    close the pool kept by cached_pool and release its shared memory
+
+    input: cache, dict given to cached_pool
+    '''
+    pool = cache.pop('pool', None)
+    if pool is not None:
+        pool.terminate()
+        pool.join()
+    for shm, spec in cache.pop('shared', {}).values():
+        shm.close()
+        shm.unlink()
+    cache.clear()
+
+def attach_inputs(inputs, specs):
+    '''
+    in a worker, attach the arrays of one call into the dict inputs,
+    detaching those of the previous call (already unlinked by the main process)
+
+    input: inputs, dict of the worker; specs, dict of specs given by share_array
+    output: True if newly attached, False if specs are those already attached
+    '''
+    if inputs.get('specs') == specs:
+        return False
+    handles = [inputs[name + '_shm'] for name in inputs.get('specs', {})]
+    # 先丢掉数组再断开，否则共享内存仍被引用，无法关闭
+    inputs.clear()
+    for shm in handles:
+        shm.close()
+    for name, spec in specs.items():
+        inputs[name + '_shm'], inputs[name] = attach_array(spec)
+    inputs['specs'] = specs
+    return True
+
+def shard_bounds(EventID, shards):
+    '''
+    split a table sorted by EventID into at most shards pieces of similar length,
+    cutting only at event boundaries
+
+    input: EventID, the EventID column; shards, number of pieces
+    output: (pieces, 2) array of [start, stop) row ranges
+    '''
+    event_starts = np.append(np.flatnonzero(np.diff(EventID)) + 1, EventID.shape[0])
+    targets = np.linspace(0, EventID.shape[0], shards + 1)[1:]
+    stops = np.unique(event_starts[np.searchsorted(event_starts, targets)])
+    return np.stack((np.append(0, stops[:-1]), stops), axis=-1)
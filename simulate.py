@@ -8,6 +8,58 @@ simulate.py: 生成模拟数据, 保存在hdf5文件中
 
 可选的参数:
 -p --pmt: Number of PMTs, default is 17612
+--sampler: GenTime sampling method, 'inverse' (default) or 'thinning'
+--optics: Optics backend, 'numpy' (default), 'numba' or 'table' (PEs drawn
+          from the probe tables of genSimProbe without tracing photons)
+-j --workers: Number of processes for the optics stage, default is 1
+-w --waveform-workers: Number of processes for the waveform stage, default
+                       is 1. Workers take contiguous blocks of events and the
+                       main process appends them in EventID order
+-c --chunk: Number of events per chunk, simulate chunk by chunk so that
+            memory is bounded by chunk size, default is all events at once
+--max-memory: Memory budget in MB, the chunk size and the optics batch
+              size are planned to fit in it (overrides -c), the plan is printed.
+              The waveform stage is sized for --waveform, --noise-bank and -w
+--max-bounces: Number of reflections a photon may undergo before it is
+               dropped, default is 4, at most 14 with --weighted
+--survival: Russian-roulette survival probability after the first
+            reflection, surviving photons carry weight 1/survival,
+            default is 1 (no roulette)
+--weighted: Weighted mode, trace on average one photon out of WEIGHTED with
+            that weight, follow both the reflected and the refracted branch
+            at every interface and resample PEs from the weights at the end.
+            PETruth has the same expectation with far fewer traced photons
+--float32: Trace photons and store PETime in float32 instead of float64,
+           see benchmarks/validate_float32.py for the accuracy
+--waveform: Waveform synthesis method, 'dense' (default, the double
+            exponential model on the full (PE, 1000) grid), 'template'
+            (a precomputed sub-ns pulse template added per PE), 'fft'
+            (per-channel histograms convolved by rFFT), 'auto' (fft for busy
+            channels, template otherwise) or 'int' (template accumulated in
+            int32 fixed point, saturated to int16 on output; the number of
+            saturated samples is kept in the 'saturated' file attribute)
+--compression: Compression of the Waveform table, 'gzip' (default, level
+               1), 'lzf' (faster, but only readable through h5py) or
+               'none'. The table is preallocated and chunked about one event
+               per chunk
+--zero-suppress: Store only the samples above a threshold in ADC (default 50
+                 when given without a value) plus a few around them, as the
+                 WaveformSegments and WaveformSamples tables instead of
+                 Waveform. Read back with scripts.readWaveform.SparseWaveform
+--writer-depth: Number of waveform blocks queued for the background HDF5
+                writer thread, default is 2 (double buffering: block k is
+                written while block k+1 is synthesized), 0 writes
+                synchronously in the main thread
+--noise-bank: Take each noise row as a slice at a random offset of a
+              precomputed bank of Gaussian noise (cached in JUNO_CACHE_DIR)
+              instead of drawing 1000 Gaussians per row, the noise is never
+              expanded to a (PE, 1000) matrix except for --waveform dense
+--fused: Generate photons batch by batch inside the optics stage instead of
+         building the whole PhotonTruth table first, results are equal within rounding
+--save-photons: Also write the PhotonTruth table to the output
+-s --seed: Random seed, default is random (printed and saved in output)
+--first-event: EventID of the first event, default is 0. Together with the
+               seed, any range of events can be re-simulated exactly
 
 输出格式:
 文件名opt，格式为hdf5
@@ -19,6 +71,11 @@ y       顶点坐标y/mm '<f8'
 z       顶点坐标z/mm '<f8'
 p       顶点动量/MeV '<f8'
 
+PhotonTruth 表（仅--save-photons）:
+EventID  事件编号                      '<i4'
+PhotonID 光子编号（每个事件单独编号）  '<i4'
+GenTime  光子产生时间/ns               '<f8'
+
 PETruth 表:
 EventID   事件编号      '<i4'
 ChannelID PMT 编号      '<i4'
@@ -28,15 +85,29 @@ Waveform 表:
 EventID   事件编号 '<i4'
 ChannelID PMT编号  '<i4'
 Waveform  波形     '<i2', (1000,)
+
+WaveformSegments 表（仅--zero-suppress，代替Waveform表）:
+EventID   事件编号                     '<i4'
+ChannelID PMT编号                      '<i4'
+Start     段在波形中的起点             '<i2'
+Length    段的采样点数                 '<i2'
+Offset    段在WaveformSamples中的起点  '<i8'
+
+WaveformSamples 表（仅--zero-suppress）: 各段的采样点 '<i2'
 '''
 
 import argparse
 import time
 import h5py as h5
-from scripts.event import generate_events
-from scripts.genPETruth import get_PE_Truth
-from scripts.genWaveform import get_waveform
-from scripts.utils import save_file
+from tqdm import tqdm
+from scripts.event import generate_events, generate_events_bychunk
+from scripts.genPETruth import get_PE_Truth, BACKENDS, BATCH_SIZE, MAX_BOUNCES, SURVIVAL, \
+    MAX_WEIGHTED_BOUNCES
+from scripts.planner import plan_memory
+from scripts.genWaveform import get_waveform, METHODS, COMPRESSIONS, COMPRESSION, ZS_THRESHOLD, \
+    WRITER_DEPTH
+from scripts.utils import save_file, append_file, append_table
+from scripts.rng import CounterRNG
 
 if __name__ == "__main__":
     start_time = time.time()
@@ -71,43 +142,267 @@ if __name__ == "__main__":
         help="Number of PMTs, default is 17612",
         default=17612
     )
+    parser.add_argument(
+        "--sampler",
+        dest="sampler",
+        type=str,
+        choices=["inverse", "thinning"],
+        help="GenTime sampling method, default is inverse",
+        default="inverse"
+    )
+    parser.add_argument(
+        "--optics",
+        dest="optics",
+        type=str,
+        choices=BACKENDS,
+        help="Optics backend, default is numpy",
+        default="numpy"
+    )
+    parser.add_argument(
+        "-j",
+        "--workers",
+        dest="workers",
+        type=int,
+        help="Number of processes for the optics stage, default is 1",
+        default=1
+    )
+    parser.add_argument(
+        "-w",
+        "--waveform-workers",
+        dest="waveform_workers",
+        type=int,
+        help="Number of processes for the waveform stage, default is 1",
+        default=1
+    )
+    parser.add_argument(
+        "-c",
+        "--chunk",
+        dest="chunk",
+        type=int,
+        help="Number of events per chunk, default is all events at once",
+        default=None
+    )
+    parser.add_argument(
+        "--max-memory",
+        dest="max_memory",
+        type=float,
+        help="Memory budget in MB, overrides -c",
+        default=None
+    )
+    parser.add_argument(
+        "--max-bounces",
+        dest="max_bounces",
+        type=int,
+        help="Maximum number of reflections per photon, default is 4",
+        default=MAX_BOUNCES
+    )
+    parser.add_argument(
+        "--survival",
+        dest="survival",
+        type=float,
+        help="Survival probability of Russian roulette, default is 1",
+        default=SURVIVAL
+    )
+    parser.add_argument(
+        "--weighted",
+        dest="weight",
+        type=float,
+        help="Photon weight of the weighted mode, default is unweighted",
+        default=None
+    )
+    parser.add_argument(
+        "--float32",
+        dest="float32",
+        action="store_true",
+        help="Trace photons and store PETime in float32"
+    )
+    parser.add_argument(
+        "--waveform",
+        dest="waveform",
+        type=str,
+        choices=METHODS,
+        help="Waveform synthesis method, default is dense",
+        default="dense"
+    )
+    parser.add_argument(
+        "--compression",
+        dest="compression",
+        type=str,
+        choices=COMPRESSIONS,
+        help="Compression of the Waveform table, default is gzip",
+        default=COMPRESSION
+    )
+    parser.add_argument(
+        "--zero-suppress",
+        dest="zero_suppress",
+        type=float,
+        nargs="?",
+        const=ZS_THRESHOLD,
+        help="Store only waveform samples above this threshold, default is full waveforms",
+        default=None
+    )
+    parser.add_argument(
+        "--writer-depth",
+        dest="writer_depth",
+        type=int,
+        help="Queue length of the background waveform writer, default is 2",
+        default=WRITER_DEPTH
+    )
+    parser.add_argument(
+        "--noise-bank",
+        dest="noise_bank",
+        action="store_true",
+        help="Take waveform noise from a precomputed noise bank"
+    )
+    parser.add_argument(
+        "--fused",
+        dest="fused",
+        action="store_true",
+        help="Generate photons inside the optics stage without PhotonTruth table"
+    )
+    parser.add_argument(
+        "--save-photons",
+        dest="save_photons",
+        action="store_true",
+        help="Also write PhotonTruth to the output"
+    )
+    parser.add_argument(
+        "-s",
+        "--seed",
+        dest="seed",
+        type=int,
+        help="Random seed, default is random",
+        default=None
+    )
+    parser.add_argument(
+        "--first-event",
+        dest="first_event",
+        type=int,
+        help="EventID of the first event, default is 0",
+        default=0
+    )
     args = parser.parse_args()
+    if not 0 < args.survival <= 1:
+        parser.error("--survival must be in (0, 1]")
+    if args.weight is not None and args.weight < 1:
+        parser.error("--weighted must be at least 1")
+    if args.weight is not None and args.max_bounces > MAX_WEIGHTED_BOUNCES:
+        parser.error(f"--max-bounces must be at most {MAX_WEIGHTED_BOUNCES} with --weighted")
+
+    # 三个阶段共用的基于计数器的随机数，结果只由seed与EventID决定
+    rng = CounterRNG(args.seed)
+    print(f'随机数种子: {rng.seed}')
 
     # 读入几何文件
     with h5.File(args.geo, "r") as geo:
         PMT_list = geo['Geometry'][:args.pmt_count]
 
-    # 生成顶点
-    ParticleTruth, PhotonTruth = generate_events(args.n)
-
-    # 光学过程
-    PETruth = get_PE_Truth(ParticleTruth, PhotonTruth, PMT_list)
-
-    # 保存ParticleTruth和PETruth
-    save_file(args.opt, ParticleTruth, PETruth)
-
-    # 中断可直接读取
-    # with h5.File('data.h5', 'r') as inp:
-    #     ParticleTruth = inp['ParticleTruth'][...]
-    #     PETruth = inp['PETruth'][...]
-    #     try:
-    #         # 删除Waveform
-    #         del inp['Waveform']
-    #     except:
-    #         pass
-
-    # 生成波形同时保存
-    get_waveform(
-        args.opt,
-        PETruth,
+    # 波形参数
+    waveform_args = dict(
         ampli=1000,
         td=10,
         tr=5,
         ratio=0.01,
-        noisetype='normal',
-        controlnoise=True
+        noisetype='bank' if args.noise_bank else 'normal',
+        controlnoise=True,
+        rng=rng,
+        method=args.waveform,
+        workers=args.waveform_workers,
+        compression=args.compression,
+        zero_suppress=args.zero_suppress,
+        depth=args.writer_depth
     )
 
+    # 探针表模式不需要光子，与融合模式一样不生成PhotonTruth
+    if args.optics == "table":
+        if args.save_photons:
+            parser.error("--save-photons is not available with --optics table")
+        if args.weight is not None:
+            parser.error("--weighted is not available with --optics table")
+        args.fused = True
+
+    dtype = '<f4' if args.float32 else '<f8'
+
+    # 按内存预算安排分块
+    batch_size = BATCH_SIZE
+    if args.max_memory is not None:
+        plan = plan_memory(
+            args.n, args.max_memory * 2**20, args.sampler, args.optics, args.workers,
+            fused=args.fused, dtype=dtype, waveform=args.waveform,
+            waveform_workers=args.waveform_workers,
+            noisetype='bank' if args.noise_bank else 'normal'
+        )
+        print(plan)
+        args.chunk = plan.chunk_size
+        batch_size = plan.batch_size
+
+    # 融合模式下PhotonTruth只在光学过程中逐批存在，需要时逐批追加写入文件
+    photon_sink = None
+    if args.fused and args.save_photons:
+        if args.workers > 1:
+            parser.error("--save-photons with --fused requires -j 1")
+        photon_sink = lambda table: append_table(args.opt, 'PhotonTruth', table)
+
+    if args.chunk is not None:
+        # 分块模拟：每块依次经过光学过程与波形生成后追加写入文件
+        h5.File(args.opt, "w").close()
+        chunks = generate_events_bychunk(
+            args.n, args.chunk, args.sampler, rng, args.first_event, photons=not args.fused
+        )
+        for ParticleTruth, PhotonTruth in tqdm(chunks, total=-(-args.n // args.chunk)):
+            if args.save_photons and not args.fused:
+                append_table(args.opt, 'PhotonTruth', PhotonTruth)
+            PETruth = get_PE_Truth(
+                ParticleTruth, PhotonTruth, PMT_list, rng,
+                batch_size=batch_size, backend=args.optics, workers=args.workers,
+                sampler=args.sampler, photon_sink=photon_sink,
+                max_bounces=args.max_bounces, survival=args.survival, weight=args.weight,
+                dtype=dtype
+            )
+            append_file(args.opt, ParticleTruth, PETruth)
+            get_waveform(args.opt, PETruth, **waveform_args)
+    else:
+        # 生成顶点
+        ParticleTruth, PhotonTruth = generate_events(
+            args.n, args.sampler, rng, args.first_event, photons=not args.fused
+        )
+
+        # 光学过程
+        if photon_sink is not None:
+            h5.File(args.opt, "w").close()
+        PETruth = get_PE_Truth(
+            ParticleTruth, PhotonTruth, PMT_list, rng,
+            batch_size=batch_size, backend=args.optics, workers=args.workers,
+            sampler=args.sampler, photon_sink=photon_sink,
+            max_bounces=args.max_bounces, survival=args.survival, weight=args.weight,
+            dtype=dtype
+        )
+
+        # 保存ParticleTruth和PETruth
+        if photon_sink is not None:
+            append_file(args.opt, ParticleTruth, PETruth)
+        else:
+            save_file(args.opt, ParticleTruth, PETruth)
+            if args.save_photons:
+                append_table(args.opt, 'PhotonTruth', PhotonTruth)
+
+        # 中断可直接读取
+        # with h5.File('data.h5', 'r') as inp:
+        #     ParticleTruth = inp['ParticleTruth'][...]
+        #     PETruth = inp['PETruth'][...]
+        #     try:
+        #         # 删除Waveform
+        #         del inp['Waveform']
+        #     except:
+        #         pass
+
+        # 生成波形同时保存
+        get_waveform(args.opt, PETruth, **waveform_args)
+
+    # 记录种子以便复现
+    with h5.File(args.opt, "a") as opt:
+        opt.attrs['seed'] = rng.seed
+
     end_time = time.time()
     print('data.h5全部生成完成!')
     print('总共用时: %.2fs' % (end_time-start_time))